@@ -1,4 +1,30 @@
+import glob
+import os
+
 bind = '127.0.0.1:8000'
 workers = 3
+# gthread: heartbeat идет из главного потока, длинные потоковые выгрузки не убиваются по timeout
+worker_class = 'gthread'
+threads = 4
 user = 'triadus'
 timeout = 120
+
+# Метрики Prometheus: воркеры пишут значения в файлы общего каталога, /metrics собирает их вместе
+# (dashboard.metrics). Celery запускается с тем же PROMETHEUS_MULTIPROC_DIR, чтобы его задачи попадали в выдачу.
+# Переменная задается до загрузки приложения, иначе prometheus_client работает в однопроцессном режиме
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/b4yi_prometheus')
+
+
+# Файлы прошлого запуска удаляются, иначе счетчики и гистограммы продолжают суммироваться со старыми значениями.
+# Удаляются только файлы: каталог и его владелец (воркеры работают от user) сохраняются
+def on_starting(server):
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+    for path in glob.glob(os.path.join(PROMETHEUS_MULTIPROC_DIR, '*.db')):
+        os.remove(path)
+
+
+# Файлы gauge "live*" завершившегося воркера удаляются; счетчики и гистограммы остаются в сумме
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+from datetime import timedelta
 from pathlib import Path
 
 from django.utils.translation import gettext_lazy as _
@@ -34,6 +35,7 @@ CRISPY_ALLOWED_TEMPLATE_PACKS = 'bootstrap4'
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
 MIDDLEWARE = [
+    'dashboard.middleware.RequestInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -49,7 +51,7 @@ HOME_TEMPLATES = os.path.join(BASE_DIR, 'templates')
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'dashboard.instrumentation.InstrumentedDjangoTemplates',
         'DIRS': [HOME_TEMPLATES],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -177,6 +179,18 @@ EMAIL_ADMIN = os.getenv('EMAIL_ADMIN')
 ADMINS = [("Maximus", EMAIL_ADMIN)]
 EMAIL_SUBJECT_PREFIX = '[B4YI] '
 
+# Очередь писем: размер пачки на одно SMTP-соединение, число попыток отправки и срок захвата пачки воркером
+# (должен быть больше времени отправки пачки; по истечении письма, не отмеченные отправленными, берутся снова)
+
+EMAIL_OUTBOX_BATCH_SIZE = 50
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_LEASE = timedelta(minutes=10)
+
+# Рассылка итогов дня профита: пользователей в пачке и лимит писем в секунду (None - без ограничения)
+
+PROFIT_DIGEST_CHUNK_SIZE = 1000
+PROFIT_DIGEST_RATE_LIMIT = 20
+
 # Настройка Redis
 
 REDIS_HOST = '192.168.146.130'
@@ -188,6 +202,24 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
+# Кэш в Redis (общий для web и celery, иначе сброс версий не виден другим процессам)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/1',
+        'KEY_PREFIX': 'b4yi',
+    }
+}
+
+# Время жизни кэша контекста дашборда, сек (сбрасывается раньше по версиям)
+
+DASHBOARD_CACHE_TIMEOUT = 60 * 60
+
+# Максимум точек на графике профита (последние бакеты выбранного окна)
+
+PROFIT_CHART_MAX_POINTS = 366
+
 # # Запуск Celery при загрузке приложения
 # CELERY_APP_NAME = 'your_project_name'
 # CELERY_IMPORTS = [
@@ -195,3 +227,67 @@ CELERY_RESULT_SERIALIZER = 'json'
 # ]
 
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
+
+# Распределение профита: размер пачки кошельков и число шардов на монету
+
+PROFIT_DISTRIBUTION_CHUNK_SIZE = 5000
+PROFIT_DISTRIBUTION_SHARDS = 4
+
+# История курсов: срок хранения свечей по разрешениям (None - хранить всегда). Значения по умолчанию
+# (1m - 2 дня, 1h - 90 дней, 1d - всегда) заданы в dashboard.rates, здесь только переопределения
+
+EXCHANGE_RATE_HISTORY_RETENTION = {}
+
+# Запуски задач Celery (dashboard.models.TaskRun): срок хранения, старые записи удаляет задача prune_task_runs
+
+TASK_RUN_RETENTION = timedelta(days=30)
+
+# Номер генератора id транзакций (0-1022), только если id выдает один процесс;
+# None - каждый процесс web/celery получает свой номер из общего счетчика в Redis
+
+SNOWFLAKE_WORKER_ID = int(os.getenv('SNOWFLAKE_WORKER_ID')) if os.getenv('SNOWFLAKE_WORKER_ID') else None
+
+# Замеры запросов (dashboard.middleware.RequestInstrumentationMiddleware): заголовок Server-Timing,
+# в лог dashboard.requests - запросы дольше REQUEST_SLOW_THRESHOLD сек и доля REQUEST_LOG_SAMPLE_RATE остальных
+
+REQUEST_INSTRUMENTATION = True
+REQUEST_TIMING_HEADER = True
+REQUEST_LOG_SAMPLE_RATE = 0.01
+REQUEST_SLOW_THRESHOLD = 1.0
+
+# Метрики Prometheus (/metrics): токен для заголовка Authorization: Bearer <токен>; без токена /metrics
+# отдает 404 (кроме DEBUG).
+# Каталог метрик процессов PROMETHEUS_MULTIPROC_DIR задается в config/gunicorn.conf.py и окружении celery
+
+METRICS_TOKEN = os.getenv('METRICS_TOKEN') or None
+
+# Лог запросов: файл из REQUEST_LOG_FILE (вне каталога проекта), без него - stdout (его собирает supervisor).
+# WatchedFileHandler: файл пишут несколько процессов gunicorn, ротация - внешним logrotate
+
+REQUEST_LOG_FILE = os.getenv('REQUEST_LOG_FILE') or None
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'plain': {'format': '%(asctime)s %(levelname)s %(process)d %(message)s'},
+    },
+    'handlers': {
+        'requests': {
+            'class': 'logging.handlers.WatchedFileHandler',
+            'filename': REQUEST_LOG_FILE,
+            'formatter': 'plain',
+        } if REQUEST_LOG_FILE else {
+            'class': 'logging.StreamHandler',
+            'stream': 'ext://sys.stdout',
+            'formatter': 'plain',
+        },
+    },
+    'loggers': {
+        'dashboard.requests': {
+            'handlers': ['requests'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
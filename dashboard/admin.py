@@ -1,18 +1,40 @@
 # -*- coding: utf-8 -*-
 from django.contrib import admin, messages
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.utils import timezone
 from django.utils.html import format_html
 
+from .cache import bump_user_version
+from .exports import export_response, USER_COLUMN, TRANSACTION_COLUMNS, PROFIT_WALLET_COLUMNS, TOTAL_WALLET_COLUMNS
+from .mail import queue_email
 from .models import Wallet, Coin, ProfitWallet, WalletReplenishmentRequest, WalletWithdrawalRequest, Transaction, \
-    ExchangeRate, UserProfile, DayProfit, TotalWallet, OwnersWallet, CoinNetwork, UserCoinAddress, OwnerCoinAddress
-from .tasks import update_exchange_rates, calculate_total_balance, calc_user_percent_dep, calculate_user_profit
+    ExchangeRate, UserProfile, DayProfit, TotalWallet, OwnersWallet, CoinNetwork, UserCoinAddress, OwnerCoinAddress, \
+    ExchangeRateCandle, ProfitRun, ProfitRunShard, OutgoingEmail, TaskRun
+from .profit import preview_distribution
+from .tasks import update_exchange_rates, calculate_total_balance, calc_user_percent_dep, calculate_user_profit, \
+    send_queued_emails
+from .telemetry import task_run_charts
 
 admin.site.site_header = 'B4YI ADMIN-PANEL'
 
 
+# Потоковая выгрузка выбранных строк (с учетом фильтров списка) в CSV/JSON
+class ExportMixin:
+    export_columns = []
+    export_filename = 'export'
+
+    def export_csv(self, request, queryset):
+        return export_response(queryset, self.export_columns, 'csv', self.export_filename)
+
+    export_csv.short_description = 'Export selected to CSV'
+
+    def export_json(self, request, queryset):
+        return export_response(queryset, self.export_columns, 'json', self.export_filename)
+
+    export_json.short_description = 'Export selected to JSON'
+
+
 @admin.register(Wallet)
 class WalletAdmin(admin.ModelAdmin):
     list_display = ('user', 'coin', 'balance', 'percentage_of_total_balance', 'last_replenishment', 'last_withdrawal')
@@ -22,7 +44,11 @@ class WalletAdmin(admin.ModelAdmin):
     actions = ['calc_user_percent_dep']
 
     def calc_user_percent_dep(self, request, queryset):
-        calc_user_percent_dep()
+        try:
+            calc_user_percent_dep()
+        except Exception as e:
+            self.message_user(request, f'An error occurred: {e}', level=messages.ERROR)
+            return
         self.message_user(request, 'Update of user percentage of total balance success.')
 
     calc_user_percent_dep.short_description = 'Update percentage of total balance'
@@ -60,19 +86,77 @@ class ExchangeRateAdmin(admin.ModelAdmin):
     update_rates.short_description = 'Update rates'
 
 
+@admin.register(ExchangeRateCandle)
+class ExchangeRateCandleAdmin(admin.ModelAdmin):
+    list_display = ['coin', 'resolution', 'open_time', 'open', 'high', 'low', 'close']
+    list_filter = ['resolution', 'coin']
+    date_hierarchy = 'open_time'
+
+
+# Начисления профита только для просмотра: балансы кошельков и сводки ProfitRollup получены из этих строк,
+# ручное изменение разошлось бы с ними
 @admin.register(ProfitWallet)
-class ProfitWalletAdmin(admin.ModelAdmin):
+class ProfitWalletAdmin(ExportMixin, admin.ModelAdmin):
     list_display = ('user', 'coin', 'amount', 'date_created')
     list_filter = ('user', 'coin')
     search_fields = ('user__username',)
-    actions = ['calculate_user_profit_action']
+    date_hierarchy = 'date_created'
+    actions = ['calculate_user_profit_action', 'preview_user_profit_action', 'export_csv', 'export_json']
+    export_columns = [USER_COLUMN] + PROFIT_WALLET_COLUMNS
+    export_filename = 'profit'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
     def calculate_user_profit_action(self, request, queryset):
-        calculate_user_profit()
-        self.message_user(request, 'Calculation success')
+        try:
+            result = calculate_user_profit()
+        except DayProfit.DoesNotExist:
+            self.message_user(request, 'Bot day profit is not set.', level=messages.ERROR)
+            return
+        self.message_user(request, result)
 
     calculate_user_profit_action.short_description = 'Calculate user profit'
 
+    def preview_user_profit_action(self, request, queryset):
+        try:
+            previews = preview_distribution()
+        except DayProfit.DoesNotExist:
+            self.message_user(request, 'Bot day profit is not set.', level=messages.ERROR)
+            return
+
+        for preview in previews:
+            self.message_user(request, f"{preview['coin']}: {preview['wallets_count']} wallets, "
+                                       f"users profit {preview['users_profit']}, "
+                                       f"owners profit {preview['owners_profit']}, "
+                                       f"max user profit {preview['max_user_profit']} "
+                                       f"(calculated in {preview['elapsed_ms']:.1f} ms)")
+
+    preview_user_profit_action.short_description = 'Preview user profit distribution'
+
+
+class ProfitRunShardInline(admin.TabularInline):
+    model = ProfitRunShard
+    extra = 0
+    can_delete = False
+    readonly_fields = ['user_id_from', 'user_id_to', 'last_wallet_id', 'wallets_count', 'users_profit', 'is_completed']
+
+
+@admin.register(ProfitRun)
+class ProfitRunAdmin(admin.ModelAdmin):
+    list_display = ['day_profit', 'coin', 'status', 'wallets_count', 'users_profit', 'owners_profit', 'date_created',
+                    'date_finished']
+    list_filter = ['status', 'coin']
+    readonly_fields = ['day_profit', 'coin', 'status', 'wallets_count', 'users_profit', 'owners_profit', 'error',
+                       'date_created', 'date_finished']
+    inlines = [ProfitRunShardInline]
+
 
 # Запрос на пополнение
 @admin.register(WalletReplenishmentRequest)
@@ -116,16 +200,14 @@ class WalletReplenishmentRequestAdmin(admin.ModelAdmin):
                     wallet.last_replenishment = timezone.now()
                     wallet.save()
 
-                    send_mail(
+                    queue_email(
                         'Replenishment ',
                         '',
-                        '',
                         [replenishment_request.user.email],
-                        html_message=render_to_string('wallet/replenishment_email.html',
-                                                      {'user': replenishment_request.user,
-                                                       'amount': replenishment_request.amount,
-                                                       'coin': replenishment_request.coin}),
-                        fail_silently=False
+                        html_body=render_to_string('wallet/replenishment_email.html',
+                                                   {'user': replenishment_request.user,
+                                                    'amount': replenishment_request.amount,
+                                                    'coin': replenishment_request.coin}),
                     )
                     self.message_user(request, 'Баланс успешно пополнен', level=messages.SUCCESS)
                 else:
@@ -160,16 +242,14 @@ class WalletWithdrawalRequestAdmin(admin.ModelAdmin):
                         transaction.mark_completed()
 
                         withdrawal_request.mark_executed()
-                        send_mail(
+                        queue_email(
                             'Withdrawals',  # тема письма
                             '',  # текст письма из файла
-                            '',
                             [withdrawal_request.user.email],
-                            html_message=render_to_string('wallet/withdrawal_email.html',
-                                                          {'user': withdrawal_request.user,
-                                                           'amount': withdrawal_request.amount,
-                                                           'coin': withdrawal_request.coin}),
-                            fail_silently=False
+                            html_body=render_to_string('wallet/withdrawal_email.html',
+                                                       {'user': withdrawal_request.user,
+                                                        'amount': withdrawal_request.amount,
+                                                        'coin': withdrawal_request.coin}),
                         )
                         self.message_user(request, 'Средства успешно выведены.', level=messages.SUCCESS)
                     else:
@@ -184,23 +264,34 @@ class WalletWithdrawalRequestAdmin(admin.ModelAdmin):
 
 # Создание транзакции
 @admin.register(Transaction)
-class TransactionAdmin(admin.ModelAdmin):
-    list_display = ['id', 'user', 'date_created', 'transaction_type', 'coin', 'network', 'amount', 'txid', 'status']
-    list_filter = ['transaction_type', 'status']
-    search_fields = ['id']
+class TransactionAdmin(ExportMixin, admin.ModelAdmin):
+    list_display = ['code', 'user', 'date_created', 'transaction_type', 'coin', 'network', 'amount', 'txid', 'status']
+    list_filter = ['transaction_type', 'status', 'coin']
+    search_fields = ['code']
     ordering = ('-date_created',)
-    actions = ['mark_completed', 'mark_cancelled']
+    date_hierarchy = 'date_created'
+    actions = ['mark_completed', 'mark_cancelled', 'export_csv', 'export_json']
+    export_columns = TRANSACTION_COLUMNS[:1] + [USER_COLUMN] + TRANSACTION_COLUMNS[1:]
+    export_filename = 'transactions'
 
     def mark_completed(self, request, queryset):
         queryset.update(status='completed')
+        self.invalidate_users_cache(queryset)
 
     mark_completed.short_description = 'Mark selected transactions as completed'
 
     def mark_cancelled(self, request, queryset):
         queryset.update(status='cancelled')
+        self.invalidate_users_cache(queryset)
 
     mark_cancelled.short_description = 'Mark selected transactions as cancelled'
 
+    # update() не вызывает post_save, поэтому сбрасываем кэш пользователей вручную
+    @staticmethod
+    def invalidate_users_cache(queryset):
+        for user_id in queryset.order_by().values_list('user_id', flat=True).distinct():
+            bump_user_version(user_id)
+
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
@@ -223,10 +314,14 @@ class DayProfitAdmin(admin.ModelAdmin):
 
 
 @admin.register(TotalWallet)
-class TotalWalletAdmin(admin.ModelAdmin):
+class TotalWalletAdmin(ExportMixin, admin.ModelAdmin):
     list_display = (
         'coin', 'total_balance', 'total_balance_with_profit', 'relative_profit', 'users_profit', 'date_created')
-    actions = ['calculate_total_balance']
+    list_filter = ('coin',)
+    date_hierarchy = 'date_created'
+    actions = ['calculate_total_balance', 'export_csv', 'export_json']
+    export_columns = TOTAL_WALLET_COLUMNS
+    export_filename = 'total_wallet'
 
     def total_balance_with_profit(self, obj):
         bot_profit = DayProfit.objects.latest('date_created').profittrailer_pnl
@@ -249,3 +344,47 @@ class TotalWalletAdmin(admin.ModelAdmin):
 @admin.register(OwnersWallet)
 class OwnersWalletAdmin(admin.ModelAdmin):
     list_display = ['coin', 'balance', 'profit', 'percentage_of_total_balance', 'last_replenishment', 'last_withdrawal']
+
+
+@admin.register(OutgoingEmail)
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ['subject', 'recipients', 'status', 'attempts', 'next_attempt_at', 'date_created', 'date_sent']
+    list_filter = ['status']
+    search_fields = ['recipients', 'subject']
+    readonly_fields = ['attempts', 'last_error', 'date_created', 'date_sent']
+    actions = ['retry_emails']
+
+    def retry_emails(self, request, queryset):
+        # Письма в sending сейчас отправляет воркер, они вернутся в очередь сами
+        queryset.exclude(status__in=(OutgoingEmail.STATUS_SENT, OutgoingEmail.STATUS_SENDING)).update(
+            status=OutgoingEmail.STATUS_PENDING, attempts=0, next_attempt_at=timezone.now())
+        send_queued_emails.delay()
+        self.message_user(request, 'Selected emails are queued for sending.')
+
+    retry_emails.short_description = 'Retry sending selected emails'
+
+
+# Запуски задач только для просмотра; над списком - графики длительности по задачам с учетом фильтров
+@admin.register(TaskRun)
+class TaskRunAdmin(admin.ModelAdmin):
+    list_display = ['task_name', 'status', 'date_started', 'duration', 'rows_read', 'rows_written', 'queries',
+                    'peak_rss_kb']
+    list_filter = ['task_name', 'status']
+    search_fields = ['task_id']
+    date_hierarchy = 'date_started'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        response = super().changelist_view(request, extra_context)
+        context = getattr(response, 'context_data', None)
+        if context and 'cl' in context:
+            context['task_run_charts'] = task_run_charts(context['cl'].queryset)
+        return response
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .instrumentation import record_cache_access
+
+RATES_VERSION_KEY = 'dashboard:version:rates'
+PROFIT_VERSION_KEY = 'dashboard:version:profit'
+HITS_KEY = 'dashboard:cache:hits'
+MISSES_KEY = 'dashboard:cache:misses'
+
+DEFAULT_DASHBOARD_CACHE_TIMEOUT = 60 * 60
+
+
+def get_dashboard_cache_timeout():
+    return getattr(settings, 'DASHBOARD_CACHE_TIMEOUT', DEFAULT_DASHBOARD_CACHE_TIMEOUT)
+
+
+def user_version_key(user_id):
+    return f'dashboard:version:user:{user_id}'
+
+
+# Версия стартует с текущего времени, чтобы после вытеснения ключа не совпасть со старой
+def _initial_version():
+    return int(time.time() * 1000)
+
+
+def bump_version(key):
+    cache.add(key, _initial_version(), None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.set(key, _initial_version(), None)
+        return cache.get(key)
+
+
+def bump_user_version(user_id):
+    return bump_version(user_version_key(user_id))
+
+
+def bump_rates_version():
+    return bump_version(RATES_VERSION_KEY)
+
+
+def bump_profit_version():
+    return bump_version(PROFIT_VERSION_KEY)
+
+
+def _get_versions(keys):
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _initial_version(), None)
+            versions[key] = cache.get(key)
+    return tuple(versions[key] for key in keys)
+
+
+def get_rates_version():
+    return _get_versions([RATES_VERSION_KEY])[0]
+
+
+def dashboard_context_key(user_id):
+    versions = _get_versions([user_version_key(user_id), RATES_VERSION_KEY, PROFIT_VERSION_KEY])
+    return 'dashboard:context:{}:{}'.format(user_id, ':'.join(str(version) for version in versions))
+
+
+# Число строк пользователя (например, транзакций по фильтру); сбрасывается вместе с версией пользователя
+def get_user_count(user_id, name, count):
+    key = 'dashboard:count:{}:{}:{}'.format(user_id, _get_versions([user_version_key(user_id)])[0], name)
+    value = cache.get(key)
+    record_cache_access(value is not None)
+    if value is None:
+        value = count()
+        cache.set(key, value, get_dashboard_cache_timeout())
+    return value
+
+
+def _count(key):
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        pass
+
+
+# Контекст дашборда пользователя из кэша, при промахе собирается через build()
+def get_dashboard_context(user_id, build):
+    key = dashboard_context_key(user_id)
+    context = cache.get(key)
+    record_cache_access(context is not None)
+    if context is not None:
+        _count(HITS_KEY)
+        return context
+
+    _count(MISSES_KEY)
+    context = build()
+    cache.set(key, context, get_dashboard_cache_timeout())
+    return context
+
+
+def dashboard_cache_stats():
+    counters = cache.get_many([HITS_KEY, MISSES_KEY])
+    hits = counters.get(HITS_KEY, 0)
+    misses = counters.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / total, 4) if total else None,
+    }
@@ -24,4 +24,17 @@ app.conf.beat_schedule = {
         # 'schedule': crontab(hour=3, minute=0, timezone='UTC'),
         # 'schedule': crontab(minute=0, hour='*'),  # Запуск каждый час
     },
+    'prune_exchange_rate_history': {
+        'task': 'dashboard.tasks.prune_exchange_rate_history',
+        'schedule': timedelta(hours=1),
+    },
+    'prune_task_runs': {
+        'task': 'dashboard.tasks.prune_task_runs',
+        'schedule': timedelta(days=1),
+    },
+    # Повторные попытки отправки писем из очереди
+    'send_queued_emails': {
+        'task': 'dashboard.tasks.send_queued_emails',
+        'schedule': timedelta(minutes=1),
+    },
 }
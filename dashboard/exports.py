@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import json
+from datetime import datetime, time, timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+DEFAULT_EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+}
+
+# Колонки выгрузок: (заголовок, поле для values_list)
+TRANSACTION_COLUMNS = [
+    ('id', 'code'),
+    ('date_created', 'date_created'),
+    ('type', 'transaction_type'),
+    ('coin', 'coin__code'),
+    ('network', 'network__name'),
+    ('amount', 'amount'),
+    ('txid', 'txid'),
+    ('status', 'status'),
+]
+PROFIT_WALLET_COLUMNS = [
+    ('date_created', 'date_created'),
+    ('coin', 'coin__code'),
+    ('amount', 'amount'),
+]
+TOTAL_WALLET_COLUMNS = [
+    ('date_created', 'date_created'),
+    ('coin', 'coin__code'),
+    ('total_balance', 'total_balance'),
+    ('total_balance_with_profit', 'total_balance_with_profit'),
+    ('users_profit', 'users_profit'),
+    ('relative_profit', 'relative_profit'),
+]
+USER_COLUMN = ('user', 'user__username')
+
+
+def get_export_chunk_size():
+    return getattr(settings, 'EXPORT_CHUNK_SIZE', DEFAULT_EXPORT_CHUNK_SIZE)
+
+
+def parse_date_param(value):
+    if not value:
+        return None
+    date = parse_date(value)
+    if date is None:
+        raise ValueError(f'Invalid date: {value}')
+    return date
+
+
+def day_start(date):
+    return timezone.make_aware(datetime.combine(date, time.min))
+
+
+# Фильтры выгрузки: from/to (YYYY-MM-DD, включительно) и coin (id монеты)
+def filter_export(queryset, params):
+    date_from = parse_date_param(params.get('from'))
+    if date_from:
+        queryset = queryset.filter(date_created__gte=day_start(date_from))
+
+    date_to = parse_date_param(params.get('to'))
+    if date_to:
+        queryset = queryset.filter(date_created__lt=day_start(date_to + timedelta(days=1)))
+
+    coin = params.get('coin')
+    if coin:
+        if not coin.isdigit():
+            raise ValueError(f'Invalid coin: {coin}')
+        queryset = queryset.filter(coin_id=coin)
+    return queryset
+
+
+def _batches(rows, size):
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def stream_csv(headers, rows, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    for batch in _batches(rows, chunk_size):
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_json(headers, rows, chunk_size):
+    yield '['
+    separator = ''
+    for batch in _batches(rows, chunk_size):
+        yield separator + ','.join(json.dumps(dict(zip(headers, row)), cls=DjangoJSONEncoder) for row in batch)
+        separator = ','
+    yield ']'
+
+
+# Потоковая выгрузка: строки читаются курсором пачками по chunk_size, память не зависит от объема
+def export_response(queryset, columns, export_format, filename):
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown format: {export_format}')
+
+    chunk_size = get_export_chunk_size()
+    headers = [header for header, _ in columns]
+    rows = queryset.order_by('date_created', 'pk').values_list(*[path for _, path in columns]).iterator(
+        chunk_size=chunk_size)
+    stream = stream_json if export_format == 'json' else stream_csv
+
+    response = StreamingHttpResponse(stream(headers, rows, chunk_size), content_type=EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{export_format}"'
+    return response
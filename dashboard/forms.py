@@ -5,7 +5,7 @@ from crispy_forms.helper import FormHelper
 from django import forms
 from django.core.validators import RegexValidator
 
-from dashboard.models import WalletReplenishmentRequest, WalletWithdrawalRequest, UserProfile, Coin
+from dashboard.models import WalletReplenishmentRequest, WalletWithdrawalRequest, UserProfile, Coin, Transaction
 
 
 class UserLoginForm(LoginForm):
@@ -126,3 +126,21 @@ class UserProfileForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.fields['phone_number'].validators.append(self.phone_regex)
+
+
+# Фильтр истории транзакций кошелька
+class TransactionFilterForm(forms.Form):
+    coin = forms.ModelChoiceField(queryset=Coin.objects.filter(is_active=True), required=False, empty_label='All coins')
+    transaction_type = forms.ChoiceField(required=False, choices=[('', 'All types')] + list(
+        Transaction._meta.get_field('transaction_type').choices))
+    status = forms.ChoiceField(required=False, choices=[('', 'All statuses')] + list(
+        Transaction._meta.get_field('status').choices))
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for field in self.fields.values():
+            field.widget.attrs.update({'class': 'form-select form-select-sm'})
+
+    def filter(self, queryset):
+        filters = {name: value for name, value in self.cleaned_data.items() if value}
+        return queryset.filter(**filters)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Snowflake-идентификатор (64 бита): 41 бит миллисекунд от SNOWFLAKE_EPOCH_MS, 10 бит номера генератора,
+# 12 бит счетчика внутри миллисекунды. Значения растут со временем, вставки идут в конец индекса.
+SNOWFLAKE_EPOCH_MS = 1672531200000  # 2023-01-01 00:00 UTC
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# Номер генератора 1023 зарезервирован за миграцией 0039 (перенос старых транзакций)
+MIGRATION_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+
+WORKER_ID_KEY = 'dashboard:snowflake:worker_id'
+
+TRANSACTION_CODE_PREFIX = '#B4Y#'
+CODE_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+def make_snowflake_id(timestamp_ms, worker_id, sequence):
+    if timestamp_ms < SNOWFLAKE_EPOCH_MS:
+        raise ValueError(f'Snowflake timestamp {timestamp_ms} is before SNOWFLAKE_EPOCH_MS')
+    return ((timestamp_ms - SNOWFLAKE_EPOCH_MS) << (WORKER_ID_BITS + SEQUENCE_BITS)) | (worker_id << SEQUENCE_BITS) | \
+        sequence
+
+
+def snowflake_timestamp_ms(snowflake_id):
+    return (snowflake_id >> (WORKER_ID_BITS + SEQUENCE_BITS)) + SNOWFLAKE_EPOCH_MS
+
+
+# Номер генератора процесса: SNOWFLAKE_WORKER_ID из настроек (0-1022, только если процесс с id один)
+# или следующий номер из общего счетчика в Redis (INCR атомарен для всех процессов на всех серверах).
+# pid не подходит: в контейнерах у gunicorn и celery одни и те же pid на каждом хосте
+def get_worker_id():
+    worker_id = getattr(settings, 'SNOWFLAKE_WORKER_ID', None)
+    if worker_id is None:
+        worker_id = allocate_worker_id()
+    if not 0 <= worker_id < MIGRATION_WORKER_ID:
+        raise ValueError(f'SNOWFLAKE_WORKER_ID must be in [0, {MIGRATION_WORKER_ID})')
+    return worker_id
+
+
+# Номера выдаются по кругу: совпадение возможно, только если процесс живет, пока стартуют еще 1022 других
+def allocate_worker_id():
+    cache.add(WORKER_ID_KEY, 0, None)
+    return (cache.incr(WORKER_ID_KEY) - 1) % MIGRATION_WORKER_ID
+
+
+class SnowflakeGenerator:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.lock = threading.Lock()
+        self.last_ms = -1
+        self.sequence = 0
+
+    def next_id(self):
+        with self.lock:
+            # При переводе часов назад продолжаем с последней выданной миллисекунды
+            now_ms = max(int(time.time() * 1000), self.last_ms)
+            if now_ms == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    while now_ms <= self.last_ms:
+                        now_ms = int(time.time() * 1000)
+            else:
+                self.sequence = 0
+
+            self.last_ms = now_ms
+            return make_snowflake_id(now_ms, self.worker_id, self.sequence)
+
+
+_generator = None
+_generator_pid = None
+
+
+# Генератор создается заново после fork, чтобы дочерние процессы не выдавали одинаковые id
+def next_snowflake_id():
+    global _generator, _generator_pid
+
+    pid = os.getpid()
+    if _generator is None or _generator_pid != pid:
+        _generator = SnowflakeGenerator(get_worker_id())
+        _generator_pid = pid
+    return _generator.next_id()
+
+
+# Человекочитаемый код транзакции: префикс + id в base36
+def transaction_code(transaction_id):
+    if transaction_id < 0:
+        raise ValueError(f'Transaction id {transaction_id} is negative')
+    digits = []
+    while transaction_id:
+        transaction_id, remainder = divmod(transaction_id, len(CODE_ALPHABET))
+        digits.append(CODE_ALPHABET[remainder])
+    return TRANSACTION_CODE_PREFIX + (''.join(reversed(digits)) or '0')
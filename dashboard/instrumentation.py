@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from contextvars import ContextVar
+from time import perf_counter
+
+from django.template.backends.django import DjangoTemplates
+
+
+# Метрики текущего запроса; заполняются middleware, шаблонами и кэшем dashboard
+class RequestMetrics:
+    __slots__ = ('sql_count', 'sql_time', 'template_time', 'cache_hits', 'cache_misses')
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    # Обертка для connection.execute_wrapper
+    def __call__(self, execute, sql, params, many, context):
+        started = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_count += 1
+            self.sql_time += perf_counter() - started
+
+
+current_metrics = ContextVar('request_metrics', default=None)
+
+
+def record_cache_access(hit):
+    metrics = current_metrics.get()
+    if metrics is not None:
+        if hit:
+            metrics.cache_hits += 1
+        else:
+            metrics.cache_misses += 1
+
+
+class InstrumentedTemplate:
+    def __init__(self, template):
+        self.template = template
+
+    @property
+    def origin(self):
+        return self.template.origin
+
+    def render(self, context=None, request=None):
+        started = perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            metrics = current_metrics.get()
+            if metrics is not None:
+                metrics.template_time += perf_counter() - started
+
+
+# Бэкенд шаблонов Django с замером времени рендеринга; include/extends внутри шаблона
+# входят во время шаблона верхнего уровня и отдельно не считаются
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    def from_string(self, template_code):
+        return InstrumentedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return InstrumentedTemplate(super().get_template(template_name))
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from datetime import timedelta
+from itertools import groupby
+
+from celery import current_app
+from django.conf import settings
+from django.core.mail import EmailMessage, EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import Sum
+from django.template.loader import get_template
+from django.utils import timezone
+
+from .models import OutgoingEmail, DayProfit, ProfitWallet, ProfitDigest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMAIL_OUTBOX_BATCH_SIZE = 50
+DEFAULT_EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+DEFAULT_EMAIL_OUTBOX_LEASE = timedelta(minutes=10)
+RETRY_BASE_DELAY = timedelta(minutes=1)
+
+DEFAULT_PROFIT_DIGEST_CHUNK_SIZE = 1000
+PROFIT_DIGEST_TEMPLATE = 'wallet/profit_digest_email.html'
+
+
+def get_outbox_batch_size():
+    return getattr(settings, 'EMAIL_OUTBOX_BATCH_SIZE', DEFAULT_EMAIL_OUTBOX_BATCH_SIZE)
+
+
+def get_outbox_max_attempts():
+    return getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', DEFAULT_EMAIL_OUTBOX_MAX_ATTEMPTS)
+
+
+# Срок, на который воркер захватывает пачку писем
+def get_outbox_lease():
+    return getattr(settings, 'EMAIL_OUTBOX_LEASE', DEFAULT_EMAIL_OUTBOX_LEASE)
+
+
+def get_profit_digest_chunk_size():
+    return getattr(settings, 'PROFIT_DIGEST_CHUNK_SIZE', DEFAULT_PROFIT_DIGEST_CHUNK_SIZE)
+
+
+# Ограничение скорости рассылки, писем в секунду (None - без ограничения)
+def get_profit_digest_rate_limit():
+    return getattr(settings, 'PROFIT_DIGEST_RATE_LIMIT', None)
+
+
+# Постановка письма в очередь; отправка запускается после коммита текущей транзакции
+def queue_email(subject, body, recipients, html_body='', from_email=''):
+    recipients = [recipient for recipient in recipients if recipient]
+    if not recipients:
+        return None
+
+    email = OutgoingEmail.objects.create(subject=subject, body=body, html_body=html_body, from_email=from_email,
+                                         recipients=','.join(recipients))
+    transaction.on_commit(lambda: current_app.signature('dashboard.tasks.send_queued_emails').delay())
+    return email
+
+
+# Аналог mail_admins через очередь
+def queue_mail_admins(subject, message, html_message=''):
+    return queue_email(settings.EMAIL_SUBJECT_PREFIX + subject, message, [email for _, email in settings.ADMINS],
+                       html_body=html_message, from_email=settings.SERVER_EMAIL)
+
+
+def _build_message(email, connection):
+    message = EmailMultiAlternatives(email.subject, email.body, email.from_email or None,
+                                     email.recipients.split(','), connection=connection)
+    if email.html_body:
+        message.attach_alternative(email.html_body, 'text/html')
+    return message
+
+
+# Попытка уже учтена при захвате письма
+def _mark_failed(email, error, now):
+    email.last_error = str(error)
+    if email.attempts >= get_outbox_max_attempts():
+        email.status = OutgoingEmail.STATUS_FAILED
+    else:
+        email.status = OutgoingEmail.STATUS_PENDING
+        email.next_attempt_at = now + RETRY_BASE_DELAY * 2 ** (email.attempts - 1)
+
+
+# Захват пачки в короткой транзакции: письма переводятся в sending, next_attempt_at становится сроком захвата.
+# Письма в sending с истекшим сроком (воркер упал во время отправки) захватываются снова
+def claim_email_batch(batch_size, now):
+    with transaction.atomic():
+        emails = list(OutgoingEmail.objects.select_for_update(skip_locked=True).filter(
+            status__in=(OutgoingEmail.STATUS_PENDING, OutgoingEmail.STATUS_SENDING), next_attempt_at__lte=now
+        ).order_by('next_attempt_at', 'pk')[:batch_size])
+        for email in emails:
+            email.status = OutgoingEmail.STATUS_SENDING
+            email.attempts += 1
+            email.next_attempt_at = now + get_outbox_lease()
+        OutgoingEmail.objects.bulk_update(emails, ['status', 'attempts', 'next_attempt_at'])
+    return emails
+
+
+# Отправка одной пачки готовых к отправке писем через одно SMTP-соединение. SMTP вызывается вне транзакции,
+# результаты записываются второй короткой транзакцией
+def deliver_email_batch(batch_size=None):
+    batch_size = batch_size or get_outbox_batch_size()
+    now = timezone.now()
+
+    emails = claim_email_batch(batch_size, now)
+    if not emails:
+        return {'sent': 0, 'failed': 0}
+
+    sent = failed = 0
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        logger.warning('SMTP connection failed: %s', e)
+        for email in emails:
+            _mark_failed(email, e, now)
+        failed = len(emails)
+    else:
+        try:
+            for email in emails:
+                try:
+                    _build_message(email, connection).send()
+                except Exception as e:
+                    logger.warning('Failed to send email #%s: %s', email.pk, e)
+                    _mark_failed(email, e, now)
+                    failed += 1
+                else:
+                    email.status = OutgoingEmail.STATUS_SENT
+                    email.date_sent = timezone.now()
+                    sent += 1
+        finally:
+            connection.close()
+
+    with transaction.atomic():
+        OutgoingEmail.objects.bulk_update(emails, ['status', 'last_error', 'next_attempt_at', 'date_sent'])
+
+    return {'sent': sent, 'failed': failed}
+
+
+# Следующая пачка получателей дайджеста после after_user_id: [(user_id, username, email, [(coin, amount)])]
+def next_digest_chunk(day_profit_id, after_user_id, chunk_size):
+    profits = ProfitWallet.objects.filter(profit_run__day_profit_id=day_profit_id)
+    user_ids = list(profits.filter(user_id__gt=after_user_id).order_by('user_id').values_list(
+        'user_id', flat=True).distinct()[:chunk_size])
+    if not user_ids:
+        return None, []
+
+    notified = set(ProfitDigest.objects.filter(day_profit_id=day_profit_id, user_id__in=user_ids).values_list(
+        'user_id', flat=True))
+    rows = profits.filter(user_id__in=[user_id for user_id in user_ids if user_id not in notified]).values(
+        'user_id', 'user__username', 'user__email', 'coin__code'
+    ).annotate(amount=Sum('amount')).order_by('user_id', 'coin__code')
+
+    recipients = []
+    for user_id, user_rows in groupby(rows, key=lambda row: row['user_id']):
+        user_rows = list(user_rows)
+        recipients.append((user_id, user_rows[0]['user__username'], user_rows[0]['user__email'],
+                           [(row['coin__code'], row['amount']) for row in user_rows]))
+    return user_ids[-1], recipients
+
+
+# Рассылка итогов дня профита: шаблон компилируется один раз, пользователи идут пачками,
+# все письма уходят через одно SMTP-соединение; отправленные отмечаются в ProfitDigest
+def deliver_profit_digest(day_profit_id, chunk_size=None, rate_limit=None):
+    day_profit = DayProfit.objects.get(pk=day_profit_id)
+    chunk_size = chunk_size or get_profit_digest_chunk_size()
+    rate_limit = rate_limit or get_profit_digest_rate_limit()
+    template = get_template(PROFIT_DIGEST_TEMPLATE)
+    subject = settings.EMAIL_SUBJECT_PREFIX + 'Profit for {:%d.%m.%Y}'.format(day_profit.date_created)
+
+    sent = 0
+    started = time.monotonic()
+    after_user_id = 0
+    connection = get_connection()
+    connection.open()
+    try:
+        while True:
+            after_user_id, recipients = next_digest_chunk(day_profit_id, after_user_id, chunk_size)
+            if after_user_id is None:
+                break
+
+            # Пачка уходит одним send_messages; при ограничении скорости - частями по rate_limit писем.
+            # Получатели отмечаются после успешной отправки своей части
+            step = max(1, int(rate_limit) if rate_limit else len(recipients))
+            for start in range(0, len(recipients), step):
+                group = recipients[start:start + step]
+                messages = []
+                for user_id, username, email, profits in group:
+                    if email:
+                        html = template.render({'username': username, 'date': day_profit.date_created,
+                                                'profits': profits})
+                        message = EmailMessage(subject, html, None, [email], connection=connection)
+                        message.content_subtype = 'html'
+                        messages.append(message)
+
+                if messages:
+                    connection.send_messages(messages)
+                    sent += len(messages)
+                ProfitDigest.objects.bulk_create([
+                    ProfitDigest(day_profit_id=day_profit_id, user_id=user_id) for user_id, _, _, _ in group
+                ], ignore_conflicts=True)
+
+                if rate_limit:
+                    delay = sent / rate_limit - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+    finally:
+        connection.close()
+
+    logger.info('Profit digest #%s: %d emails in %.1f s', day_profit_id, sent, time.monotonic() - started)
+    return sent
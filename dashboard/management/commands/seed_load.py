@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+import io
+from datetime import datetime, time, timedelta
+from functools import lru_cache
+from time import monotonic
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections, models, transaction
+from django.utils import timezone
+
+from dashboard.cache import bump_profit_version, bump_rates_version
+from dashboard.ids import MAX_SEQUENCE, SEQUENCE_BITS, SNOWFLAKE_EPOCH_MS, WORKER_ID_BITS, get_worker_id, \
+    transaction_code
+from dashboard.models import Coin, CoinNetwork, DayProfit, ExchangeRate, OwnersWallet, ProfitRollup, ProfitRun, \
+    ProfitWallet, TotalWallet, Transaction, UserProfile, Wallet, WalletReplenishmentRequest, WalletWithdrawalRequest
+from dashboard.profit import USERS_PROFIT_SHARE
+
+# Монеты по умолчанию, если в базе нет активных: (название, код, сеть, код сети, курс в USDT)
+DEFAULT_COINS = [
+    ('Bitcoin', 'BTC', 'Bitcoin', 'BTC', 30000),
+    ('Ethereum', 'ETH', 'ERC20', 'ERC20', 2000),
+    ('Tron', 'TRX', 'TRC20', 'TRC20', 0.1),
+]
+FIRST_NAMES = ['Alex', 'Maria', 'Ivan', 'Olga', 'John', 'Anna', 'Petr', 'Elena', 'Max', 'Sofia']
+LAST_NAMES = ['Smith', 'Ivanov', 'Petrenko', 'Brown', 'Kovalenko', 'Miller', 'Shevchenko', 'Wilson']
+
+# Время начисления профита внутри дня истории
+PROFIT_TIME = time(23, 0)
+# Заявки моложе этого срока остаются в ожидании
+PENDING_WINDOW = timedelta(days=3)
+COPY_NULL = r'\N'
+
+
+# Максимум DecimalField (max_digits, decimal_places): значения за пределами поля обрезаются
+def decimal_limit(model, field_name):
+    field = model._meta.get_field(field_name)
+    return 10 ** (field.max_digits - field.decimal_places) - 10 ** -field.decimal_places
+
+
+# Запись строк пачками: COPY в PostgreSQL, INSERT ... VALUES пачкой в остальных СУБД.
+# Save() и bulk_create не используются: auto_now_add перезаписал бы исторические даты.
+# Значения - числа, строки, bool и даты; адаптируются под СУБД только даты
+class RowWriter:
+    def __init__(self, model, fields, batch_size):
+        self.connection = connections[DEFAULT_DB_ALIAS]
+        ops = self.connection.ops
+        opts = model._meta
+        fields = [opts.get_field(name) for name in fields]
+        self.table = ops.quote_name(opts.db_table)
+        self.columns = ', '.join(ops.quote_name(field.column) for field in fields)
+        self.placeholders = ', '.join(['%s'] * len(fields))
+        # Даты в пачке в основном повторяются (время начисления дня), адаптация кэшируется
+        self.adapters = [
+            lru_cache(maxsize=4096)(ops.adapt_datetimefield_value) if isinstance(field, models.DateTimeField) else
+            lru_cache(maxsize=4096)(ops.adapt_datefield_value) if isinstance(field, models.DateField) else None
+            for field in fields
+        ]
+        self.batch_size = batch_size
+        self.use_copy = self.connection.vendor == 'postgresql'
+        self.rows = []
+        self.count = 0
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        if not self.rows:
+            return
+        with self.connection.cursor() as cursor:
+            if self.use_copy:
+                self.copy(cursor)
+            else:
+                cursor.executemany(f'INSERT INTO {self.table} ({self.columns}) VALUES ({self.placeholders})',
+                                   [self.adapt(row) for row in self.rows])
+        self.count += len(self.rows)
+        self.rows = []
+
+    def adapt(self, row):
+        return [value if adapter is None or value is None else adapter(value)
+                for adapter, value in zip(self.adapters, row)]
+
+    def copy(self, cursor):
+        buffer = io.StringIO()
+        for row in self.rows:
+            buffer.write('\t'.join(COPY_NULL if value is None else str(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        sql = f'COPY {self.table} ({self.columns}) FROM STDIN'
+        raw_cursor = cursor.cursor
+        if hasattr(raw_cursor, 'copy_expert'):  # psycopg2
+            raw_cursor.copy_expert(sql, buffer)
+        else:  # psycopg 3
+            with raw_cursor.copy(sql) as copy:
+                copy.write(buffer.getvalue())
+
+
+# Snowflake id по времени заявки, как в миграции 0039: время до SNOWFLAKE_EPOCH_MS прижимается к нему,
+# номер внутри миллисекунды - порядок среди заявок с той же миллисекундой, при переполнении счетчика
+# id переходит на следующую миллисекунду; порядок id совпадает с порядком дат
+def snowflake_ids(timestamps_ms, worker_id):
+    order = np.argsort(timestamps_ms, kind='stable')
+    sorted_ms = np.maximum(timestamps_ms[order], SNOWFLAKE_EPOCH_MS)
+    positions = np.arange(len(sorted_ms))
+    group_starts = np.maximum.accumulate(np.where(np.r_[True, sorted_ms[1:] != sorted_ms[:-1]], positions, 0))
+    sequences = positions - group_starts
+    if len(sequences) and sequences.max() > MAX_SEQUENCE:
+        # Слот (миллисекунда, номер) каждой заявки - не раньше ее времени и следующий за слотом предыдущей
+        slots = positions + np.maximum.accumulate((sorted_ms << SEQUENCE_BITS) - positions)
+        sorted_ms, sequences = slots >> SEQUENCE_BITS, slots & MAX_SEQUENCE
+    ids = np.empty(len(sorted_ms), dtype=np.int64)
+    ids[order] = ((sorted_ms - SNOWFLAKE_EPOCH_MS) << (WORKER_ID_BITS + SEQUENCE_BITS)) | \
+        (worker_id << SEQUENCE_BITS) | sequences
+    return ids
+
+
+# Создание небольшого числа строк с получением id (MySQL не возвращает id из bulk_create)
+def create_with_ids(model, objects):
+    if connection.features.can_return_rows_from_bulk_insert:
+        return model.objects.bulk_create(objects)
+    for obj in objects:
+        obj.save(force_insert=True)
+    return objects
+
+
+class Command(BaseCommand):
+    help = 'Generates production-shaped load test data: users, wallets, profit history, requests and transactions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Number of users')
+        parser.add_argument('--days', type=int, default=365,
+                            help='Days of DayProfit/TotalWallet/OwnersWallet history')
+        parser.add_argument('--profit-days', type=int, default=None,
+                            help='Days of per-user ProfitWallet/ProfitRollup history (default: --days)')
+        parser.add_argument('--wallet-share', type=float, default=0.7,
+                            help='Probability that a user has a wallet in each coin (at least one wallet per user)')
+        parser.add_argument('--balance-mu', type=float, default=4.0, help='Wallet balance lognormal mu')
+        parser.add_argument('--balance-sigma', type=float, default=1.5, help='Wallet balance lognormal sigma')
+        parser.add_argument('--owners-share', type=float, default=0.1,
+                            help='Owners balance as a share of users balance per coin')
+        parser.add_argument('--pnl-mean', type=float, default=500, help='Mean daily bot profit')
+        parser.add_argument('--pnl-sd', type=float, default=400, help='Standard deviation of daily bot profit')
+        parser.add_argument('--requests-per-user', type=float, default=4,
+                            help='Mean number of deposit/withdrawal requests per user (Poisson)')
+        parser.add_argument('--withdrawal-share', type=float, default=0.35, help='Share of withdrawal requests')
+        parser.add_argument('--pending-share', type=float, default=0.05, help='Share of pending requests')
+        parser.add_argument('--amount-mu', type=float, default=3.5, help='Request amount lognormal mu')
+        parser.add_argument('--amount-sigma', type=float, default=1.2, help='Request amount lognormal sigma')
+        parser.add_argument('--prefix', default='load', help='Username prefix of generated users')
+        parser.add_argument('--password', default='load-test', help='Password of generated users')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Rows per COPY/INSERT batch')
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['days'] < 1:
+            raise CommandError('--users and --days must be positive')
+        if User.objects.filter(username__startswith=options['prefix']).exists():
+            raise CommandError(f'Users with prefix "{options["prefix"]}" already exist, use another --prefix')
+
+        self.options = options
+        self.rng = np.random.default_rng(options['seed'])
+        self.now = timezone.now()
+        self.counts = {}
+        started = monotonic()
+
+        with transaction.atomic():
+            coins, networks = self.get_coins()
+            user_ids = self.seed_users()
+            wallets = self.seed_wallets(user_ids, coins)
+            self.seed_history(user_ids, coins, wallets)
+            self.seed_requests(user_ids, coins, networks, wallets)
+            transaction.on_commit(bump_rates_version)
+            transaction.on_commit(bump_profit_version)
+
+        elapsed = monotonic() - started
+        for name, count in self.counts.items():
+            self.stdout.write(f'{name}: {count}')
+        total = sum(self.counts.values())
+        self.stdout.write(self.style.SUCCESS(f'{total} rows in {elapsed:.1f} s ({total / elapsed:.0f} rows/s)'))
+
+    def writer(self, model, fields):
+        return RowWriter(model, fields, self.options['batch_size'])
+
+    def done(self, writer, name):
+        writer.flush()
+        self.counts[name] = self.counts.get(name, 0) + writer.count
+
+    def day_moment(self, date):
+        return timezone.make_aware(datetime.combine(date, PROFIT_TIME))
+
+    # Активные монеты с первой сетью; если монет нет, создаются DEFAULT_COINS. Курс создается при отсутствии
+    def get_coins(self):
+        coins = list(Coin.objects.filter(is_active=True).exclude(code='USDT').order_by('pk'))
+        if not coins:
+            for name, code, network_name, network_code, rate in DEFAULT_COINS:
+                coin = Coin.objects.create(name=name, code=code, is_active=True,
+                                           coin_image=f'coin_images/{code.lower()}.png')
+                CoinNetwork.objects.create(coin=coin, name=network_name, code=network_code)
+                ExchangeRate.objects.create(coin=coin, rate=rate)
+                coins.append(coin)
+
+        networks = []
+        for coin in coins:
+            network = CoinNetwork.objects.filter(coin=coin).order_by('pk').first()
+            if network is None:
+                network = CoinNetwork.objects.create(coin=coin, name=coin.code, code=coin.code)
+            networks.append(network.pk)
+            if not ExchangeRate.objects.filter(coin=coin).exists():
+                ExchangeRate.objects.create(coin=coin, rate=1)
+        return np.array([coin.pk for coin in coins]), np.array(networks)
+
+    def seed_users(self):
+        users_count = self.options['users']
+        prefix = self.options['prefix']
+        password = make_password(self.options['password'])
+        joined_seconds = self.rng.integers(0, self.options['days'] * 86400, users_count).tolist()
+
+        users = self.writer(User, ['username', 'email', 'password', 'first_name', 'last_name', 'is_staff',
+                                   'is_active', 'is_superuser', 'date_joined'])
+        users.write_many(
+            (f'{prefix}{i}', f'{prefix}{i}@example.com', password, '', '', False, True, False,
+             self.now - timedelta(seconds=seconds))
+            for i, seconds in enumerate(joined_seconds)
+        )
+        self.done(users, 'User')
+        user_ids = np.fromiter(User.objects.filter(username__startswith=prefix).order_by('pk').values_list(
+            'pk', flat=True).iterator(), dtype=np.int64)
+
+        first_names = self.rng.integers(0, len(FIRST_NAMES), users_count).tolist()
+        last_names = self.rng.integers(0, len(LAST_NAMES), users_count).tolist()
+        profiles = self.writer(UserProfile, ['user_id', 'first_name', 'last_name', 'phone_number', 'avatar'])
+        profiles.write_many(
+            (user_id, FIRST_NAMES[first], LAST_NAMES[last], '', None)
+            for user_id, first, last in zip(user_ids.tolist(), first_names, last_names)
+        )
+        self.done(profiles, 'UserProfile')
+        return user_ids
+
+    # Кошельки: каждая монета с вероятностью wallet_share, балансы логнормальные, доли от общего баланса монеты
+    def seed_wallets(self, user_ids, coins):
+        has_wallet = self.rng.random((len(user_ids), len(coins))) < self.options['wallet_share']
+        without_wallets = ~has_wallet.any(axis=1)
+        has_wallet[without_wallets, self.rng.integers(0, len(coins), without_wallets.sum())] = True
+        user_index, coin_index = np.nonzero(has_wallet)
+
+        balances = np.minimum(np.round(self.rng.lognormal(self.options['balance_mu'], self.options['balance_sigma'],
+                                                          len(user_index)), 2), decimal_limit(Wallet, 'balance'))
+        users_balance = np.bincount(coin_index, weights=balances, minlength=len(coins))
+        owners_balance = np.round(users_balance * self.options['owners_share'], 4)
+        total_balance = users_balance + owners_balance
+        percentages = np.round(balances / total_balance[coin_index] * 100, 4)
+
+        wallets = self.writer(Wallet, ['user_id', 'coin_id', 'balance', 'percentage_of_total_balance',
+                                       'last_replenishment', 'last_withdrawal', 'last_updated'])
+        wallets.write_many(
+            (user_id, coin_id, balance, percentage, None, None, self.now)
+            for user_id, coin_id, balance, percentage in zip(user_ids[user_index].tolist(),
+                                                             coins[coin_index].tolist(), balances.tolist(),
+                                                             percentages.tolist())
+        )
+        self.done(wallets, 'Wallet')
+
+        return {
+            'user_index': user_index,
+            'coin_index': coin_index,
+            'percentages': percentages,
+            'users_balance': users_balance,
+            'owners_balance': owners_balance,
+            'starts': np.searchsorted(user_index, np.arange(len(user_ids))),
+            'counts': np.bincount(user_index, minlength=len(user_ids)),
+        }
+
+    # История по дням: DayProfit, запуски распределения, общий портфель и кошельки владельцев по монетам,
+    # за последние profit_days дней - профит каждого кошелька и сводки пользователей
+    def seed_history(self, user_ids, coins, wallets):
+        days = self.options['days']
+        profit_days = min(self.options['profit_days'] or days, days)
+        today = timezone.localdate(self.now)
+        dates = [today - timedelta(days=days - day) for day in range(days)]
+        moments = [self.day_moment(date) for date in dates]
+        pnl_limit = decimal_limit(DayProfit, 'profittrailer_pnl')
+        pnls = np.clip(np.round(self.rng.normal(self.options['pnl_mean'], self.options['pnl_sd'], days), 4),
+                       -pnl_limit, pnl_limit)
+        users_share = float(USERS_PROFIT_SHARE)
+
+        day_profits = create_with_ids(DayProfit, [
+            DayProfit(profittrailer_pnl=round(pnl, 4), binance_pnl=round(pnl, 4), date_created=moment)
+            for pnl, moment in zip(pnls.tolist(), moments)
+        ])
+        self.counts['DayProfit'] = len(day_profits)
+
+        coin_wallets = np.bincount(wallets['coin_index'], minlength=len(coins)).tolist()
+        profit_runs = create_with_ids(ProfitRun, [
+            ProfitRun(day_profit=day_profit, coin_id=coin_id, status='completed', wallets_count=coin_wallets[index],
+                      users_profit=round(pnl * users_share, 4), owners_profit=round(pnl * (1 - users_share), 4),
+                      date_created=moment, date_finished=moment + timedelta(minutes=5))
+            for day_profit, pnl, moment in zip(day_profits, pnls.tolist(), moments)
+            for index, coin_id in enumerate(coins.tolist())
+        ])
+        self.counts['ProfitRun'] = len(profit_runs)
+        run_ids = np.array([profit_run.pk for profit_run in profit_runs]).reshape(days, len(coins))
+
+        total_limit = decimal_limit(TotalWallet, 'total_balance')
+        total_balance = np.minimum(wallets['users_balance'] + wallets['owners_balance'], total_limit)
+        total_wallets = self.writer(TotalWallet, ['coin_id', 'total_balance', 'total_balance_with_profit',
+                                                  'users_profit', 'relative_profit', 'date_created'])
+        owners_wallets = self.writer(OwnersWallet, ['coin_id', 'balance', 'profit', 'percentage_of_total_balance',
+                                                    'last_replenishment', 'last_withdrawal'])
+        owners_limit = decimal_limit(OwnersWallet, 'balance')
+        owners_balance = wallets['owners_balance'].copy()
+        for pnl, moment in zip(pnls.tolist(), moments):
+            with_profit = np.minimum(total_balance + pnl, total_limit)
+            owners_balance = np.clip(owners_balance + pnl * (1 - users_share), 0, owners_limit)
+            for index, coin_id in enumerate(coins.tolist()):
+                total_wallets.write((coin_id, round(total_balance[index], 4), round(with_profit[index], 4),
+                                     round(pnl * users_share, 4),
+                                     round(pnl / with_profit[index] * 100, 4) if with_profit[index] else 0, moment))
+                owners_wallets.write((coin_id, round(owners_balance[index], 4), round(pnl * (1 - users_share), 4),
+                                      round(owners_balance[index] / total_balance[index] * 100, 4)
+                                      if total_balance[index] else 0, moment, None))
+        self.done(total_wallets, 'TotalWallet')
+        self.done(owners_wallets, 'OwnersWallet')
+
+        self.seed_profits(user_ids, coins, wallets, dates[-profit_days:], moments[-profit_days:],
+                          pnls[-profit_days:], run_ids[-profit_days:])
+
+    def seed_profits(self, user_ids, coins, wallets, dates, moments, pnls, run_ids):
+        users_share = float(USERS_PROFIT_SHARE)
+        wallet_users = user_ids[wallets['user_index']].tolist()
+        wallet_coins = coins[wallets['coin_index']].tolist()
+        user_ids_list = user_ids.tolist()
+
+        profits = self.writer(ProfitWallet, ['user_id', 'coin_id', 'amount', 'date_created', 'profit_run_id'])
+        rollups = self.writer(ProfitRollup, ['user_id', 'period', 'period_start', 'amount'])
+        month_start = None
+        month_total = total = np.zeros(len(user_ids))
+        for date, moment, pnl, day_run_ids in zip(dates, moments, pnls.tolist(), run_ids):
+            amounts = np.round(wallets['percentages'] * (pnl * users_share / 100), 4)
+            profits.write_many(zip(wallet_users, wallet_coins, amounts.tolist(), [moment] * len(amounts),
+                                   day_run_ids[wallets['coin_index']].tolist()))
+
+            day_total = np.bincount(wallets['user_index'], weights=amounts, minlength=len(user_ids))
+            rollups.write_many((user_id, ProfitRollup.PERIOD_DAY, date, amount)
+                               for user_id, amount in zip(user_ids_list, np.round(day_total, 4).tolist()))
+
+            if month_start is not None and date.replace(day=1) != month_start:
+                self.write_rollups(rollups, user_ids_list, ProfitRollup.PERIOD_MONTH, month_start, month_total)
+                month_total = np.zeros(len(user_ids))
+            month_start = date.replace(day=1)
+            month_total = month_total + day_total
+            total = total + day_total
+
+        if month_start is not None:
+            self.write_rollups(rollups, user_ids_list, ProfitRollup.PERIOD_MONTH, month_start, month_total)
+        self.write_rollups(rollups, user_ids_list, ProfitRollup.PERIOD_TOTAL, ProfitRollup.TOTAL_PERIOD_START, total)
+        self.done(profits, 'ProfitWallet')
+        self.done(rollups, 'ProfitRollup')
+
+    @staticmethod
+    def write_rollups(rollups, user_ids, period, period_start, amounts):
+        rollups.write_many((user_id, period, period_start, amount)
+                           for user_id, amount in zip(user_ids, np.round(amounts, 4).tolist()))
+
+    # Заявки на пополнение и вывод (Пуассон на пользователя) по монетам его кошельков; ожидающие - последние
+    # PENDING_WINDOW, исполненные - по всей истории. К каждой заявке - транзакция с id от даты заявки
+    def seed_requests(self, user_ids, coins, networks, wallets):
+        rng = self.rng
+        requests_count = rng.poisson(self.options['requests_per_user'], len(user_ids))
+        user_index = np.repeat(np.arange(len(user_ids)), requests_count)
+        size = len(user_index)
+        if not size:
+            return
+
+        wallet_index = wallets['starts'][user_index] + (rng.random(size) * wallets['counts'][user_index]).astype(
+            np.int64)
+        coin_index = wallets['coin_index'][wallet_index]
+        is_withdrawal = rng.random(size) < self.options['withdrawal_share']
+        is_pending = rng.random(size) < self.options['pending_share']
+
+        pending_seconds = int(PENDING_WINDOW.total_seconds())
+        history_seconds = max(self.options['days'] * 86400, pending_seconds + 1)
+        seconds_ago = np.where(is_pending, rng.integers(0, pending_seconds, size),
+                               rng.integers(pending_seconds, history_seconds, size))
+        executed_after = rng.integers(60, 86400, size)
+        amount_limit = decimal_limit(Transaction, 'amount')
+        amounts = np.clip(np.round(rng.lognormal(self.options['amount_mu'], self.options['amount_sigma'], size), 2),
+                          0.01, amount_limit)
+        txid_parts = rng.integers(0, 2 ** 63, (size, 2))
+
+        now_ms = int(self.now.timestamp() * 1000)
+        transaction_ids = snowflake_ids(now_ms - seconds_ago * 1000, get_worker_id())
+
+        replenishments = self.writer(WalletReplenishmentRequest, [
+            'user_id', 'amount', 'coin_id', 'network_id', 'txid', 'is_approved', 'is_executed', 'date_requested',
+            'date_executed'])
+        withdrawals = self.writer(WalletWithdrawalRequest, [
+            'user_id', 'amount', 'coin_id', 'network_id', 'txid', 'is_approved', 'is_executed', 'date_requested',
+            'date_executed'])
+        transactions = self.writer(Transaction, [
+            'id', 'code', 'user_id', 'transaction_type', 'coin_id', 'network_id', 'txid', 'amount', 'status',
+            'date_created'])
+
+        rows = zip(user_ids[user_index].tolist(), coins[coin_index].tolist(), networks[coin_index].tolist(),
+                   is_withdrawal.tolist(), is_pending.tolist(), seconds_ago.tolist(), executed_after.tolist(),
+                   amounts.tolist(), txid_parts.tolist(), transaction_ids.tolist())
+        for user_id, coin_id, network_id, withdrawal, pending, ago, after, amount, txid, transaction_id in rows:
+            date_requested = self.now - timedelta(seconds=ago)
+            date_executed = None if pending else min(date_requested + timedelta(seconds=after), self.now)
+            txid = None if withdrawal and pending else f'{txid[0]:016x}{txid[1]:016x}'
+
+            request_writer = withdrawals if withdrawal else replenishments
+            request_writer.write((user_id, amount, coin_id, network_id, txid, not pending, not pending,
+                                  date_requested, date_executed))
+            transactions.write((transaction_id, transaction_code(transaction_id), user_id,
+                                'withdrawal' if withdrawal else 'replenishment', coin_id, network_id, txid, amount,
+                                'pending' if pending else 'completed', date_requested))
+
+        self.done(replenishments, 'WalletReplenishmentRequest')
+        self.done(withdrawals, 'WalletWithdrawalRequest')
+        self.done(transactions, 'Transaction')
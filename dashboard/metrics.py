@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+# Метрики Prometheus. Под gunicorn и celery задается PROMETHEUS_MULTIPROC_DIR (config/gunicorn.conf.py): значения
+# каждого процесса пишутся в mmap-файлы каталога и суммируются при выдаче /metrics, без обращений к БД
+
+REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TASK_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+REQUEST_DURATION = Histogram('dashboard_request_duration_seconds', 'Request latency by URL name',
+                             ['view', 'method'], buckets=REQUEST_BUCKETS)
+REQUESTS = Counter('dashboard_requests', 'Requests by URL name and status code', ['view', 'method', 'status'])
+REQUEST_DB_QUERIES = Counter('dashboard_request_db_queries', 'SQL queries executed by requests', ['view'])
+REQUEST_DB_TIME = Counter('dashboard_request_db_seconds', 'Time spent in SQL queries by requests', ['view'])
+CACHE_REQUESTS = Counter('dashboard_cache_requests', 'Dashboard cache lookups by result', ['result'])
+
+TASK_DURATION = Histogram('dashboard_task_duration_seconds', 'Celery task duration by outcome',
+                          ['task', 'status'], buckets=TASK_BUCKETS)
+TASK_DB_QUERIES = Counter('dashboard_task_db_queries', 'SQL queries executed by Celery tasks', ['task'])
+TASK_LAST_SUCCESS = Gauge('dashboard_task_last_success_timestamp_seconds', 'Time of the last successful task run',
+                          ['task'], multiprocess_mode='max')
+
+RATES_UPDATED_METRIC = 'dashboard_exchange_rates_updated_timestamp_seconds'
+RATES_UPDATED = Gauge(RATES_UPDATED_METRIC, 'Time of the last exchange rate update', multiprocess_mode='max')
+PROFIT_RUN_WALLETS = Gauge('dashboard_profit_run_wallets', 'Wallets credited by the last completed profit run',
+                           ['coin'], multiprocess_mode='mostrecent')
+PROFIT_RUN_USERS_PROFIT = Gauge('dashboard_profit_run_users_profit', 'Users profit of the last completed profit run',
+                                ['coin'], multiprocess_mode='mostrecent')
+
+
+def observe_request(request, response, request_metrics, total):
+    match = request.resolver_match
+    view = match.view_name if match else 'unmatched'
+    REQUEST_DURATION.labels(view, request.method).observe(total)
+    REQUESTS.labels(view, request.method, response.status_code).inc()
+    REQUEST_DB_QUERIES.labels(view).inc(request_metrics.sql_count)
+    REQUEST_DB_TIME.labels(view).inc(request_metrics.sql_time)
+    if request_metrics.cache_hits:
+        CACHE_REQUESTS.labels('hit').inc(request_metrics.cache_hits)
+    if request_metrics.cache_misses:
+        CACHE_REQUESTS.labels('miss').inc(request_metrics.cache_misses)
+
+
+def observe_task_run(task_run):
+    TASK_DURATION.labels(task_run.task_name, task_run.status).observe(task_run.duration)
+    TASK_DB_QUERIES.labels(task_run.task_name).inc(task_run.queries)
+    if task_run.status == task_run.STATUS_SUCCESS:
+        TASK_LAST_SUCCESS.labels(task_run.task_name).set(time.time())
+
+
+def observe_rates_update():
+    RATES_UPDATED.set(time.time())
+
+
+def observe_profit_run(profit_run):
+    PROFIT_RUN_WALLETS.labels(profit_run.coin.code).set(profit_run.wallets_count)
+    PROFIT_RUN_USERS_PROFIT.labels(profit_run.coin.code).set(float(profit_run.users_profit))
+
+
+# Возраст последнего обновления курсов считается в момент выдачи из сохраненного времени обновления
+class RatesAgeCollector:
+    def __init__(self, collector):
+        self.collector = collector
+
+    def collect(self):
+        for metric in self.collector.collect():
+            yield metric
+            if metric.name == RATES_UPDATED_METRIC:
+                updated = max((sample.value for sample in metric.samples), default=0)
+                if updated:
+                    age = GaugeMetricFamily('dashboard_exchange_rates_age_seconds',
+                                            'Seconds since the last exchange rate update')
+                    age.add_metric([], time.time() - updated)
+                    yield age
+
+
+def render_metrics():
+    registry = CollectorRegistry()
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry.register(RatesAgeCollector(MultiProcessCollector(None)))
+    else:
+        registry.register(RatesAgeCollector(REGISTRY))
+    return generate_latest(registry)
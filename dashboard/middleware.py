@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import random
+from contextlib import ExitStack
+from time import perf_counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .instrumentation import RequestMetrics, current_metrics
+from .metrics import observe_request
+
+logger = logging.getLogger('dashboard.requests')
+
+DEFAULT_REQUEST_LOG_SAMPLE_RATE = 0.01
+DEFAULT_REQUEST_SLOW_THRESHOLD = 1.0
+
+
+def get_request_log_sample_rate():
+    return getattr(settings, 'REQUEST_LOG_SAMPLE_RATE', DEFAULT_REQUEST_LOG_SAMPLE_RATE)
+
+
+def get_request_slow_threshold():
+    return getattr(settings, 'REQUEST_SLOW_THRESHOLD', DEFAULT_REQUEST_SLOW_THRESHOLD)
+
+
+def server_timing(metrics, total):
+    return ', '.join([
+        f'db;dur={metrics.sql_time * 1000:.1f};desc="{metrics.sql_count} queries"',
+        f'tpl;dur={metrics.template_time * 1000:.1f}',
+        f'cache;desc="{metrics.cache_hits} hits, {metrics.cache_misses} misses"',
+        f'total;dur={total * 1000:.1f}',
+    ])
+
+
+# Время запроса, SQL (число и время через execute_wrapper), рендеринг шаблонов и обращения к кэшу dashboard.
+# Результат - метрики Prometheus, заголовок Server-Timing и строка JSON в логе dashboard.requests: медленные
+# запросы всегда, остальные с вероятностью REQUEST_LOG_SAMPLE_RATE. У потоковых ответов учитывается время
+# до начала отдачи
+class RequestInstrumentationMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_INSTRUMENTATION', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.timing_header = getattr(settings, 'REQUEST_TIMING_HEADER', True)
+        self.sample_rate = get_request_log_sample_rate()
+        self.slow_threshold = get_request_slow_threshold()
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        started = perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        total = perf_counter() - started
+        observe_request(request, response, metrics, total)
+
+        if self.timing_header:
+            timing = server_timing(metrics, total)
+            # Заголовок мог выставить debug_toolbar (DEBUG), метрики добавляются к нему
+            response['Server-Timing'] = f"{response['Server-Timing']}, {timing}" if response.has_header(
+                'Server-Timing') else timing
+
+        slow = total >= self.slow_threshold
+        if slow or random.random() < self.sample_rate:
+            self.log(request, response, metrics, total, slow)
+        return response
+
+    @staticmethod
+    def log(request, response, metrics, total, slow):
+        user = getattr(request, 'user', None)
+        match = request.resolver_match
+        logger.log(logging.WARNING if slow else logging.INFO, json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match else None,
+            'status': response.status_code,
+            'user': user.pk if user is not None and user.is_authenticated else None,
+            'total_ms': round(total * 1000, 1),
+            'sql_count': metrics.sql_count,
+            'sql_ms': round(metrics.sql_time * 1000, 1),
+            'template_ms': round(metrics.template_time * 1000, 1),
+            'cache_hits': metrics.cache_hits,
+            'cache_misses': metrics.cache_misses,
+            'slow': slow,
+        }))
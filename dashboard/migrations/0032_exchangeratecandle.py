@@ -0,0 +1,31 @@
+# Generated by Django 4.2.2 on 2026-10-18 11:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0031_transaction_txid_walletreplenishmentrequest_txid_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeRateCandle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('1m', '1 minute'), ('1h', '1 hour'), ('1d', '1 day')], max_length=2)),
+                ('open_time', models.DateTimeField()),
+                ('open', models.DecimalField(decimal_places=8, max_digits=20)),
+                ('high', models.DecimalField(decimal_places=8, max_digits=20)),
+                ('low', models.DecimalField(decimal_places=8, max_digits=20)),
+                ('close', models.DecimalField(decimal_places=8, max_digits=20)),
+                ('coin', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dashboard.coin')),
+            ],
+            options={
+                'verbose_name': 'Coin rate candle',
+                'unique_together': {('coin', 'resolution', 'open_time')},
+            },
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.2.2 on 2026-10-18 11:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0032_exchangeratecandle'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfitRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('wallets_count', models.PositiveIntegerField(default=0)),
+                ('users_profit', models.DecimalField(decimal_places=4, default=0, max_digits=10)),
+                ('owners_profit', models.DecimalField(decimal_places=4, default=0, max_digits=10)),
+                ('error', models.TextField(blank=True)),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('date_finished', models.DateTimeField(blank=True, null=True)),
+                ('coin', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='dashboard.coin')),
+                ('day_profit', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='dashboard.dayprofit')),
+            ],
+            options={
+                'verbose_name': 'Profit run',
+                'unique_together': {('day_profit', 'coin')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ProfitRunShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id_from', models.IntegerField(blank=True, null=True)),
+                ('user_id_to', models.IntegerField(blank=True, null=True)),
+                ('last_wallet_id', models.BigIntegerField(default=0)),
+                ('wallets_count', models.PositiveIntegerField(default=0)),
+                ('users_profit', models.DecimalField(decimal_places=4, default=0, max_digits=10)),
+                ('is_completed', models.BooleanField(default=False)),
+                ('profit_run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='dashboard.profitrun')),
+            ],
+            options={
+                'verbose_name': 'Profit run shard',
+            },
+        ),
+        migrations.AddField(
+            model_name='profitwallet',
+            name='profit_run',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='dashboard.profitrun'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:02
+
+import datetime
+import itertools
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+from django.db.models.functions import TruncDate, TruncMonth
+import django.db.models.deletion
+
+
+# Заполнение сводок из уже начисленного профита
+def backfill_profit_rollup(apps, schema_editor):
+    ProfitWallet = apps.get_model('dashboard', 'ProfitWallet')
+    ProfitRollup = apps.get_model('dashboard', 'ProfitRollup')
+
+    profits = ProfitWallet.objects.order_by()
+    periods = (
+        ('day', profits.filter(date_created__isnull=False).annotate(period_start=TruncDate('date_created'))),
+        ('month', profits.filter(date_created__isnull=False).annotate(
+            period_start=TruncMonth('date_created', output_field=models.DateField()))),
+        ('total', profits.annotate(period_start=models.Value(datetime.date(1970, 1, 1)))),
+    )
+
+    for period, queryset in periods:
+        rows = queryset.values('user_id', 'period_start').annotate(amount=Sum('amount')).iterator(chunk_size=5000)
+        while True:
+            batch = [ProfitRollup(user_id=row['user_id'], period=period, period_start=row['period_start'],
+                                  amount=row['amount']) for row in itertools.islice(rows, 5000)]
+            if not batch:
+                break
+            ProfitRollup.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dashboard', '0033_profitrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfitRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('day', 'Day'), ('month', 'Month'), ('total', 'All time')], max_length=5)),
+                ('period_start', models.DateField()),
+                ('amount', models.DecimalField(decimal_places=4, default=0, max_digits=14)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'User profit rollup',
+                'unique_together': {('user', 'period', 'period_start')},
+            },
+        ),
+        migrations.RunPython(backfill_profit_rollup, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0034_profitrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='last_updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
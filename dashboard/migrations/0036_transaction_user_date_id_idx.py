@@ -0,0 +1,17 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0035_wallet_last_updated'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['user', 'date_created', 'id'], name='transaction_user_date_id_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:16
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dashboard', '0037_outgoingemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfitDigest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_sent', models.DateTimeField(default=django.utils.timezone.now)),
+                ('day_profit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dashboard.dayprofit')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Profit digest',
+                'unique_together': {('day_profit', 'user')},
+            },
+        ),
+    ]
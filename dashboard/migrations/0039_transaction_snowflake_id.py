@@ -0,0 +1,103 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:30
+
+import dashboard.ids
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+BATCH_SIZE = 5000
+
+# Значения зафиксированы здесь, чтобы миграция не зависела от будущих изменений dashboard.ids
+SNOWFLAKE_EPOCH_MS = 1672531200000
+MIGRATION_WORKER_ID = 1023
+MAX_SEQUENCE = 4095
+
+
+# Перенос транзакций в новую таблицу: id строится из date_created (порядок истории сохраняется),
+# старый строковый id становится кодом транзакции
+def copy_transactions(apps, schema_editor):
+    Transaction = apps.get_model('dashboard', 'Transaction')
+    NewTransaction = apps.get_model('dashboard', 'NewTransaction')
+
+    last_ms = None
+    sequence = 0
+    batch = []
+    for transaction in Transaction.objects.order_by('date_created', 'id').iterator(chunk_size=BATCH_SIZE):
+        timestamp_ms = max(int(transaction.date_created.timestamp() * 1000), SNOWFLAKE_EPOCH_MS)
+        if last_ms is not None and timestamp_ms <= last_ms:
+            timestamp_ms = last_ms
+            sequence += 1
+            if sequence > MAX_SEQUENCE:
+                timestamp_ms += 1
+                sequence = 0
+        else:
+            sequence = 0
+        last_ms = timestamp_ms
+
+        batch.append(NewTransaction(
+            id=((timestamp_ms - SNOWFLAKE_EPOCH_MS) << 22) | (MIGRATION_WORKER_ID << 12) | sequence,
+            code=transaction.id,
+            user_id=transaction.user_id,
+            transaction_type=transaction.transaction_type,
+            coin_id=transaction.coin_id,
+            network_id=transaction.network_id,
+            txid=transaction.txid,
+            amount=transaction.amount,
+            status=transaction.status,
+            date_created=transaction.date_created,
+        ))
+        if len(batch) >= BATCH_SIZE:
+            NewTransaction.objects.bulk_create(batch)
+            batch = []
+
+    if batch:
+        NewTransaction.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dashboard', '0038_profitdigest'),
+    ]
+
+    operations = [
+        # date_created без auto_now_add, чтобы при переносе сохранить исходные даты
+        migrations.CreateModel(
+            name='NewTransaction',
+            fields=[
+                ('id', models.BigIntegerField(default=dashboard.ids.next_snowflake_id, editable=False, primary_key=True, serialize=False)),
+                ('code', models.CharField(editable=False, max_length=20, unique=True)),
+                ('transaction_type', models.CharField(choices=[('replenishment', 'Replenishment'), ('withdrawal', 'Withdrawal')], max_length=100, null=True)),
+                ('txid', models.CharField(blank=True, max_length=100, null=True)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], default='pending', max_length=100)),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('coin', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='dashboard.coin')),
+                ('network', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dashboard.coinnetwork')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Balance transaction',
+                'ordering': ['date_created'],
+            },
+        ),
+        migrations.RunPython(copy_transactions),
+        migrations.DeleteModel(
+            name='Transaction',
+        ),
+        migrations.RenameModel(
+            old_name='NewTransaction',
+            new_name='Transaction',
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='date_created',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['user', 'date_created', 'id'], name='transaction_user_date_id_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0039_transaction_snowflake_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dayprofit',
+            index=models.Index(fields=['date_created'], name='dayprofit_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ownerswallet',
+            index=models.Index(fields=['coin', 'last_replenishment'], name='ownerswallet_coin_repl_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='profitwallet',
+            index=models.Index(fields=['user', 'date_created'], name='profitwallet_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='profitwallet',
+            index=models.Index(fields=['profit_run', 'user'], name='profitwallet_run_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='totalwallet',
+            index=models.Index(fields=['coin', 'date_created'], name='totalwallet_coin_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['user', 'transaction_type', 'status'], name='transaction_user_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['user', 'transaction_type', 'coin', 'network'], name='transaction_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['txid'], name='transaction_txid_idx'),
+        ),
+    ]
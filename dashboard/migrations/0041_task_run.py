@@ -0,0 +1,37 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:43
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0040_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_name', models.CharField(max_length=100)),
+                ('task_id', models.CharField(blank=True, max_length=50)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('success', 'Success'), ('failure', 'Failure')], default='running', max_length=10)),
+                ('date_started', models.DateTimeField(default=django.utils.timezone.now)),
+                ('date_finished', models.DateTimeField(blank=True, null=True)),
+                ('duration', models.FloatField(blank=True, help_text='Seconds', null=True)),
+                ('rows_read', models.PositiveIntegerField(default=0)),
+                ('rows_written', models.PositiveIntegerField(default=0)),
+                ('queries', models.PositiveIntegerField(default=0)),
+                ('peak_rss_kb', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('result', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'verbose_name': 'Task run',
+                'ordering': ['-date_started'],
+                'indexes': [models.Index(fields=['task_name', 'date_started'], name='taskrun_task_date_idx')],
+            },
+        ),
+    ]
@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
+import datetime
 import os
-import uuid
 
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, RegexValidator
 from django.db import models
-from django.db.models.signals import pre_delete, pre_save
+from django.db.models import Q
+from django.db.models.signals import pre_delete, pre_save, post_save, post_delete
+from django.db.transaction import on_commit
 from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from .cache import bump_user_version, bump_rates_version
+from .ids import next_snowflake_id, transaction_code
+
 User._meta.get_field('email')._unique = True
 
 
@@ -116,6 +121,32 @@ class ExchangeRate(models.Model):
         verbose_name = 'Coin exchange rate'
 
 
+# История курса: OHLC свечи с разрешением 1 минута / 1 час / 1 день
+class ExchangeRateCandle(models.Model):
+    RESOLUTION_MINUTE = '1m'
+    RESOLUTION_HOUR = '1h'
+    RESOLUTION_DAY = '1d'
+
+    coin = models.ForeignKey(Coin, on_delete=models.CASCADE)
+    resolution = models.CharField(max_length=2, choices=(
+        (RESOLUTION_MINUTE, _('1 minute')),
+        (RESOLUTION_HOUR, _('1 hour')),
+        (RESOLUTION_DAY, _('1 day'))
+    ))
+    open_time = models.DateTimeField()
+    open = models.DecimalField(max_digits=20, decimal_places=8)
+    high = models.DecimalField(max_digits=20, decimal_places=8)
+    low = models.DecimalField(max_digits=20, decimal_places=8)
+    close = models.DecimalField(max_digits=20, decimal_places=8)
+
+    def __str__(self):
+        return f'{self.coin} {self.resolution} - {self.open_time}'
+
+    class Meta:
+        unique_together = ('coin', 'resolution', 'open_time',)
+        verbose_name = 'Coin rate candle'
+
+
 # Модель кошелька пользователя
 class Wallet(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -125,6 +156,7 @@ class Wallet(models.Model):
     percentage_of_total_balance = models.DecimalField(max_digits=10, decimal_places=4, blank=True, null=True)
     last_replenishment = models.DateTimeField(null=True, blank=True)
     last_withdrawal = models.DateTimeField(null=True, blank=True)
+    last_updated = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ('user', 'coin',)
@@ -146,6 +178,10 @@ class TotalWallet(models.Model):
     class Meta:
         verbose_name = 'Total Wallet'
         verbose_name_plural = 'Total Wallet'
+        indexes = [
+            # Последний портфель по монете (latest('date_created'), подзапрос latest_total_wallet)
+            models.Index(fields=['coin', 'date_created'], name='totalwallet_coin_date_idx'),
+        ]
 
 
 class OwnersWallet(models.Model):
@@ -160,6 +196,10 @@ class OwnersWallet(models.Model):
     class Meta:
         verbose_name = 'Owners Wallet'
         verbose_name_plural = 'Owners Wallet'
+        indexes = [
+            # Последний кошелек владельцев по монете (latest('last_replenishment'), подзапрос latest_owners_wallet)
+            models.Index(fields=['coin', 'last_replenishment'], name='ownerswallet_coin_repl_idx'),
+        ]
 
 
 # Модель получения дневной прибыли
@@ -171,6 +211,51 @@ class DayProfit(models.Model):
     class Meta:
         ordering = ['-date_created']
         verbose_name = 'Bot day profit'
+        indexes = [
+            models.Index(fields=['date_created'], name='dayprofit_date_idx'),
+        ]
+
+
+# Журнал распределения профита: одна запись на DayProfit и монету
+class ProfitRun(models.Model):
+    day_profit = models.ForeignKey(DayProfit, on_delete=models.PROTECT)
+    coin = models.ForeignKey(Coin, on_delete=models.PROTECT)
+    status = models.CharField(max_length=20, default='pending', choices=(
+        ('pending', _('Pending')),
+        ('running', _('Running')),
+        ('completed', _('Completed')),
+        ('failed', _('Failed'))
+    ))
+    wallets_count = models.PositiveIntegerField(default=0)
+    users_profit = models.DecimalField(max_digits=10, decimal_places=4, default=0)
+    owners_profit = models.DecimalField(max_digits=10, decimal_places=4, default=0)
+    error = models.TextField(blank=True)
+    date_created = models.DateTimeField(default=timezone.now)
+    date_finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.day_profit_id} {self.coin} - {self.status}'
+
+    class Meta:
+        unique_together = ('day_profit', 'coin',)
+        verbose_name = 'Profit run'
+
+
+# Контрольная точка шарда (диапазон user_id [from, to)) внутри запуска
+class ProfitRunShard(models.Model):
+    profit_run = models.ForeignKey(ProfitRun, on_delete=models.CASCADE, related_name='shards')
+    user_id_from = models.IntegerField(null=True, blank=True)
+    user_id_to = models.IntegerField(null=True, blank=True)
+    last_wallet_id = models.BigIntegerField(default=0)
+    wallets_count = models.PositiveIntegerField(default=0)
+    users_profit = models.DecimalField(max_digits=10, decimal_places=4, default=0)
+    is_completed = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f'{self.profit_run} [{self.user_id_from}, {self.user_id_to})'
+
+    class Meta:
+        verbose_name = 'Profit run shard'
 
 
 # Модель кошелька профита
@@ -179,12 +264,125 @@ class ProfitWallet(models.Model):
     coin = models.ForeignKey(Coin, on_delete=models.PROTECT)
     amount = models.DecimalField(max_digits=10, decimal_places=4, default=0)
     date_created = models.DateTimeField(null=True, blank=True)
+    profit_run = models.ForeignKey(ProfitRun, on_delete=models.SET_NULL, null=True, blank=True)
 
     def __str__(self):
         return f'{self.coin}: {self.amount}'
 
     class Meta:
         verbose_name = 'User profit'
+        indexes = [
+            # График и выгрузка профита пользователя по диапазону дат, отметка последнего изменения
+            models.Index(fields=['user', 'date_created'], name='profitwallet_user_date_idx'),
+            # Получатели дайджеста запуска по возрастанию user_id
+            models.Index(fields=['profit_run', 'user'], name='profitwallet_run_user_idx'),
+        ]
+
+
+# Отметка об отправленном пользователю письме с итогами DayProfit (повторный запуск рассылки их пропускает)
+class ProfitDigest(models.Model):
+    day_profit = models.ForeignKey(DayProfit, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date_sent = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('day_profit', 'user')
+        verbose_name = 'Profit digest'
+
+
+# Сводка профита пользователя за день, месяц и за все время (ведется задачей распределения профита)
+class ProfitRollup(models.Model):
+    PERIOD_DAY = 'day'
+    PERIOD_MONTH = 'month'
+    PERIOD_TOTAL = 'total'
+    # period_start для сводки за все время
+    TOTAL_PERIOD_START = datetime.date(1970, 1, 1)
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    period = models.CharField(max_length=5, choices=(
+        (PERIOD_DAY, _('Day')),
+        (PERIOD_MONTH, _('Month')),
+        (PERIOD_TOTAL, _('All time'))
+    ))
+    period_start = models.DateField()
+    amount = models.DecimalField(max_digits=14, decimal_places=4, default=0)
+
+    def __str__(self):
+        return f'{self.user.username} {self.period} {self.period_start}: {self.amount}'
+
+    class Meta:
+        unique_together = ('user', 'period', 'period_start',)
+        verbose_name = 'User profit rollup'
+
+
+# Исходящее письмо: пишется в одной транзакции с запросом, отправляется задачей send_queued_emails
+class OutgoingEmail(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField(blank=True)
+    html_body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=255, blank=True)
+    recipients = models.TextField(help_text='Comma-separated addresses')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    date_created = models.DateTimeField(default=timezone.now)
+    date_sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Outgoing email'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outgoingemail_status_next_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.subject} -> {self.recipients} ({self.status})'
+
+
+# Запуск задачи Celery: время, объем работы с БД и пиковая память процесса воркера (см. telemetry.track_task_run)
+class TaskRun(models.Model):
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCESS = 'success'
+    STATUS_FAILURE = 'failure'
+    STATUS_CHOICES = (
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCESS, 'Success'),
+        (STATUS_FAILURE, 'Failure'),
+    )
+
+    task_name = models.CharField(max_length=100)
+    task_id = models.CharField(max_length=50, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_RUNNING)
+    date_started = models.DateTimeField(default=timezone.now)
+    date_finished = models.DateTimeField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True, help_text='Seconds')
+    rows_read = models.PositiveIntegerField(default=0)
+    rows_written = models.PositiveIntegerField(default=0)
+    queries = models.PositiveIntegerField(default=0)
+    peak_rss_kb = models.PositiveBigIntegerField(null=True, blank=True)
+    result = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name = 'Task run'
+        ordering = ['-date_started']
+        indexes = [
+            models.Index(fields=['task_name', 'date_started'], name='taskrun_task_date_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.task_name} {self.date_started:%Y-%m-%d %H:%M:%S} ({self.status})'
 
 
 # Модель запроса на пополнение кошелька
@@ -282,7 +480,8 @@ class WalletWithdrawalRequest(models.Model):
 
 # Модель транзакции
 class Transaction(models.Model):
-    id = models.CharField(max_length=15, unique=True, primary_key=True, editable=False)
+    id = models.BigIntegerField(primary_key=True, default=next_snowflake_id, editable=False)
+    code = models.CharField(max_length=20, unique=True, editable=False)
     user = models.ForeignKey(User, on_delete=models.PROTECT)
     transaction_type = models.CharField(max_length=100, null=True, choices=(
         ('replenishment', _('Replenishment')),
@@ -302,10 +501,23 @@ class Transaction(models.Model):
     class Meta:
         ordering = ['date_created']
         verbose_name = 'Balance transaction'
-
+        indexes = [
+            # Курсорная пагинация истории пользователя по (date_created, id)
+            models.Index(fields=['user', 'date_created', 'id'], name='transaction_user_date_id_idx'),
+            # Суммы завершенных пополнений и выводов пользователя
+            models.Index(fields=['user', 'transaction_type', 'status'], name='transaction_user_type_idx'),
+            # Поиск ожидающей транзакции при исполнении заявки; частичный индекс только по pending
+            # (MySQL частичные индексы не поддерживает, там он не создается)
+            models.Index(fields=['user', 'transaction_type', 'coin', 'network'], condition=Q(status='pending'),
+                         name='transaction_pending_idx'),
+            # Поиск транзакции заявки по txid
+            models.Index(fields=['txid'], name='transaction_txid_idx'),
+        ]
+
+    # id выдается генератором при создании объекта; при bulk_create code нужно заполнить самому
     def save(self, *args, **kwargs):
-        if not self.id:
-            self.id = "#B4Y#" + str(uuid.uuid4().hex[:7]).upper()
+        if not self.code:
+            self.code = transaction_code(self.id)
         super().save(*args, **kwargs)
 
     def mark_completed(self):
@@ -317,4 +529,26 @@ class Transaction(models.Model):
         self.save()
 
     def __str__(self):
-        return f"Transaction ID: {self.id}, Type: {self.transaction_type}, Status: {self.status}"
+        return f"Transaction ID: {self.code}, Type: {self.transaction_type}, Status: {self.status}"
+
+
+# Сброс кэша пользователя при изменении его кошельков, профита, профиля и транзакций
+@receiver(post_save, sender=Wallet)
+@receiver(post_delete, sender=Wallet)
+@receiver(post_save, sender=ProfitWallet)
+@receiver(post_delete, sender=ProfitWallet)
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+def invalidate_dashboard_cache(sender, instance, **kwargs):
+    on_commit(lambda: bump_user_version(instance.user_id))
+
+
+# Ручная правка курсов и монет в админке тоже публикует новую версию курсов
+@receiver(post_save, sender=ExchangeRate)
+@receiver(post_delete, sender=ExchangeRate)
+@receiver(post_save, sender=Coin)
+@receiver(post_delete, sender=Coin)
+def invalidate_rate_snapshot(sender, instance, **kwargs):
+    on_commit(bump_rates_version)
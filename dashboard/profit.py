@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from decimal import Decimal
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q, Value, Case, When, Count, Min, Max, Sum, OuterRef, Subquery, BigIntegerField
+from django.db.models.functions import Cast, Round
+from django.db.models.lookups import Exact, GreaterThan
+from django.utils import timezone
+
+from .cache import bump_profit_version
+from .metrics import observe_profit_run
+from .models import Coin, DayProfit, Wallet, ProfitWallet, ProfitRun, ProfitRunShard, ProfitRollup, TotalWallet, \
+    OwnersWallet
+
+logger = logging.getLogger(__name__)
+
+# Доля прибыли бота, распределяемая между пользователями
+USERS_PROFIT_SHARE = Decimal('0.66')
+
+# Фиксированная точка: целые в единицах последнего знака соответствующих полей
+BALANCE_PLACES = 2  # Wallet.balance
+PERCENT_PLACES = 4  # Wallet.percentage_of_total_balance
+AMOUNT_PLACES = 4  # TotalWallet.total_balance, DayProfit.profittrailer_pnl, ProfitWallet.amount
+
+
+# Последний кошелек владельца по монете (подзапрос для аннотаций)
+def latest_owners_wallet(field, coin_ref='coin'):
+    return Subquery(OwnersWallet.objects.filter(coin=OuterRef(coin_ref)).order_by('-last_replenishment')
+                    .values(field)[:1])
+
+
+# Последний общий баланс по монете (подзапрос для аннотаций)
+def latest_total_wallet(field, coin_ref='coin'):
+    return Subquery(TotalWallet.objects.filter(coin=OuterRef(coin_ref)).order_by('-date_created')
+                    .values(field)[:1])
+
+
+def get_chunk_size():
+    return getattr(settings, 'PROFIT_DISTRIBUTION_CHUNK_SIZE', 5000)
+
+
+def get_shards_count():
+    return getattr(settings, 'PROFIT_DISTRIBUTION_SHARDS', 4)
+
+
+def shard_wallets(coin_id, user_id_from=None, user_id_to=None):
+    wallets = Wallet.objects.filter(coin_id=coin_id, percentage_of_total_balance__isnull=False)
+    if user_id_from is not None:
+        wallets = wallets.filter(user_id__gte=user_id_from)
+    if user_id_to is not None:
+        wallets = wallets.filter(user_id__lt=user_id_to)
+    return wallets
+
+
+# Разбиение кошельков монеты на диапазоны user_id [from, to) равной ширины
+def plan_shards(coin_id, shards=None, chunk_size=None):
+    shards = shards or get_shards_count()
+    chunk_size = chunk_size or get_chunk_size()
+    stats = shard_wallets(coin_id).aggregate(count=Count('pk'), min_user=Min('user_id'), max_user=Max('user_id'))
+    if not stats['count']:
+        return []
+
+    # Нет смысла дробить монету мельче одной пачки на шард
+    shards = max(1, min(shards, -(-stats['count'] // chunk_size)))
+    width = -(-(stats['max_user'] - stats['min_user'] + 1) // shards)
+
+    bounds = [stats['min_user'] + width * i for i in range(1, shards)]
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def to_fixed(value, places):
+    return int(Decimal(value).scaleb(places).to_integral_value())
+
+
+def from_fixed(value, places):
+    return Decimal(int(value)).scaleb(-places)
+
+
+# Значение поля в фиксированной точке, посчитанное на стороне БД
+def fixed_point(field, places):
+    return Cast(Round(F(field) * 10 ** places), BigIntegerField())
+
+
+# Целочисленное деление массива с округлением половины к четному (как Decimal.quantize)
+def div_round_half_even(numerator, denominator):
+    quotient, remainder = np.divmod(numerator, denominator)
+    twice_remainder = remainder * 2
+    round_up = (twice_remainder > denominator) | ((twice_remainder == denominator) & (quotient % 2 == 1))
+    return quotient + round_up
+
+
+# То же деление на стороне БД для целого выражения numerator и целого denominator > 0. Только целочисленная
+# арифметика: частное и остаток точны в PostgreSQL, MySQL и SQLite (в SQLite деление на целое значение
+# десятичного поля становится целочисленным)
+def sql_div_round_half_even(numerator, denominator):
+    remainder = numerator % Value(denominator)
+    quotient = (numerator - remainder) / Value(denominator)
+    twice_remainder = remainder * Value(2)
+    return Case(
+        When(GreaterThan(twice_remainder, Value(denominator)), then=quotient + Value(1)),
+        When(Q(Exact(twice_remainder, Value(denominator))) & Q(Exact(quotient % Value(2), Value(1))),
+             then=quotient + Value(1)),
+        default=quotient,
+        output_field=BigIntegerField(),
+    )
+
+
+# Доля кошелька в общем балансе, % (PERCENT_PLACES), выражением для UPDATE по балансу (BALANCE_PLACES)
+# и общему балансу (AMOUNT_PLACES). Кошелек без баланса остается без доли
+def balance_percentage(total_balance):
+    total = to_fixed(total_balance, AMOUNT_PLACES)
+    if total <= 0:
+        return F('balance') * Value(0)
+    percentages = sql_div_round_half_even(
+        fixed_point('balance', BALANCE_PLACES) * Value(10 ** (2 + PERCENT_PLACES + AMOUNT_PLACES - BALANCE_PLACES)),
+        total)
+    return percentages * Value(Decimal(1).scaleb(-PERCENT_PLACES))
+
+
+# Прибыль пользователей по долям и остаток владельца, оба в AMOUNT_PLACES. Прибыль пользователя округляется
+# до BALANCE_PLACES - ровно эта сумма зачисляется на Wallet.balance и пишется в ProfitWallet;
+# сумма прибыли пользователей плюс остаток владельца всегда равна profittrailer_pnl
+def allocate_profit(percentages, profittrailer_pnl):
+    pnl = to_fixed(profittrailer_pnl, AMOUNT_PLACES)
+    share_numerator, share_denominator = USERS_PROFIT_SHARE.as_integer_ratio()
+    profits = div_round_half_even(percentages * (pnl * share_numerator),
+                                  10 ** (2 + PERCENT_PLACES + AMOUNT_PLACES - BALANCE_PLACES) * share_denominator)
+    profits *= 10 ** (AMOUNT_PLACES - BALANCE_PLACES)
+    return profits, pnl - int(profits.sum())
+
+
+# Следующая пачка кошельков шарда по возрастанию pk (keyset, без OFFSET)
+def next_wallet_chunk(coin_id, after_pk, chunk_size, user_id_from=None, user_id_to=None):
+    return list(
+        shard_wallets(coin_id, user_id_from, user_id_to).filter(pk__gt=after_pk).order_by('pk')
+        .values_list('pk', 'user_id', 'percentage_of_total_balance')[:chunk_size]
+    )
+
+
+# Начисление прибыли одной пачке кошельков: bulk_create в ProfitWallet, затем по одному UPDATE кошельков
+# и сводок. Суммы в UPDATE берутся подзапросом из только что записанных строк ProfitWallet (индекс
+# profit_run + user, у пользователя один кошелек монеты), поэтому баланс и сводки совпадают с журналом
+def distribute_chunk(coin_id, chunk, profittrailer_pnl, date_created, profit_run_id):
+    percentages = np.fromiter((to_fixed(percentage, PERCENT_PLACES) for _, _, percentage in chunk), dtype=np.int64,
+                              count=len(chunk))
+    profits, _ = allocate_profit(percentages, profittrailer_pnl)
+
+    ProfitWallet.objects.bulk_create([
+        ProfitWallet(user_id=user_id, coin_id=coin_id, amount=from_fixed(profit, AMOUNT_PLACES),
+                     date_created=date_created, profit_run_id=profit_run_id)
+        for (_, user_id, _), profit in zip(chunk, profits.tolist())
+    ])
+    user_profit = Subquery(ProfitWallet.objects.filter(
+        profit_run_id=profit_run_id, user_id=OuterRef('user_id')
+    ).values('amount')[:1])
+
+    Wallet.objects.filter(pk__in=[wallet_id for wallet_id, _, _ in chunk]).update(
+        balance=F('balance') + user_profit, last_updated=timezone.now())
+    add_to_profit_rollup([user_id for _, user_id, _ in chunk], date_created, user_profit)
+
+    return from_fixed(profits.sum(), AMOUNT_PLACES)
+
+
+# Инкремент сводок профита (день, месяц, все время) пользователей user_ids на amount - значение или выражение
+# по строке сводки (подзапрос по OuterRef('user_id')). Недостающие строки создаются с нулем, затем все
+# увеличиваются одним UPDATE через F(), так что параллельные шарды не теряют суммы
+def add_to_profit_rollup(user_ids, date_created, amount):
+    day = timezone.localdate(date_created)
+    periods = {
+        ProfitRollup.PERIOD_DAY: day,
+        ProfitRollup.PERIOD_MONTH: day.replace(day=1),
+        ProfitRollup.PERIOD_TOTAL: ProfitRollup.TOTAL_PERIOD_START,
+    }
+
+    period_filter = Q()
+    for period, period_start in periods.items():
+        period_filter |= Q(period=period, period_start=period_start)
+    rollups = ProfitRollup.objects.filter(period_filter, user_id__in=user_ids)
+
+    # Строки месяца и всего времени обычно уже есть - создаются только отсутствующие
+    existing = set(rollups.values_list('user_id', 'period'))
+    ProfitRollup.objects.bulk_create([
+        ProfitRollup(user_id=user_id, period=period, period_start=period_start)
+        for user_id in user_ids
+        for period, period_start in periods.items()
+        if (user_id, period) not in existing
+    ], ignore_conflicts=True)
+
+    rollups.update(amount=F('amount') + amount)
+
+
+# Запуск распределения по монете; создается один раз на DayProfit вместе с шардами
+def start_profit_run(day_profit, coin_id):
+    with transaction.atomic():
+        profit_run, created = ProfitRun.objects.get_or_create(day_profit=day_profit, coin_id=coin_id)
+        if created:
+            ProfitRunShard.objects.bulk_create([
+                ProfitRunShard(profit_run=profit_run, user_id_from=user_id_from, user_id_to=user_id_to)
+                for user_id_from, user_id_to in plan_shards(coin_id)
+            ])
+    return profit_run
+
+
+# Обработка шарда пачками. Каждая пачка коммитится вместе с контрольной точкой шарда,
+# поэтому повторный запуск продолжает с последней закоммиченной пачки и не начисляет дважды
+def distribute_shard(shard_id, chunk_size=None):
+    chunk_size = chunk_size or get_chunk_size()
+    profit_run = ProfitRun.objects.select_related('day_profit').get(shards=shard_id)
+    profittrailer_pnl = profit_run.day_profit.profittrailer_pnl
+
+    while True:
+        started = time.monotonic()
+        with transaction.atomic():
+            shard = ProfitRunShard.objects.select_for_update().get(pk=shard_id)
+            if shard.is_completed:
+                return shard
+
+            chunk = next_wallet_chunk(profit_run.coin_id, shard.last_wallet_id, chunk_size,
+                                      shard.user_id_from, shard.user_id_to)
+            if not chunk:
+                shard.is_completed = True
+                shard.save(update_fields=['is_completed'])
+                return shard
+
+            shard.users_profit += distribute_chunk(profit_run.coin_id, chunk, profittrailer_pnl,
+                                                   profit_run.date_created, profit_run.pk)
+            shard.wallets_count += len(chunk)
+            shard.last_wallet_id = chunk[-1][0]
+            shard.save(update_fields=['users_profit', 'wallets_count', 'last_wallet_id'])
+
+        elapsed = time.monotonic() - started
+        logger.info('Coin %s, shard %s: %d wallets in %.3fs (%.0f wallets/s)', profit_run.coin_id, shard_id,
+                    len(chunk), elapsed, len(chunk) / elapsed if elapsed else 0)
+
+
+# Закрытие запуска, когда все шарды завершены: итоги в TotalWallet и OwnersWallet
+def finalize_profit_run(profit_run_id):
+    with transaction.atomic():
+        profit_run = ProfitRun.objects.select_for_update().select_related('day_profit').get(pk=profit_run_id)
+        if profit_run.status == 'completed':
+            return profit_run
+
+        totals = profit_run.shards.aggregate(
+            wallets_count=Sum('wallets_count'),
+            users_profit=Sum('users_profit'),
+            pending=Count('pk', filter=Q(is_completed=False)),
+        )
+        if totals['pending']:
+            return profit_run
+
+        users_profit = totals['users_profit'] or Decimal(0)
+        owners_profit = profit_run.day_profit.profittrailer_pnl - users_profit
+
+        total_wallet = TotalWallet.objects.filter(coin_id=profit_run.coin_id).latest('date_created')
+        total_wallet.users_profit = users_profit
+        total_wallet.save(update_fields=['users_profit'])
+
+        # Новая запись кошелька владельца на основе последней, с остатком прибыли
+        existing_owners_wallet = OwnersWallet.objects.filter(coin_id=profit_run.coin_id).latest('last_replenishment')
+        OwnersWallet.objects.create(
+            coin_id=profit_run.coin_id,
+            balance=existing_owners_wallet.balance + owners_profit,
+            profit=owners_profit,
+            last_replenishment=timezone.now()
+        )
+
+        profit_run.status = 'completed'
+        profit_run.wallets_count = totals['wallets_count'] or 0
+        profit_run.users_profit = users_profit
+        profit_run.owners_profit = owners_profit
+        profit_run.date_finished = timezone.now()
+        profit_run.save()
+        transaction.on_commit(bump_profit_version)
+
+    observe_profit_run(profit_run)
+    return profit_run
+
+
+# Предпросмотр распределения по сохраненным долям кошельков (тем же, по которым начисляет запуск), без записи в БД
+def preview_distribution(day_profit=None):
+    day_profit = day_profit or DayProfit.objects.latest('date_created')
+    coins = Coin.objects.annotate(total_balance=latest_total_wallet('total_balance', 'pk')).filter(
+        total_balance__isnull=False)
+
+    previews = []
+    for coin in coins:
+        percentages = shard_wallets(coin.pk).values_list(fixed_point('percentage_of_total_balance', PERCENT_PLACES),
+                                                         flat=True)
+        percentages = np.fromiter(percentages.iterator(chunk_size=get_chunk_size()), dtype=np.int64)
+
+        started = time.monotonic()
+        profits, owners_profit = allocate_profit(percentages, day_profit.profittrailer_pnl)
+        elapsed = time.monotonic() - started
+
+        previews.append({
+            'coin': coin,
+            'wallets_count': len(profits),
+            'users_profit': from_fixed(profits.sum(), AMOUNT_PLACES),
+            'owners_profit': from_fixed(owners_profit, AMOUNT_PLACES),
+            'max_user_profit': from_fixed(profits.max(), AMOUNT_PLACES) if len(profits) else Decimal(0),
+            'elapsed_ms': elapsed * 1000,
+        })
+    return previews
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta, timezone as dt_timezone
+from types import MappingProxyType
+
+from django.conf import settings
+from django.utils import timezone
+
+from .cache import get_rates_version
+from .models import ExchangeRate, ExchangeRateCandle
+
+RESOLUTION_STEPS = {
+    ExchangeRateCandle.RESOLUTION_MINUTE: timedelta(minutes=1),
+    ExchangeRateCandle.RESOLUTION_HOUR: timedelta(hours=1),
+    ExchangeRateCandle.RESOLUTION_DAY: timedelta(days=1),
+}
+
+# Сколько хранить свечи каждого разрешения (None - без ограничения); в settings.EXCHANGE_RATE_HISTORY_RETENTION
+# задаются только переопределения
+DEFAULT_HISTORY_RETENTION = {
+    ExchangeRateCandle.RESOLUTION_MINUTE: timedelta(days=2),
+    ExchangeRateCandle.RESOLUTION_HOUR: timedelta(days=90),
+    ExchangeRateCandle.RESOLUTION_DAY: None,
+}
+
+
+def get_history_retention():
+    retention = dict(DEFAULT_HISTORY_RETENTION)
+    retention.update(getattr(settings, 'EXCHANGE_RATE_HISTORY_RETENTION', {}))
+    return retention
+
+
+def candle_open_time(timestamp, resolution):
+    step = int(RESOLUTION_STEPS[resolution].total_seconds())
+    return datetime.fromtimestamp(int(timestamp.timestamp()) // step * step, tz=dt_timezone.utc)
+
+
+# Запись наблюдаемых цен {coin_id: price} во все разрешения свечей
+def record_rate_history(prices, timestamp=None):
+    if not prices:
+        return 0
+
+    timestamp = timestamp or timezone.now()
+    open_times = {resolution: candle_open_time(timestamp, resolution) for resolution in RESOLUTION_STEPS}
+
+    candles = {
+        (candle.coin_id, candle.resolution, candle.open_time): candle
+        for candle in ExchangeRateCandle.objects.filter(coin_id__in=prices, open_time__in=set(open_times.values()))
+    }
+
+    to_create = []
+    to_update = []
+    for coin_id, price in prices.items():
+        for resolution, open_time in open_times.items():
+            candle = candles.get((coin_id, resolution, open_time))
+            if candle is None:
+                to_create.append(ExchangeRateCandle(coin_id=coin_id, resolution=resolution, open_time=open_time,
+                                                    open=price, high=price, low=price, close=price))
+                continue
+
+            candle.high = max(candle.high, price)
+            candle.low = min(candle.low, price)
+            candle.close = price
+            to_update.append(candle)
+
+    if to_create:
+        ExchangeRateCandle.objects.bulk_create(to_create)
+    if to_update:
+        ExchangeRateCandle.objects.bulk_update(to_update, ['high', 'low', 'close'])
+
+    return len(to_create) + len(to_update)
+
+
+# Удаление свечей старше срока хранения своего разрешения
+def prune_rate_history(now=None):
+    now = now or timezone.now()
+    deleted = {}
+    for resolution, keep in get_history_retention().items():
+        if keep is None:
+            continue
+        deleted[resolution], _ = ExchangeRateCandle.objects.filter(resolution=resolution,
+                                                                   open_time__lt=now - keep).delete()
+    return deleted
+
+
+# Курс монеты на момент времени: одно обращение к индексу (coin, resolution, open_time)
+def rate_at(coin, timestamp):
+    age = timezone.now() - timestamp
+    retention = get_history_retention()
+    resolutions = list(RESOLUTION_STEPS)
+
+    # Самое мелкое разрешение, срок хранения которого покрывает запрошенный момент
+    start = 0
+    while start < len(resolutions) - 1:
+        keep = retention[resolutions[start]]
+        if keep is None or age <= keep:
+            break
+        start += 1
+
+    for resolution in resolutions[start:]:
+        candle = ExchangeRateCandle.objects.filter(
+            coin=coin, resolution=resolution, open_time__lte=timestamp
+        ).order_by('-open_time').values_list('open_time', 'open', 'close').first()
+        if candle is not None:
+            open_time, open_rate, close_rate = candle
+            # close свечи, внутри которой лежит момент, может быть наблюдением после него - берется open;
+            # свеча, закончившаяся раньше (пропуск в истории), дает последнюю известную цену - close
+            return open_rate if timestamp < open_time + RESOLUTION_STEPS[resolution] else close_rate
+    return None
+
+
+# Неизменяемый снимок текущих курсов: {coin_id: rate} и строки ExchangeRate с монетами для шаблонов
+class RateSnapshot:
+    def __init__(self, version, exchange_rates):
+        self.version = version
+        # Для шаблонов - по убыванию курса, как ExchangeRate.Meta.ordering; строки без курса в конце
+        self.exchange_rates = tuple(sorted(exchange_rates, key=lambda exchange_rate: (
+            exchange_rate.rate is None, -(exchange_rate.rate or 0), exchange_rate.coin_id)))
+        self.rates = MappingProxyType({
+            exchange_rate.coin_id: exchange_rate.rate
+            for exchange_rate in self.exchange_rates if exchange_rate.rate is not None
+        })
+        self.last_updated = max((exchange_rate.last_updated for exchange_rate in self.exchange_rates), default=None)
+
+    def rate(self, coin_id, default=None):
+        return self.rates.get(coin_id, default)
+
+
+_rate_snapshot = None
+
+
+# Снимок курсов процесса; перечитывается из БД только после смены версии курсов в общем кэше
+def get_rate_snapshot():
+    global _rate_snapshot
+
+    version = get_rates_version()
+    snapshot = _rate_snapshot
+    if snapshot is None or snapshot.version != version:
+        snapshot = RateSnapshot(version, ExchangeRate.objects.select_related('coin').order_by('coin_id'))
+        _rate_snapshot = snapshot
+    return snapshot
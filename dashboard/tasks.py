@@ -1,157 +1,369 @@
 # -*- coding: utf-8 -*-
+import codecs
+import json
 from _decimal import Decimal
+from itertools import chain
+
 import requests
-from celery import shared_task
+from celery import shared_task, chord
+from celery.utils.log import get_task_logger
 from django.db import transaction
-from django.db.models import Sum
+from django.db.models import Sum, Value, Case, When
 from django.utils import timezone
-from .models import Coin, ExchangeRate, Wallet, TotalWallet, DayProfit, ProfitWallet, OwnersWallet
+from .cache import bump_rates_version
+from .mail import deliver_email_batch, get_outbox_batch_size, deliver_profit_digest
+from .metrics import observe_rates_update
+from .models import Coin, ExchangeRate, Wallet, TotalWallet, DayProfit, OwnersWallet, ProfitRun
+from .profit import latest_owners_wallet, latest_total_wallet, start_profit_run, distribute_shard, \
+    finalize_profit_run, balance_percentage
+from .rates import record_rate_history, prune_rate_history
+from .telemetry import track_task_run, prune_task_run_history
+
+logger = get_task_logger(__name__)
+
+USDT_CODE = 'USDT'
 
 
 # Обновление курса монет
 @shared_task
-def update_exchange_rates():
-    response = requests.get('https://api.binance.com/api/v3/ticker/24hr')
-    data = response.json()
+@track_task_run
+def update_exchange_rates(full_feed=False):
+    if full_feed:
+        coins = {coin.code: coin for coin in Coin.objects.all()}
+        tickers = iter_ticker_feed()
+    else:
+        coins = {coin.code: coin for coin in Coin.objects.filter(is_active=True).exclude(code=USDT_CODE)}
+        tickers = fetch_tickers(coins)
 
-    for item in data:
-        symbol = item['symbol']
-        price = item['lastPrice']
-        price_change = item['priceChange']
-        percent_change_1h = item['priceChangePercent']
-        usdt_code = 'USDT'
+    return save_exchange_rates(tickers, coins)
 
-        if symbol.endswith(usdt_code):
-            coin_code = symbol[:-len(usdt_code)]
 
-            try:
-                coin = Coin.objects.get(code=coin_code)
-            except Coin.DoesNotExist:
+BINANCE_TICKER_URL = 'https://api.binance.com/api/v3/ticker/24hr'
+BINANCE_SYMBOLS_PER_REQUEST = 100
+BINANCE_TIMEOUT = 30
+BINANCE_STREAM_CHUNK_SIZE = 64 * 1024
+
+
+# Запрос тикеров только по нужным монетам (параметр symbols, пачками)
+def fetch_tickers(coins):
+    symbols = sorted(code + USDT_CODE for code in coins)
+    feed_tickers = None
+
+    for start in range(0, len(symbols), BINANCE_SYMBOLS_PER_REQUEST):
+        batch = symbols[start:start + BINANCE_SYMBOLS_PER_REQUEST]
+        response = requests.get(BINANCE_TICKER_URL, params={'symbols': json.dumps(batch, separators=(',', ':'))},
+                                timeout=BINANCE_TIMEOUT)
+
+        if response.status_code == 400:
+            # Binance отклоняет всю пачку, если хотя бы одной пары нет на бирже. Полный список скачивается
+            # один раз за запуск, из него берутся тикеры всех монет, в том числе для следующих отклоненных пачек
+            logger.warning('Binance rejected ticker batch %s..%s (%s symbols): %s',
+                           batch[0], batch[-1], len(batch), response.text[:200])
+            if feed_tickers is None:
+                wanted = set(symbols)
+                feed_tickers = {item['symbol']: item for item in iter_ticker_feed() if item['symbol'] in wanted}
+
+            missing = [symbol for symbol in batch if symbol not in feed_tickers]
+            if missing:
+                logger.warning('Symbols not listed on Binance: %s', ', '.join(missing))
+            yield from (feed_tickers[symbol] for symbol in batch if symbol in feed_tickers)
+            continue
+
+        response.raise_for_status()
+        yield from response.json()
+
+
+# Полный список тикеров, разбираемый потоком без загрузки всего документа в память
+def iter_ticker_feed():
+    with requests.get(BINANCE_TICKER_URL, stream=True, timeout=BINANCE_TIMEOUT) as response:
+        response.raise_for_status()
+        yield from iter_json_array(response.iter_content(chunk_size=BINANCE_STREAM_CHUNK_SIZE))
+
+
+# Потоковый разбор JSON-массива из чанков байтов: элементы отдаются по мере чтения
+def iter_json_array(chunks):
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    opened = False
+
+    # None в конце - признак окончания потока, чтобы разобрать элемент, на котором закончился последний чанк
+    for chunk in chain(chunks, [None]):
+        final = chunk is None
+        buffer += utf8.decode(b'' if final else chunk, final=final)
+        if not opened:
+            # Открывающая скобка пропускается один раз: элементы сами могут быть массивами
+            buffer = buffer.lstrip()
+            if not buffer:
                 continue
+            if buffer[0] != '[':
+                raise ValueError('Expected JSON array')
+            buffer = buffer[1:]
+            opened = True
+
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ', \t\r\n':
+                pos += 1
+            if pos >= len(buffer) or buffer[pos] == ']':
+                break
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # Элемент оборван на границе чанка - дочитываем следующий
+                break
+            if end == len(buffer) and not final:
+                # Число на границе чанка может продолжаться в следующем
+                break
+            yield item
+            pos = end
+        buffer = buffer[pos:]
+
+    if buffer.strip() not in ('', ']'):
+        raise ValueError('Unexpected end of JSON array')
 
-            exchange_rate, created = ExchangeRate.objects.get_or_create(coin=coin)
-            exchange_rate.rate = price
-            exchange_rate.price_change = price_change
-            exchange_rate.percent_change_1h = percent_change_1h
-            exchange_rate.last_updated = timezone.now()
-            exchange_rate.save()
+
+# Поле ExchangeRate -> ключ в тикере Binance
+EXCHANGE_RATE_FIELDS = {
+    'rate': 'lastPrice',
+    'price_change': 'priceChange',
+    'percent_change_1h': 'priceChangePercent',
+}
+
+
+def _quantize_field(field_name, value):
+    decimal_places = ExchangeRate._meta.get_field(field_name).decimal_places
+    return Decimal(value).quantize(Decimal(1).scaleb(-decimal_places))
+
+
+# Пакетное сохранение курсов: один запрос на чтение, bulk_create + bulk_update на запись
+def save_exchange_rates(tickers, coins):
+    existing_rates = {}
+    for exchange_rate in ExchangeRate.objects.filter(coin__in=coins.values()).order_by('pk'):
+        existing_rates.setdefault(exchange_rate.coin_id, exchange_rate)
+
+    now = timezone.now()
+    to_create = []
+    to_update = {}
+    changed_fields = set()
+    prices = {}
+    skipped = 0
+
+    for item in tickers:
+        symbol = item['symbol']
+        if not symbol.endswith(USDT_CODE):
+            continue
+
+        coin = coins.get(symbol[:-len(USDT_CODE)])
+        if coin is None:
+            continue
+
+        prices[coin.pk] = Decimal(item['lastPrice'])
+        values = {name: _quantize_field(name, item[key]) for name, key in EXCHANGE_RATE_FIELDS.items()}
+
+        exchange_rate = existing_rates.get(coin.pk)
+        if exchange_rate is None:
+            exchange_rate = ExchangeRate(coin=coin, last_updated=now, **values)
+            existing_rates[coin.pk] = exchange_rate
+            to_create.append(exchange_rate)
+            continue
+
+        if exchange_rate.pk is None:
+            # Повторный тикер для монеты, созданной в этом же проходе
+            for field_name, value in values.items():
+                setattr(exchange_rate, field_name, value)
+            continue
+
+        row_changed = [name for name in EXCHANGE_RATE_FIELDS if getattr(exchange_rate, name) != values[name]]
+        if not row_changed:
+            skipped += 1
+            continue
+
+        for field_name in row_changed:
+            setattr(exchange_rate, field_name, values[field_name])
+        exchange_rate.last_updated = now
+        changed_fields.update(row_changed)
+        to_update[exchange_rate.pk] = exchange_rate
+
+    with transaction.atomic():
+        if to_create:
+            ExchangeRate.objects.bulk_create(to_create)
+        if to_update:
+            ExchangeRate.objects.bulk_update(to_update.values(), sorted(changed_fields) + ['last_updated'])
+        record_rate_history(prices, now)
+        if to_create or to_update:
+            transaction.on_commit(bump_rates_version)
+    observe_rates_update()
+
+    return {'inserted': len(to_create), 'updated': len(to_update), 'skipped': skipped}
+
+
+# Очистка истории курсов по срокам хранения
+@shared_task
+@track_task_run
+def prune_exchange_rate_history():
+    return prune_rate_history()
+
+
+# Очистка записей о запусках задач старше TASK_RUN_RETENTION
+@shared_task
+def prune_task_runs():
+    return prune_task_run_history()
 
 
 # Рассчет общего баланса
 @shared_task
+@track_task_run
 def calculate_total_balance():
-    coins = Wallet.objects.values('coin').distinct()
+    coin_totals = Wallet.objects.order_by().values('coin').annotate(
+        users_balance=Sum('balance'),
+        owners_balance=latest_owners_wallet('balance'),
+    )
 
-    for coin in coins:
-        coin_id = coin['coin']
-        coin_instance = Coin.objects.get(pk=coin_id)
-        total_balance = Wallet.objects.filter(coin_id=coin_id).aggregate(Sum('balance'))['balance__sum'] or Decimal(
-            '0.00')
-        owners_wallet = OwnersWallet.objects.filter(coin_id=coin_id).latest('last_replenishment')
-
-        total_wallet = TotalWallet.objects.create(coin=coin_instance)
-        total_wallet.total_balance = total_balance + owners_wallet.balance
-        total_wallet.date_created = timezone.now()
-        total_wallet.save()
-
-        bot_profit = DayProfit.objects.latest('date_created').profittrailer_pnl
-        total_balance = TotalWallet.objects.latest('date_created').total_balance
+    bot_profit = DayProfit.objects.order_by('-date_created').values_list('profittrailer_pnl', flat=True).first()
+    bot_profit = bot_profit or Decimal('0.00')
+    now = timezone.now()
+
+    total_wallets = []
+    for coin_total in coin_totals:
+        total_balance = (coin_total['users_balance'] or Decimal('0.00')) + (coin_total['owners_balance'] or 0)
         total_balance_with_profit = bot_profit + total_balance
 
-        total_wallet.total_balance_with_profit = total_balance_with_profit
-        total_wallet.relative_profit = bot_profit / total_balance_with_profit * 100
-        total_wallet.save()
+        total_wallets.append(TotalWallet(
+            coin_id=coin_total['coin'],
+            total_balance=total_balance,
+            total_balance_with_profit=total_balance_with_profit,
+            relative_profit=bot_profit / total_balance_with_profit * 100 if total_balance_with_profit else 0,
+            date_created=now,
+        ))
+
+    TotalWallet.objects.bulk_create(total_wallets)
 
     return 'Successfully calculated total balance.'
 
 
 # Рассчет вклада пользователя относительно общего баланса
 @shared_task
+@track_task_run
 def calc_user_percent_dep():
-    try:
-        coins = Wallet.objects.values_list('coin', flat=True).distinct()
-
-        for coin in coins:
-            total_balance_obj = TotalWallet.objects.filter(coin=coin).latest('date_created')
-            total_balance = total_balance_obj.total_balance or 0
-            owners_wallet = OwnersWallet.objects.filter(coin=coin).latest('last_replenishment')
-            owners_balance = owners_wallet.balance or 0
-
-            if total_balance != 0:
-                owners_percentage_of_total_balance = (owners_balance / total_balance) * 100
-            else:
-                owners_percentage_of_total_balance = 0
-            owners_wallet.percentage_of_total_balance = owners_percentage_of_total_balance
-            owners_wallet.save()
-
-            wallets = Wallet.objects.filter(coin=coin)
-
-            for wallet in wallets:
-                user_balance = wallet.balance
-                if total_balance != 0:
-                    percentage_of_total_balance = (user_balance / total_balance) * 100
-                else:
-                    percentage_of_total_balance = 0
-                wallet.percentage_of_total_balance = percentage_of_total_balance
-                wallet.save()
-
-        return 'Successfully updated percentage_of_total_balance for all users'
-    except Exception as e:
-        return f'An error occurred: {str(e)}'
+    coins = Coin.objects.annotate(
+        total_balance=latest_total_wallet('total_balance', 'pk'),
+        owners_wallet_id=latest_owners_wallet('pk', 'pk'),
+        owners_balance=latest_owners_wallet('balance', 'pk'),
+    ).filter(total_balance__isnull=False).values('pk', 'total_balance', 'owners_wallet_id', 'owners_balance')
+
+    percentage_field = Wallet._meta.get_field('percentage_of_total_balance')
+    percentage_quantum = Decimal(1).scaleb(-percentage_field.decimal_places)
+
+    wallet_percentages = []
+    owners_percentages = []
+    for coin in coins:
+        total_balance = coin['total_balance']
+
+        # Доли кошельков округляются половиной к четному в SQL, доля владельца - так же через quantize
+        wallet_percentages.append(When(coin_id=coin['pk'], then=balance_percentage(total_balance)))
+        if total_balance > 0:
+            owners_percentage = ((coin['owners_balance'] or 0) / total_balance * 100).quantize(percentage_quantum)
+        else:
+            owners_percentage = Decimal(0)
+
+        if coin['owners_wallet_id'] is not None:
+            owners_percentages.append(When(pk=coin['owners_wallet_id'], then=Value(owners_percentage)))
+
+    # Два UPDATE на все монеты сразу вместо save() каждого кошелька
+    with transaction.atomic():
+        if wallet_percentages:
+            Wallet.objects.filter(coin_id__in=[coin['pk'] for coin in coins]).update(
+                percentage_of_total_balance=Case(*wallet_percentages, output_field=percentage_field)
+            )
+        if owners_percentages:
+            OwnersWallet.objects.filter(pk__in=[coin['owners_wallet_id'] for coin in coins]).update(
+                percentage_of_total_balance=Case(*owners_percentages, output_field=percentage_field)
+            )
+
+    return 'Successfully updated percentage_of_total_balance for all users'
+
+
+# Рассчет профита: координатор заводит ProfitRun на каждую монету (один раз на DayProfit),
+# запускает незавершенные шарды параллельно и сводит итоги в finalize_user_profit
+@shared_task
+@track_task_run
+def calculate_user_profit(day_profit_id=None):
+    if day_profit_id is None:
+        day_profit = DayProfit.objects.latest('date_created')
+    else:
+        day_profit = DayProfit.objects.get(pk=day_profit_id)
+    coin_ids = Wallet.objects.order_by().values_list('coin', flat=True).distinct()
+
+    profit_run_ids = []
+    shards = []
+    for coin_id in coin_ids:
+        profit_run = start_profit_run(day_profit, coin_id)
+        if profit_run.status == 'completed':
+            continue
+
+        profit_run_ids.append(profit_run.pk)
+        shards += [
+            distribute_profit_shard.si(shard_id)
+            for shard_id in profit_run.shards.filter(is_completed=False).values_list('pk', flat=True)
+        ]
+
+    if not profit_run_ids:
+        return f'Profit for day profit #{day_profit.pk} is already distributed'
+
+    ProfitRun.objects.filter(pk__in=profit_run_ids).update(status='running', error='')
+    if not shards:
+        return finalize_user_profit(profit_run_ids)
 
+    chord(shards)(finalize_user_profit.si(profit_run_ids))
+    return f'Started {len(shards)} profit shards'
 
-# Рассчет профита
+
+# Начисление прибыли одному шарду с контрольными точками по пачкам
 @shared_task
-def calculate_user_profit():
+@track_task_run
+def distribute_profit_shard(shard_id):
     try:
-        with transaction.atomic():
-            coin_ids = Wallet.objects.values_list('coin', flat=True).distinct()
-            print("Coins found:", coin_ids)  # Выведем список монет
-            for coin_id in coin_ids:
-                coin = Coin.objects.get(pk=coin_id)  # Получим экземпляр Coin по ID
-                profittrailer_pnl = DayProfit.objects.latest('date_created').profittrailer_pnl
-                print("Profittrailer_pnl for coin", coin, ":", profittrailer_pnl)  # Выведем pnl для каждой монеты
-                wallets = Wallet.objects.filter(coin=coin)
-                total_users_profit = Decimal(0)
-                for wallet in wallets:
-                    user_percentage = wallet.percentage_of_total_balance
-                    user_profit = Decimal(user_percentage) * Decimal(profittrailer_pnl) * Decimal(0.66) / Decimal(100)
-                    total_users_profit += user_profit
-                    print("User profit for wallet", wallet, ":", user_profit)  # Выведем профит для каждого кошелька
-
-                    profit_wallet = ProfitWallet.objects.create(
-                        user=wallet.user,
-                        coin=coin,  # Передаем экземпляр Coin
-                        amount=user_profit,
-                        date_created=timezone.now()
-                    )
-
-                    wallet.balance += user_profit
-                    wallet.save()
-                    print("New balance for wallet", wallet, ":", wallet.balance)  # Выведем новый баланс
-
-                total_wallet = TotalWallet.objects.filter(coin=coin).latest('date_created')
-                total_wallet.users_profit = total_users_profit
-                total_wallet.save()
-
-                # Получите существующий объект OwnersWallet для данной монеты
-                existing_owners_wallet = OwnersWallet.objects.filter(coin=coin).latest('last_replenishment')
-
-                # Создайте новый объект OwnersWallet, скопировав значения из существующего
-                owners_wallet = OwnersWallet.objects.create(
-                    coin=existing_owners_wallet.coin,
-                    balance=existing_owners_wallet.balance,
-                    profit=profittrailer_pnl - total_users_profit,
-                    last_replenishment=timezone.now()
-                )
-
-                # Теперь добавьте прибыль к балансу
-                owners_wallet.balance += owners_wallet.profit
-
-                # И сохраните изменения
-                owners_wallet.save()
-
-            return 'Successfully'
+        shard = distribute_shard(shard_id)
     except Exception as e:
-        print("An error occurred:", str(e))  # Выведем ошибку, если она есть
-        return f'An error occurred: {str(e)}'
+        ProfitRun.objects.filter(shards=shard_id).update(status='failed', error=str(e))
+        raise
+
+    logger.info('Shard %s: profit %s distributed to %d wallets', shard_id, shard.users_profit, shard.wallets_count)
+    return {'shard_id': shard_id, 'wallets': shard.wallets_count, 'users_profit': str(shard.users_profit)}
+
+
+# Сведение итогов шардов в TotalWallet и OwnersWallet
+@shared_task
+@track_task_run
+def finalize_user_profit(profit_run_ids):
+    day_profit_ids = set()
+    for profit_run_id in profit_run_ids:
+        day_profit_ids.add(finalize_profit_run(profit_run_id).day_profit_id)
+
+    # Итоги дня рассылаются, когда завершены запуски по всем монетам
+    for day_profit_id in day_profit_ids:
+        if not ProfitRun.objects.filter(day_profit_id=day_profit_id).exclude(status='completed').exists():
+            send_profit_digest.delay(day_profit_id)
+
+    return 'Successfully'
+
+
+# Отправка очереди писем пачками, пока есть письма, готовые к отправке
+@shared_task
+def send_queued_emails(max_batches=20):
+    totals = {'sent': 0, 'failed': 0}
+    for _ in range(max_batches):
+        result = deliver_email_batch()
+        totals['sent'] += result['sent']
+        totals['failed'] += result['failed']
+        if result['sent'] + result['failed'] < get_outbox_batch_size():
+            break
+    return totals
+
+
+# Письма пользователям с итогами дня профита
+@shared_task
+@track_task_run
+def send_profit_digest(day_profit_id):
+    return deliver_profit_digest(day_profit_id)
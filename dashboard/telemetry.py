@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import functools
+import logging
+import resource
+from contextlib import ExitStack
+from datetime import timedelta
+from time import perf_counter
+
+from celery import current_app, current_task
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .metrics import observe_task_run
+from .models import TaskRun
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TASK_RUN_RETENTION = timedelta(days=30)
+MAX_RESULT_LENGTH = 1000
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+READ_STATEMENTS = ('SELECT', 'WITH')
+
+# Размеры графика длительности в админке и число последних запусков на графике
+CHART_WIDTH = 600
+CHART_HEIGHT = 120
+CHART_POINTS = 200
+
+
+def get_task_run_retention():
+    return getattr(settings, 'TASK_RUN_RETENTION', DEFAULT_TASK_RUN_RETENTION)
+
+
+# Счетчик запросов задачи для connection.execute_wrapper. Строки считаются по cursor.rowcount: для SELECT
+# и INSERT ... RETURNING его отдает не каждый драйвер (sqlite3 возвращает -1), такие запросы не учитываются
+class QueryCounter:
+    __slots__ = ('queries', 'rows_read', 'rows_written')
+
+    def __init__(self):
+        self.queries = 0
+        self.rows_read = 0
+        self.rows_written = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        self.queries += 1
+        rowcount = getattr(context['cursor'], 'rowcount', -1)
+        if rowcount and rowcount > 0:
+            statement = sql.lstrip()[:6].upper()
+            if statement.startswith(WRITE_STATEMENTS):
+                self.rows_written += rowcount
+            elif statement.startswith(READ_STATEMENTS):
+                self.rows_read += rowcount
+        return result
+
+
+# id запроса Celery, если функция выполняется как задача, а не вызвана напрямую из другой задачи
+def get_task_id(task_name):
+    task = current_task
+    if task and task.name == task_name:
+        return task.request.id or ''
+    return ''
+
+
+# Пиковая память процесса воркера, КБ (ru_maxrss на Linux); это максимум за жизнь процесса, а не только задачи
+def get_peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def finish_task_run(task_run, counter, started, status, result='', error=''):
+    task_run.status = status
+    task_run.date_finished = timezone.now()
+    task_run.duration = round(perf_counter() - started, 3)
+    task_run.queries = counter.queries
+    task_run.rows_read = counter.rows_read
+    task_run.rows_written = counter.rows_written
+    task_run.peak_rss_kb = get_peak_rss_kb()
+    task_run.result = result[:MAX_RESULT_LENGTH]
+    task_run.error = error
+    observe_task_run(task_run)
+    try:
+        task_run.save()
+    except Exception:
+        # Ошибка записи телеметрии не должна менять результат самой задачи
+        logger.exception('Could not save task run %s', task_run.pk)
+
+
+# Строка запуска создается до задачи; если записать ее не удалось, задача все равно выполняется,
+# а несохраненная строка со временем старта записывается целиком при завершении
+def start_task_run(task_name):
+    task_run = TaskRun(task_name=task_name, task_id=get_task_id(task_name))
+    try:
+        task_run.save()
+    except Exception:
+        logger.exception('Could not save start of task %s', task_name)
+    return task_run
+
+
+# Запись каждого запуска задачи в TaskRun; ставится под @shared_task. Запросы самой телеметрии не считаются
+def track_task_run(func):
+    task_name = f'{func.__module__}.{func.__name__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        task_run = start_task_run(task_name)
+        counter = QueryCounter()
+        started = perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(counter))
+                result = func(*args, **kwargs)
+        except Exception as e:
+            finish_task_run(task_run, counter, started, TaskRun.STATUS_FAILURE, error=f'{type(e).__name__}: {e}')
+            raise
+
+        finish_task_run(task_run, counter, started, TaskRun.STATUS_SUCCESS, result=str(result))
+        return result
+
+    return wrapper
+
+
+def prune_task_run_history(now=None):
+    now = now or timezone.now()
+    deleted, _ = TaskRun.objects.filter(date_started__lt=now - get_task_run_retention()).delete()
+    return deleted
+
+
+# Период задачи в расписании beat, сек (только для интервалов timedelta)
+def get_beat_intervals():
+    intervals = {}
+    for entry in current_app.conf.beat_schedule.values():
+        if isinstance(entry['schedule'], timedelta):
+            intervals[entry['task']] = entry['schedule'].total_seconds()
+    return intervals
+
+
+# Данные SVG-графиков длительности для changelist TaskRun: последние CHART_POINTS завершенных запусков
+# каждой задачи из отфильтрованного списка и линия периода beat, если задача в расписании
+def task_run_charts(queryset, points=CHART_POINTS):
+    intervals = get_beat_intervals()
+    queryset = queryset.filter(duration__isnull=False).order_by()
+    charts = []
+    for task_name in queryset.values_list('task_name', flat=True).distinct().order_by('task_name'):
+        runs = list(queryset.filter(task_name=task_name).order_by('-date_started').values_list(
+            'duration', 'status')[:points])[::-1]
+        durations = [duration for duration, _ in runs]
+        interval = intervals.get(task_name)
+
+        top = max(durations + [interval or 0]) * 1.1 or 1
+        step = CHART_WIDTH / max(len(runs) - 1, 1)
+        charts.append({
+            'task_name': task_name,
+            'runs': len(runs),
+            'last': durations[-1],
+            'average': sum(durations) / len(durations),
+            'max': max(durations),
+            'failures': sum(1 for _, status in runs if status == TaskRun.STATUS_FAILURE),
+            'interval': interval,
+            'overruns': sum(1 for duration in durations if interval and duration > interval),
+            'points': ' '.join(
+                f'{i * step:.1f},{CHART_HEIGHT - duration / top * CHART_HEIGHT:.1f}'
+                for i, duration in enumerate(durations)
+            ),
+            'interval_y': f'{CHART_HEIGHT - interval / top * CHART_HEIGHT:.1f}' if interval else None,
+            'width': CHART_WIDTH,
+            'height': CHART_HEIGHT,
+        })
+    return charts
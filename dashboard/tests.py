@@ -1,3 +1,1199 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from itertools import islice
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import DatabaseError, connection
+from django.db.models import Q, Sum
+from django.test import TestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .exports import PROFIT_WALLET_COLUMNS, TRANSACTION_COLUMNS, day_start
+from .ids import MIGRATION_WORKER_ID, SNOWFLAKE_EPOCH_MS, get_worker_id, make_snowflake_id, transaction_code
+from .mail import deliver_email_batch, deliver_profit_digest
+from .models import (Coin, CoinNetwork, DayProfit, ExchangeRate, OutgoingEmail, OwnersWallet, ProfitRollup, ProfitRun,
+                     ProfitWallet, ProfitDigest, ProfitRunShard, TaskRun, TotalWallet, Transaction, UserProfile, Wallet)
+from .profit import (distribute_chunk, distribute_shard, finalize_profit_run, plan_shards, preview_distribution,
+                     start_profit_run)
+from .rates import (DEFAULT_HISTORY_RETENTION, RateSnapshot, candle_open_time, get_history_retention, rate_at,
+                    record_rate_history)
+from .tasks import (calc_user_percent_dep, calculate_total_balance, calculate_user_profit, fetch_tickers,
+                    iter_json_array, save_exchange_rates)
+
+
+# Заглушка SMTP: сериализует письма как SMTP-бэкенд, считает соединения и письма, но не хранит их
+class CountingEmailBackend(BaseEmailBackend):
+    connections_opened = 0
+    messages_sent = 0
+    send_calls = 0
+
+    def open(self):
+        CountingEmailBackend.connections_opened += 1
+        return True
+
+    def send_messages(self, email_messages):
+        CountingEmailBackend.send_calls += 1
+        for message in email_messages:
+            message.message().as_bytes()
+        CountingEmailBackend.messages_sent += len(email_messages)
+        return len(email_messages)
+
+    @classmethod
+    def reset(cls):
+        cls.connections_opened = 0
+        cls.messages_sent = 0
+        cls.send_calls = 0
+
+
+@override_settings(EMAIL_BACKEND='dashboard.tests.CountingEmailBackend', PROFIT_DIGEST_RATE_LIMIT=None)
+class ProfitDigestTests(TestCase):
+    def setUp(self):
+        CountingEmailBackend.reset()
+        self.btc = Coin.objects.create(name='Bitcoin', code='BTC', is_active=True)
+        self.eth = Coin.objects.create(name='Ethereum', code='ETH', is_active=True)
+        self.day_profit = DayProfit.objects.create(profittrailer_pnl=Decimal('100'), date_created=timezone.now())
+
+    def create_profits(self, users_count):
+        User.objects.bulk_create([
+            User(username=f'digest{i}', email=f'digest{i}@example.com') for i in range(users_count)
+        ], batch_size=5000)
+        user_ids = list(User.objects.filter(username__startswith='digest').values_list('pk', flat=True))
+
+        for coin in (self.btc, self.eth):
+            profit_run = ProfitRun.objects.create(day_profit=self.day_profit, coin=coin, status='completed')
+            ProfitWallet.objects.bulk_create([
+                ProfitWallet(user_id=user_id, coin=coin, amount=Decimal('0.0100'), profit_run=profit_run,
+                             date_created=self.day_profit.date_created)
+                for user_id in user_ids
+            ], batch_size=5000)
+        return user_ids
+
+    def test_digest_is_sent_once_per_user(self):
+        user_ids = self.create_profits(25)
+        User.objects.filter(pk=user_ids[0]).update(email='')
+
+        self.assertEqual(deliver_profit_digest(self.day_profit.pk, chunk_size=10), 24)
+        self.assertEqual(CountingEmailBackend.connections_opened, 1)
+        # Одна отправка на пачку из 10 пользователей
+        self.assertEqual(CountingEmailBackend.send_calls, 3)
+        self.assertEqual(ProfitDigest.objects.filter(day_profit=self.day_profit).count(), 25)
+
+        # Повторный запуск никого не уведомляет второй раз
+        self.assertEqual(deliver_profit_digest(self.day_profit.pk, chunk_size=10), 0)
+        self.assertEqual(CountingEmailBackend.messages_sent, 24)
+
+    def test_digest_resumes_after_partial_run(self):
+        user_ids = self.create_profits(10)
+        ProfitDigest.objects.bulk_create([ProfitDigest(day_profit=self.day_profit, user_id=user_id)
+                                          for user_id in user_ids[:4]])
+
+        self.assertEqual(deliver_profit_digest(self.day_profit.pk, chunk_size=3), 6)
+
+    def test_digest_rate_limit_splits_chunk(self):
+        self.create_profits(5)
+
+        with mock.patch('dashboard.mail.time.sleep'):
+            self.assertEqual(deliver_profit_digest(self.day_profit.pk, chunk_size=10, rate_limit=2), 5)
+        self.assertEqual(CountingEmailBackend.send_calls, 3)
+
+    # Запускается только с PROFIT_DIGEST_BENCHMARK_USERS (например, 100000);
+    # бюджет времени - PROFIT_DIGEST_BENCHMARK_SECONDS
+    @skipUnless(os.getenv('PROFIT_DIGEST_BENCHMARK_USERS'), 'PROFIT_DIGEST_BENCHMARK_USERS is not set')
+    def test_digest_benchmark(self):
+        users_count = int(os.getenv('PROFIT_DIGEST_BENCHMARK_USERS'))
+        budget = float(os.getenv('PROFIT_DIGEST_BENCHMARK_SECONDS', 300))
+        self.create_profits(users_count)
+
+        started = time.monotonic()
+        sent = deliver_profit_digest(self.day_profit.pk)
+        elapsed = time.monotonic() - started
+
+        print(f'\nProfit digest: {sent} emails in {elapsed:.1f} s ({sent / elapsed:.0f}/s)')
+        self.assertEqual(sent, users_count)
+        self.assertEqual(CountingEmailBackend.connections_opened, 1)
+        self.assertLess(elapsed, budget)
+
+
+@override_settings(EMAIL_BACKEND='dashboard.tests.CountingEmailBackend', EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+class EmailOutboxTests(TestCase):
+    def setUp(self):
+        CountingEmailBackend.reset()
+
+    def create_email(self, **fields):
+        return OutgoingEmail.objects.create(subject='Test', body='Body', recipients='user@example.com', **fields)
+
+    def test_email_is_claimed_before_sending(self):
+        email = self.create_email()
+        statuses = []
+
+        def send_messages(backend, email_messages):
+            statuses.append(OutgoingEmail.objects.get(pk=email.pk).status)
+            return len(email_messages)
+
+        with mock.patch.object(CountingEmailBackend, 'send_messages', send_messages):
+            self.assertEqual(deliver_email_batch(), {'sent': 1, 'failed': 0})
+
+        self.assertEqual(statuses, [OutgoingEmail.STATUS_SENDING])
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutgoingEmail.STATUS_SENT)
+        self.assertEqual(email.attempts, 1)
+        self.assertIsNotNone(email.date_sent)
+
+    def test_expired_lease_is_claimed_again(self):
+        now = timezone.now()
+        expired = self.create_email(status=OutgoingEmail.STATUS_SENDING, attempts=1,
+                                    next_attempt_at=now - timedelta(minutes=1))
+        leased = self.create_email(status=OutgoingEmail.STATUS_SENDING, attempts=1,
+                                   next_attempt_at=now + timedelta(minutes=5))
+
+        self.assertEqual(deliver_email_batch(), {'sent': 1, 'failed': 0})
+        expired.refresh_from_db()
+        leased.refresh_from_db()
+        self.assertEqual(expired.status, OutgoingEmail.STATUS_SENT)
+        self.assertEqual(leased.status, OutgoingEmail.STATUS_SENDING)
+
+    def test_failed_email_is_retried_until_max_attempts(self):
+        email = self.create_email()
+
+        with mock.patch.object(CountingEmailBackend, 'send_messages', side_effect=OSError('refused')):
+            self.assertEqual(deliver_email_batch(), {'sent': 0, 'failed': 1})
+            email.refresh_from_db()
+            self.assertEqual(email.status, OutgoingEmail.STATUS_PENDING)
+            self.assertGreater(email.next_attempt_at, timezone.now())
+
+            OutgoingEmail.objects.filter(pk=email.pk).update(next_attempt_at=timezone.now())
+            self.assertEqual(deliver_email_batch(), {'sent': 0, 'failed': 1})
+
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutgoingEmail.STATUS_FAILED)
+        self.assertEqual(email.attempts, 2)
+        self.assertEqual(email.last_error, 'refused')
+
+
+def ticker(symbol, price):
+    return {'symbol': symbol, 'lastPrice': price, 'priceChange': '0.5', 'priceChangePercent': '1.25'}
+
+
+# Ответы requests.get для fetch_tickers: пачки с символами из rejected получают 400, без symbols - полный список
+class FakeBinance:
+    def __init__(self, feed, rejected=()):
+        self.feed = feed
+        self.rejected = set(rejected)
+        self.batch_requests = 0
+        self.feed_requests = 0
+
+    def get(self, url, params=None, stream=False, timeout=None):
+        if params is None:
+            self.feed_requests += 1
+            body = json.dumps(self.feed).encode()
+            response = mock.MagicMock(status_code=200)
+            response.__enter__.return_value = response
+            response.iter_content.side_effect = lambda chunk_size: (
+                body[i:i + chunk_size] for i in range(0, len(body), chunk_size))
+            return response
+
+        self.batch_requests += 1
+        symbols = json.loads(params['symbols'])
+        if self.rejected.intersection(symbols):
+            return mock.Mock(status_code=400, text='{"code":-1121,"msg":"Invalid symbol."}')
+        return mock.Mock(status_code=200, json=lambda: [item for item in self.feed if item['symbol'] in symbols])
+
+
+class TickerFeedTests(TestCase):
+    def test_json_array_split_at_every_chunk_boundary(self):
+        items = [ticker('BTCUSDT', '30000.5'), {'symbol': 'Ŧ[,]"', 'count': 123456}, 7890, 'ünïcode', None, []]
+        body = json.dumps(items, ensure_ascii=False).encode()
+
+        for size in range(1, len(body) + 1):
+            chunks = (body[i:i + size] for i in range(0, len(body), size))
+            self.assertEqual(list(iter_json_array(chunks)), items, f'chunk size {size}')
+
+    def test_truncated_json_array(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'[{"symbol": "BTCUSDT"}, {"symbol": ']))
+
+    def test_rejected_batches_download_full_feed_once(self):
+        coins = {code: None for code in ('AAA', 'BBB', 'CCC', 'DDD', 'EEE', 'XXX')}
+        binance = FakeBinance([ticker(code + 'USDT', '1.5') for code in ('AAA', 'BBB', 'CCC', 'DDD', 'EEE', 'ZZZ')],
+                              rejected={'BBBUSDT', 'XXXUSDT'})
+
+        with mock.patch('dashboard.tasks.BINANCE_SYMBOLS_PER_REQUEST', 2), \
+                mock.patch('dashboard.tasks.requests.get', binance.get), \
+                self.assertLogs('dashboard.tasks', 'WARNING') as logs:
+            symbols = [item['symbol'] for item in fetch_tickers(coins)]
+
+        self.assertEqual(symbols, ['AAAUSDT', 'BBBUSDT', 'CCCUSDT', 'DDDUSDT', 'EEEUSDT'])
+        self.assertEqual(binance.batch_requests, 3)
+        self.assertEqual(binance.feed_requests, 1)
+        self.assertTrue(any('AAAUSDT..BBBUSDT' in line for line in logs.output))
+        self.assertTrue(any('not listed on Binance: XXXUSDT' in line for line in logs.output))
+
+    def test_save_exchange_rates_counts(self):
+        coins = {coin.code: coin for coin in [
+            Coin.objects.create(name=name, code=code, is_active=True)
+            for name, code in (('Bitcoin', 'BTC'), ('Ethereum', 'ETH'), ('Tron', 'TRX'))
+        ]}
+        ExchangeRate.objects.create(coin=coins['BTC'], rate=Decimal('30000.00'), price_change=Decimal('0.50'),
+                                    percent_change_1h=Decimal('1.25'))
+        ExchangeRate.objects.create(coin=coins['ETH'], rate=Decimal('2000.00'), price_change=Decimal('0.50'),
+                                    percent_change_1h=Decimal('1.25'))
+        tickers = [
+            ticker('BTCUSDT', '30000.001'),
+            ticker('ETHUSDT', '2100'),
+            ticker('TRXUSDT', '0.1'),
+            ticker('TRXUSDT', '0.12'),
+            ticker('ETHBTC', '0.066'),
+            ticker('DOGEUSDT', '0.07'),
+        ]
+
+        self.assertEqual(save_exchange_rates(tickers, coins), {'inserted': 1, 'updated': 1, 'skipped': 1})
+        rates = dict(ExchangeRate.objects.values_list('coin__code', 'rate'))
+        self.assertEqual(rates, {'BTC': Decimal('30000.00'), 'ETH': Decimal('2100.00'), 'TRX': Decimal('0.12')})
+
+        # Повторный тикер TRX в одном проходе перезаписывает созданную строку, без него все пропускается
+        del tickers[2]
+        self.assertEqual(save_exchange_rates(tickers, coins), {'inserted': 0, 'updated': 0, 'skipped': 3})
+
+
+class RateHistoryTests(TestCase):
+    def setUp(self):
+        self.coin = Coin.objects.create(name='Bitcoin', code='BTC', is_active=True)
+        self.minute = candle_open_time(timezone.now() - timedelta(hours=1), '1m')
+
+    def test_rate_inside_candle_is_open(self):
+        record_rate_history({self.coin.pk: Decimal('100')}, self.minute + timedelta(seconds=5))
+        record_rate_history({self.coin.pk: Decimal('110')}, self.minute + timedelta(seconds=50))
+
+        self.assertEqual(rate_at(self.coin, self.minute + timedelta(seconds=20)), Decimal('100'))
+        # Следующих свечей нет - последняя известная цена
+        self.assertEqual(rate_at(self.coin, self.minute + timedelta(minutes=10)), Decimal('110'))
+        self.assertIsNone(rate_at(self.coin, self.minute - timedelta(days=2)))
+
+    def test_snapshot_rates_sorted_by_rate(self):
+        now = timezone.now()
+        exchange_rates = [ExchangeRate(coin_id=coin_id, rate=rate, last_updated=now) for coin_id, rate in (
+            (1, Decimal('0.10')), (2, None), (3, Decimal('30000.00')), (4, Decimal('2000')))]
+
+        snapshot = RateSnapshot(1, exchange_rates)
+        self.assertEqual([exchange_rate.coin_id for exchange_rate in snapshot.exchange_rates], [3, 4, 1, 2])
+        self.assertEqual(dict(snapshot.rates), {1: Decimal('0.10'), 3: Decimal('30000.00'), 4: Decimal('2000')})
+
+    @override_settings(EXCHANGE_RATE_HISTORY_RETENTION={'1m': timedelta(days=7)})
+    def test_retention_overrides_defaults(self):
+        self.assertEqual(get_history_retention(), dict(DEFAULT_HISTORY_RETENTION, **{'1m': timedelta(days=7)}))
+
+
+# План запроса по свежей статистике; в PostgreSQL последовательное чтение запрещается,
+# иначе на маленьких тестовых таблицах индекс не выбирается
+def explain(queryset):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('ANALYZE')
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        elif connection.vendor == 'sqlite':
+            cursor.execute('ANALYZE')
+    return queryset.explain()
+
+
+# Горячие запросы dashboard должны читать данные по индексу
+class HotQueryIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.now = timezone.now()
+        cls.coins = [Coin.objects.create(name=code, code=code, is_active=True) for code in ('BTC', 'ETH', 'TRX')]
+        cls.coin = cls.coins[0]
+        cls.networks = [CoinNetwork.objects.create(coin=coin, name=coin.code, code=coin.code) for coin in cls.coins]
+        cls.network = cls.networks[0]
+        users = User.objects.bulk_create([User(username=f'indexes{i}', email=f'indexes{i}@example.com')
+                                          for i in range(20)])
+        cls.user = users[0]
+
+        # Распределение как в проде: много завершенных транзакций, мало ожидающих, txid почти уникален
+        transactions = []
+        for user in users:
+            for i in range(50):
+                transaction = Transaction(
+                    id=len(transactions) + 1, user=user, coin=cls.coins[i % 3], network=cls.networks[i % 3],
+                    transaction_type='withdrawal' if i % 4 else 'replenishment', amount=i,
+                    status='pending' if i % 25 == 0 else 'completed', txid=f'{user.username}-{i}')
+                transaction.code = f'T{transaction.id}'
+                transactions.append(transaction)
+        Transaction.objects.bulk_create(transactions)
+
+        day_profits = DayProfit.objects.bulk_create([DayProfit(date_created=cls.now - timedelta(days=i))
+                                                     for i in range(30)])
+        profit_runs = [ProfitRun.objects.create(day_profit=day_profit, coin=coin, status='completed')
+                       for day_profit in day_profits[:5] for coin in cls.coins]
+        ProfitWallet.objects.bulk_create([
+            ProfitWallet(user=user, coin=profit_run.coin, amount=Decimal('0.01'), profit_run=profit_run,
+                         date_created=profit_run.day_profit.date_created)
+            for profit_run in profit_runs for user in users
+        ])
+        for coin in cls.coins:
+            TotalWallet.objects.bulk_create([TotalWallet(coin=coin, date_created=cls.now - timedelta(days=i))
+                                             for i in range(30)])
+            OwnersWallet.objects.bulk_create([OwnersWallet(coin=coin, last_replenishment=cls.now - timedelta(days=i))
+                                              for i in range(30)])
+
+    # Запросы без сортировки повторяют get() и агрегаты из views/admin (get() сбрасывает Meta.ordering)
+    def assertUsesIndex(self, queryset, index_name):
+        plan = explain(queryset)
+        self.assertIn(index_name, plan, plan)
+
+    def test_profit_chart_range(self):
+        self.assertUsesIndex(ProfitWallet.objects.filter(
+            user=self.user, date_created__gte=self.now - timedelta(days=30), date_created__lt=self.now
+        ), 'profitwallet_user_date_idx')
+
+    def test_profit_last_updated(self):
+        self.assertUsesIndex(ProfitWallet.objects.filter(user=self.user).order_by('-date_created')[:1],
+                             'profitwallet_user_date_idx')
+
+    def test_profit_digest_recipients(self):
+        self.assertUsesIndex(ProfitWallet.objects.filter(profit_run_id=1, user_id__gt=0).order_by('user_id'),
+                             'profitwallet_run_user_idx')
+
+    def test_wallet_history_page(self):
+        self.assertUsesIndex(Transaction.objects.filter(user=self.user, date_created__gte=self.now).filter(
+            Q(date_created__gt=self.now) | Q(id__gt=1)
+        ).order_by('date_created', 'id')[:11], 'transaction_user_date_id_idx')
+
+    def test_completed_totals(self):
+        self.assertUsesIndex(Transaction.objects.filter(
+            user=self.user, transaction_type__in=['replenishment', 'withdrawal'], status='completed'
+        ).order_by(), 'transaction_user_type_idx')
+
+    @skipUnlessDBFeature('supports_partial_indexes')
+    def test_pending_transaction_lookup(self):
+        self.assertUsesIndex(Transaction.objects.filter(
+            user=self.user, coin=self.coin, network=self.network, transaction_type='withdrawal', status='pending'
+        ).order_by(), 'transaction_pending_idx')
+
+    def test_transaction_by_txid(self):
+        self.assertUsesIndex(Transaction.objects.filter(
+            user=self.user, transaction_type='replenishment', coin=self.coin, network=self.network, txid='abc'
+        ).order_by(), 'transaction_txid_idx')
+
+    def test_latest_total_wallet(self):
+        self.assertUsesIndex(TotalWallet.objects.filter(coin=self.coin).order_by('-date_created')[:1],
+                             'totalwallet_coin_date_idx')
+
+    def test_latest_owners_wallet(self):
+        self.assertUsesIndex(OwnersWallet.objects.filter(coin=self.coin).order_by('-last_replenishment')[:1],
+                             'ownerswallet_coin_repl_idx')
+
+    def test_latest_day_profit(self):
+        self.assertUsesIndex(DayProfit.objects.order_by('-date_created')[:1], 'dayprofit_date_idx')
+
+
+BENCHMARK_BATCH_SIZE = 5000
+
+# Бюджеты просмотров: (url, максимум SQL-запросов, максимум секунд на запрос при масштабе по умолчанию)
+VIEW_BUDGETS = {
+    'dashboard_cold': ('/', 6, 1.0),
+    'dashboard_warm': ('/', 2, 0.5),
+    'wallet': ('/wallet/', 7, 0.5),
+    'wallet_filtered': ('/wallet/?transaction_type=withdrawal&status=completed', 7, 0.5),
+    'get_chart_data': ('/get_chart_data/', 3, 0.2),
+    'profit_chart_data': ('/profit_chart_data/?bucket=day', 3, 0.5),
+    'profit_chart_data_years': ('/profit_chart_data/?bucket=month&from={years_ago}', 3, 0.5),
+    'chart_data': ('/chart_data/', 5, 0.5),
+}
+
+
+def _chunked(rows, size=BENCHMARK_BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Бенчмарк страниц: синтетические данные масштаба DASHBOARD_BENCHMARK_USERS (1000, 100000, 1000000)
+# и DASHBOARD_BENCHMARK_PROFIT_DAYS дней профита у измеряемого пользователя; бюджет времени умножается на
+# DASHBOARD_BENCHMARK_TIME_FACTOR, отчет пишется в DASHBOARD_BENCHMARK_REPORT (по умолчанию во временный каталог)
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ViewBenchmarkTests(TestCase):
+    users_count = int(os.getenv('DASHBOARD_BENCHMARK_USERS', 1000))
+    profit_days = int(os.getenv('DASHBOARD_BENCHMARK_PROFIT_DAYS', 730))
+    transactions_count = int(os.getenv('DASHBOARD_BENCHMARK_TRANSACTIONS', 500))
+    repeat = int(os.getenv('DASHBOARD_BENCHMARK_REPEAT', 5))
+    time_factor = float(os.getenv('DASHBOARD_BENCHMARK_TIME_FACTOR', 1))
+    report_path = os.getenv('DASHBOARD_BENCHMARK_REPORT', os.path.join(tempfile.gettempdir(),
+                                                                       'dashboard_benchmark_report.json'))
+
+    # Результаты не через setUpTestData: там атрибуты копируются для каждого теста
+    @classmethod
+    def setUpClass(cls):
+        cls.results = {}
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        started = time.monotonic()
+        cls.now = timezone.now()
+        cls.coins = [Coin.objects.create(name=name, code=code, is_active=True, coin_image=f'coin_images/{code}.png')
+                     for name, code in (('Bitcoin', 'BTC'), ('Ethereum', 'ETH'), ('Tron', 'TRX'))]
+        cls.networks = [CoinNetwork.objects.create(coin=coin, name=coin.name, code=coin.code) for coin in cls.coins]
+        for coin, rate in zip(cls.coins, (30000, 2000, 0.1)):
+            ExchangeRate.objects.create(coin=coin, rate=rate)
+
+        cls.user = User.objects.create_user('benchmark', 'benchmark@example.com', 'benchmark')
+        UserProfile.objects.create(user=cls.user, first_name='Bench')
+        for batch in _chunked(User(username=f'load{i}', email=f'load{i}@example.com')
+                              for i in range(cls.users_count - 1)):
+            User.objects.bulk_create(batch)
+
+        # У каждого пользователя кошельки по всем монетам, пара транзакций и профит за последний день
+        next_id = iter(range(1, 10 ** 12))
+        for user_ids in _chunked(User.objects.order_by('pk').values_list('pk', flat=True).iterator()):
+            Wallet.objects.bulk_create([
+                Wallet(user_id=user_id, coin=coin, balance=Decimal('100.00'),
+                       percentage_of_total_balance=Decimal('0.0100'))
+                for user_id in user_ids for coin in cls.coins
+            ])
+            Transaction.objects.bulk_create(cls.make_transactions(user_ids, next_id, 2))
+            ProfitWallet.objects.bulk_create([
+                ProfitWallet(user_id=user_id, coin=coin, amount=Decimal('0.0100'), date_created=cls.now)
+                for user_id in user_ids for coin in cls.coins
+            ])
+
+        # Измеряемый пользователь: длинная история транзакций и годы профита со сводками
+        for batch in _chunked(cls.make_transactions([cls.user.pk], next_id, cls.transactions_count)):
+            Transaction.objects.bulk_create(batch)
+        rollups = defaultdict(Decimal)
+        profits = ((cls.now - timedelta(days=day), coin, Decimal('0.0100') * (day % 7 + 1))
+                   for day in range(1, cls.profit_days) for coin in cls.coins)
+        for batch in _chunked(profits):
+            ProfitWallet.objects.bulk_create([ProfitWallet(user=cls.user, coin=coin, amount=amount, date_created=date)
+                                              for date, coin, amount in batch])
+            for date, _, amount in batch:
+                day = timezone.localdate(date)
+                rollups[ProfitRollup.PERIOD_DAY, day] += amount
+                rollups[ProfitRollup.PERIOD_MONTH, day.replace(day=1)] += amount
+                rollups[ProfitRollup.PERIOD_TOTAL, ProfitRollup.TOTAL_PERIOD_START] += amount
+        ProfitRollup.objects.bulk_create([
+            ProfitRollup(user=cls.user, period=period, period_start=period_start, amount=amount)
+            for (period, period_start), amount in rollups.items()
+        ], batch_size=BENCHMARK_BATCH_SIZE)
+
+        cls.seed_seconds = time.monotonic() - started
+
+    @classmethod
+    def make_transactions(cls, user_ids, next_id, per_user):
+        for user_id in user_ids:
+            for i in range(per_user):
+                transaction_id = next(next_id)
+                yield Transaction(
+                    id=transaction_id, code=f'BENCH{transaction_id}', user_id=user_id, coin=cls.coins[i % 3],
+                    network=cls.networks[i % 3], transaction_type='withdrawal' if i % 3 else 'replenishment',
+                    amount=Decimal(i % 100 + 1), status='pending' if i % 20 == 0 else 'completed')
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.results:
+            report = {
+                'date': timezone.now().isoformat(),
+                'commit': _git_commit(),
+                'database': connection.vendor,
+                'scale': {'users': cls.users_count, 'profit_days': cls.profit_days,
+                          'transactions': cls.transactions_count, 'seed_seconds': round(cls.seed_seconds, 1)},
+                'views': cls.results,
+            }
+            os.makedirs(os.path.dirname(cls.report_path), exist_ok=True)
+            with open(cls.report_path, 'w') as report_file:
+                json.dump(report, report_file, indent=2, sort_keys=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    # Медиана времени из repeat запросов; запросы считаются на последнем; cold - с пустым кэшем перед каждым
+    def measure(self, name, cold=False):
+        url, max_queries, max_seconds = VIEW_BUDGETS[name]
+        url = url.format(years_ago=timezone.localdate() - timedelta(days=self.profit_days))
+        self.client.get(url)
+
+        timings = []
+        for _ in range(self.repeat):
+            if cold:
+                cache.clear()
+            queries = []
+            with connection.execute_wrapper(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)):
+                started = time.monotonic()
+                response = self.client.get(url)
+                timings.append(time.monotonic() - started)
+            self.assertEqual(response.status_code, 200)
+
+        seconds = statistics.median(timings)
+        budget = max_seconds * self.time_factor
+        self.results[name] = {'url': url, 'queries': len(queries), 'max_queries': max_queries,
+                              'seconds': round(seconds, 4), 'max_seconds': budget}
+        self.assertLessEqual(len(queries), max_queries, '\n'.join(queries))
+        self.assertLess(seconds, budget)
+
+    def test_dashboard_cold_cache(self):
+        self.measure('dashboard_cold', cold=True)
+
+    def test_dashboard_warm_cache(self):
+        self.measure('dashboard_warm')
+
+    def test_wallet(self):
+        self.measure('wallet')
+
+    def test_wallet_filtered(self):
+        self.measure('wallet_filtered')
+
+    def test_get_chart_data(self):
+        self.measure('get_chart_data')
+
+    def test_profit_chart_data(self):
+        self.measure('profit_chart_data')
+
+    def test_profit_chart_data_years(self):
+        self.measure('profit_chart_data_years')
+
+    def test_chart_data(self):
+        self.measure('chart_data')
+
+
+# Курсорная пагинация истории кошелька: обход вперед и назад без пропусков и повторов, в том числе при
+# одинаковом date_created (id в группе убывает, порядок задает второй ключ курсора)
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class WalletPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='wallet')
+        other_user = User.objects.create(username='other')
+        coin = Coin.objects.create(name='Bitcoin', code='BTC', is_active=True, coin_image='coin_images/BTC.png')
+        network = CoinNetwork.objects.create(coin=coin, name='Bitcoin', code='BTC')
+        start = timezone.now() - timedelta(days=1)
+
+        Transaction.objects.bulk_create([
+            Transaction(id=1000 - i, code=f'W{i}', user=other_user if i % 7 == 6 else cls.user, coin=coin,
+                        network=network, transaction_type='withdrawal' if i % 2 else 'replenishment', amount=i)
+            for i in range(30)
+        ])
+        for i in range(30):
+            Transaction.objects.filter(pk=1000 - i).update(date_created=start + timedelta(minutes=i // 3))
+        cls.expected = list(Transaction.objects.filter(user=cls.user).order_by('date_created', 'id').values_list(
+            'pk', flat=True))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def get_page(self, query=''):
+        response = self.client.get(reverse('wallet') + query)
+        self.assertEqual(response.status_code, 200)
+        return [transaction.pk for transaction in response.context['transactions']], response.context
+
+    def test_forward_and_backward_walk(self):
+        pages = []
+        page, context = self.get_page()
+        self.assertIsNone(context['previous_page_url'])
+        pages.append(page)
+        while context['next_page_url']:
+            page, context = self.get_page(context['next_page_url'])
+            pages.append(page)
+        self.assertEqual([pk for page in pages for pk in page], self.expected)
+        self.assertEqual([len(page) for page in pages], [10, 10, 6])
+
+        backward = [page]
+        while context['previous_page_url']:
+            page, context = self.get_page(context['previous_page_url'])
+            backward.append(page)
+        self.assertEqual(backward[::-1], pages)
+
+    def test_cursor_keeps_filters(self):
+        page, context = self.get_page('?transaction_type=withdrawal&after=garbage')
+        self.assertIn('transaction_type=withdrawal', context['next_page_url'])
+        expected = list(Transaction.objects.filter(user=self.user, transaction_type='withdrawal').order_by(
+            'date_created', 'id').values_list('pk', flat=True))
+        self.assertEqual(page, expected[:10])
+        self.assertEqual(context['transactions_count'], len(expected))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   REQUEST_LOG_SAMPLE_RATE=0)
+class DashboardCacheTests(TestCase):
+    def setUp(self):
+        # Версии и контексты в общем locmem-кэше пережили бы откат базы между тестами
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user('cached', 'cached@example.com', 'cached')
+        self.coin = Coin.objects.create(name='Bitcoin', code='BTC', is_active=True, coin_image='coin_images/BTC.png')
+        self.network = CoinNetwork.objects.create(coin=self.coin, name='Bitcoin', code='BTC')
+        self.wallet = Wallet.objects.create(user=self.user, coin=self.coin, balance=Decimal('1'))
+        self.rate = ExchangeRate.objects.create(coin=self.coin, rate=Decimal('100'))
+        self.client.force_login(self.user)
+
+    def dashboard_wallet(self):
+        return self.client.get(reverse('dashboard')).context['wallets'][0]
+
+    def test_model_saves_refresh_dashboard(self):
+        changes = {
+            'Wallet': lambda: Wallet.objects.get(pk=self.wallet.pk).save(),
+            'ProfitWallet': lambda: ProfitWallet.objects.create(user=self.user, coin=self.coin, amount=Decimal('1'),
+                                                                date_created=timezone.now()),
+            'Transaction': lambda: Transaction.objects.create(user=self.user, coin=self.coin, network=self.network,
+                                                              transaction_type='replenishment', amount=Decimal('1')),
+            'ExchangeRate': lambda: ExchangeRate.objects.get(pk=self.rate.pk).save(),
+        }
+        for balance, (model, change) in enumerate(changes.items(), start=2):
+            with self.subTest(model):
+                cached = self.dashboard_wallet().balance
+                # Изменение без сигналов не видно: контекст берется из кэша
+                Wallet.objects.filter(pk=self.wallet.pk).update(balance=balance)
+                self.assertEqual(self.dashboard_wallet().balance, cached)
+
+                with self.captureOnCommitCallbacks(execute=True):
+                    change()
+                wallet = self.dashboard_wallet()
+                self.assertEqual((wallet.balance, wallet.usdt_equivalent), (balance, balance * Decimal('100')))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ChartDataTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('chart', 'chart@example.com', 'chart')
+        self.coin = Coin.objects.create(name='Bitcoin', code='BTC', is_active=True)
+        self.wallet = Wallet.objects.create(user=self.user, coin=self.coin, balance=Decimal('2'))
+        self.rate = ExchangeRate.objects.create(coin=self.coin, rate=Decimal('30000'))
+        ProfitWallet.objects.create(user=self.user, coin=self.coin, amount=Decimal('1.5'), date_created=timezone.now())
+        self.client.force_login(self.user)
+        self.url = reverse('chart_data') + '?series=allocation,profit'
+
+    def get(self, **headers):
+        return self.client.get(self.url, **headers)
+
+    def test_repeat_request_is_not_modified(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['profit']['series'], [[1.5]])
+        self.assertTrue(response['ETag'])
+        self.assertTrue(response['Last-Modified'])
+
+        repeat = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(repeat.status_code, 304)
+        self.assertEqual(repeat.content, b'')
+
+    def test_wallet_change_returns_new_etag(self):
+        etag = self.get()['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.wallet.balance = Decimal('3')
+            self.wallet.save()
+
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_rate_change_returns_new_etag(self):
+        etag = self.get()['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.rate.rate = Decimal('31000')
+            self.rate.save()
+
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ProfitChartTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('profitchart', 'profitchart@example.com', 'profitchart')
+        other_user = User.objects.create_user('other', 'other@example.com', 'other')
+        coin = Coin.objects.create(name='Bitcoin', code='BTC', is_active=True)
+        for user, day, amount in [(self.user, '2026-01-30', '1'), (self.user, '2026-01-30', '2.5'),
+                                  (self.user, '2026-01-31', '3'), (self.user, '2026-02-01', '4'),
+                                  (other_user, '2026-02-01', '100'), (self.user, '2026-02-15', '5'),
+                                  (self.user, '2026-03-01', '6')]:
+            ProfitWallet.objects.create(user=user, coin=coin, amount=Decimal(amount),
+                                        date_created=day_start(parse_date(day)) + timedelta(hours=12))
+        self.client.force_login(self.user)
+
+    def get(self, **params):
+        return self.client.get(reverse('profit_chart_data'), {'from': '2026-01-01', 'to': '2026-03-31', **params})
+
+    def test_day_and_month_buckets(self):
+        self.assertEqual(json.loads(self.get().content), {
+            'labels': ['2026-01-30', '2026-01-31', '2026-02-01', '2026-02-15', '2026-03-01'],
+            'series': [[3.5, 3.0, 4.0, 5.0, 6.0]],
+        })
+        self.assertEqual(json.loads(self.get(bucket='month').content), {
+            'labels': ['2026-01-01', '2026-02-01', '2026-03-01'],
+            'series': [[6.5, 9.0, 6.0]],
+        })
+        self.assertEqual(json.loads(self.get(bucket='month', **{'from': '2026-01-31', 'to': '2026-02-01'}).content),
+                         {'labels': ['2026-01-01', '2026-02-01'], 'series': [[3.0, 4.0]]})
+
+    @override_settings(PROFIT_CHART_MAX_POINTS=2)
+    def test_points_are_capped_to_latest(self):
+        self.assertEqual(json.loads(self.get().content)['labels'], ['2026-02-15', '2026-03-01'])
+        self.assertEqual(json.loads(self.get(bucket='month').content)['labels'], ['2026-02-01', '2026-03-01'])
+
+    def test_bad_params(self):
+        for params in ({'bucket': 'year'}, {'from': '2026-03-01', 'to': '2026-02-01'}, {'to': '2026-02-30'}):
+            response = self.get(**params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('error', json.loads(response.content))
+
+        response = self.client.get(reverse('chart_data'), {'series': 'profit', 'bucket': 'year'})
+        self.assertEqual(response.status_code, 400)
+
+
+def read_csv(response):
+    return list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   EXPORT_CHUNK_SIZE=2)
+class ExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('export', 'export@example.com', 'export')
+        self.other_user = User.objects.create_user('other', 'other@example.com', 'other')
+        coin = Coin.objects.create(name='Bitcoin', code='BTC', is_active=True)
+        network = CoinNetwork.objects.create(coin=coin, name='Bitcoin', code='BTC')
+        for i, user in enumerate([self.user, self.other_user, self.user, self.user, self.other_user]):
+            Transaction.objects.create(user=user, coin=coin, network=network, transaction_type='replenishment',
+                                       amount=Decimal(i + 1), txid=f'tx{i}')
+            ProfitWallet.objects.create(user=user, coin=coin, amount=Decimal(i + 1), date_created=timezone.now())
+        self.client.force_login(self.user)
+
+    def test_transactions_csv(self):
+        response = self.client.get(reverse('export_transactions'))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="transactions.csv"')
+
+        rows = read_csv(response)
+        self.assertEqual(rows[0], [header for header, _ in TRANSACTION_COLUMNS])
+        self.assertEqual([row[0] for row in rows[1:]], list(Transaction.objects.filter(user=self.user).order_by(
+            'date_created', 'pk').values_list('code', flat=True)))
+        self.assertEqual([row[5] for row in rows[1:]], ['1.00', '3.00', '4.00'])
+
+    def test_profit_json(self):
+        response = self.client.get(reverse('export_profit'), {'format': 'json'})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="profit.json"')
+
+        rows = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([set(row) for row in rows], [{header for header, _ in PROFIT_WALLET_COLUMNS}] * 3)
+        self.assertEqual([row['amount'] for row in rows], ['1.0000', '3.0000', '4.0000'])
+
+    def test_bad_params(self):
+        self.assertEqual(self.client.get(reverse('export_profit'), {'format': 'xml'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('export_transactions'), {'from': 'yesterday'}).status_code, 400)
+
+    def test_login_required(self):
+        self.client.logout()
+        for name in ('export_transactions', 'export_profit'):
+            response = self.client.get(reverse(name))
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue(response['Location'].startswith(reverse(settings.LOGIN_URL)))
+
+    def test_admin_export_actions(self):
+        self.client.force_login(User.objects.create_superuser('exportadmin', 'exportadmin@example.com', 'admin'))
+        transactions = list(Transaction.objects.order_by('date_created', 'pk'))
+
+        response = self.client.post('/admin/dashboard/transaction/', {
+            'action': 'export_csv', '_selected_action': [transaction.pk for transaction in transactions[:2]]})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="transactions.csv"')
+        rows = read_csv(response)
+        self.assertEqual(rows[0][:3], ['id', 'user', 'date_created'])
+        self.assertEqual([row[:2] for row in rows[1:]], [[transactions[0].code, 'export'],
+                                                         [transactions[1].code, 'other']])
+
+        response = self.client.post('/admin/dashboard/profitwallet/', {
+            'action': 'export_json', '_selected_action': list(ProfitWallet.objects.values_list('pk', flat=True))})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        rows = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([row['user'] for row in rows], ['export', 'other', 'export', 'export', 'other'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   REQUEST_LOG_SAMPLE_RATE=0)
+class RequestInstrumentationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('timing', 'timing@example.com', 'timing')
+        self.client.force_login(self.user)
+
+    def test_server_timing_header(self):
+        timing = self.client.get('/')['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+        self.assertRegex(timing, r'tpl;dur=[\d.]*[1-9]')
+        self.assertIn('cache;desc="0 hits, 1 misses"', timing)
+        self.assertRegex(timing, r'total;dur=[\d.]+$')
+
+        self.assertIn('cache;desc="1 hits, 0 misses"', self.client.get('/')['Server-Timing'])
+
+    @override_settings(REQUEST_SLOW_THRESHOLD=0)
+    def test_slow_request_is_logged(self):
+        with self.assertLogs('dashboard.requests', 'WARNING') as logs:
+            self.client.get('/get_chart_data/')
+
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['view'], 'get_chart_data')
+        self.assertEqual(record['user'], self.user.pk)
+        self.assertGreater(record['sql_count'], 0)
+        self.assertTrue(record['slow'])
+
+
+class TaskRunTests(TestCase):
+    def setUp(self):
+        self.coins = [Coin.objects.create(name=code, code=code, is_active=True) for code in ('BTC', 'ETH', 'XRP')]
+        user = User.objects.create_user('taskrun', 'taskrun@example.com', 'taskrun')
+        Wallet.objects.bulk_create([Wallet(user=user, coin=coin, balance=Decimal('10')) for coin in self.coins])
+
+    def test_successful_run_is_recorded(self):
+        calculate_total_balance()
+        calc_user_percent_dep()
+
+        task_run = TaskRun.objects.get(task_name='dashboard.tasks.calc_user_percent_dep')
+        self.assertEqual(task_run.status, TaskRun.STATUS_SUCCESS)
+        self.assertEqual(task_run.result, 'Successfully updated percentage_of_total_balance for all users')
+        self.assertEqual(task_run.rows_written, len(self.coins))
+        self.assertGreaterEqual(task_run.queries, 2)
+        self.assertGreater(task_run.peak_rss_kb, 0)
+        self.assertIsNotNone(task_run.duration)
+        self.assertGreaterEqual(task_run.date_finished, task_run.date_started)
+
+    def test_failed_run_is_recorded(self):
+        with self.assertRaises(DayProfit.DoesNotExist):
+            calculate_user_profit()
+
+        task_run = TaskRun.objects.get()
+        self.assertEqual(task_run.status, TaskRun.STATUS_FAILURE)
+        self.assertTrue(task_run.error.startswith('DoesNotExist'))
+
+    def test_task_runs_when_task_run_is_not_saved(self):
+        def failing_save(task_run, *args, **kwargs):
+            raise DatabaseError('Database is down')
+
+        with mock.patch.object(TaskRun, 'save', failing_save), self.assertLogs('dashboard.telemetry', 'ERROR') as logs:
+            calculate_total_balance()
+        self.assertEqual(TotalWallet.objects.count(), len(self.coins))
+        self.assertFalse(TaskRun.objects.exists())
+        self.assertEqual(len(logs.records), 2)
+
+    def test_task_run_is_saved_on_finish_after_failed_start(self):
+        save = TaskRun.save
+        saves = []
+
+        def save_after_first_call(task_run, *args, **kwargs):
+            saves.append(task_run.pk)
+            if len(saves) == 1:
+                raise DatabaseError('Database is down')
+            save(task_run, *args, **kwargs)
+
+        with mock.patch.object(TaskRun, 'save', save_after_first_call), self.assertLogs('dashboard.telemetry', 'ERROR'):
+            calculate_total_balance()
+        self.assertEqual(saves, [None, None])
+        task_run = TaskRun.objects.get()
+        self.assertEqual(task_run.status, TaskRun.STATUS_SUCCESS)
+        self.assertLess(task_run.date_started, task_run.date_finished)
+
+    def test_admin_changelist_shows_trend(self):
+        for _ in range(3):
+            calculate_total_balance()
+        TaskRun.objects.update(duration=90)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+
+        response = self.client.get('/admin/dashboard/taskrun/')
+        chart = response.context['task_run_charts'][0]
+        self.assertEqual((chart['task_name'], chart['runs'], chart['interval']),
+                         ('dashboard.tasks.calculate_total_balance', 3, 60))
+        self.assertEqual(chart['overruns'], 3)
+        self.assertContains(response, '<polyline points="0.0,10.9 300.0,10.9 600.0,10.9"')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   REQUEST_LOG_SAMPLE_RATE=0, METRICS_TOKEN=None)
+class MetricsTests(TestCase):
+    @override_settings(METRICS_TOKEN='secret')
+    def test_scrape_does_not_touch_db(self):
+        self.client.force_login(User.objects.create_user('metrics', 'metrics@example.com', 'metrics'))
+        self.client.get('/get_chart_data/')
+        save_exchange_rates([], {})
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response.content.decode(),
+                         r'dashboard_request_duration_seconds_count\{method="GET",view="get_chart_data"\} [1-9]')
+        self.assertRegex(response.content.decode(), r'dashboard_exchange_rates_age_seconds \d')
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token_is_required(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_closed_without_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with self.settings(DEBUG=True):
+            self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   SNOWFLAKE_WORKER_ID=None)
+class SnowflakeIdTests(TestCase):
+    def test_worker_ids_are_allocated_in_turn(self):
+        first = get_worker_id()
+        self.assertEqual([get_worker_id() for _ in range(3)],
+                         [(first + i) % MIGRATION_WORKER_ID for i in (1, 2, 3)])
+
+    def test_timestamp_before_epoch_is_rejected(self):
+        self.assertEqual(make_snowflake_id(SNOWFLAKE_EPOCH_MS, 5, 7), (5 << 12) | 7)
+        with self.assertRaises(ValueError):
+            make_snowflake_id(SNOWFLAKE_EPOCH_MS - 1, 5, 0)
+        with self.assertRaises(ValueError):
+            transaction_code(-1)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SeedLoadTests(TestCase):
+    def test_history_before_snowflake_epoch(self):
+        days = (timezone.now().timestamp() * 1000 - SNOWFLAKE_EPOCH_MS) // 86400000 + 100
+        call_command('seed_load', users=20, days=int(days), profit_days=3, requests_per_user=20, stdout=StringIO())
+
+        transactions = list(Transaction.objects.order_by('date_created', 'id').values_list('id', 'code',
+                                                                                         'date_created'))
+        self.assertLess(transactions[0][2].timestamp() * 1000, SNOWFLAKE_EPOCH_MS)
+        ids = [transaction_id for transaction_id, _, _ in transactions]
+        self.assertGreaterEqual(min(ids), 0)
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual([code for _, code, _ in transactions], [transaction_code(pk) for pk in ids])
+
+
+class BalancePercentageTests(TestCase):
+    def setUp(self):
+        self.coins = {code: Coin.objects.create(name=code, code=code, is_active=True) for code in ('BTC', 'ETH', 'TRX')}
+        self.users = User.objects.bulk_create([User(username=f'percent{i}') for i in range(2)])
+        # BTC: обе доли на половине последнего знака (0.03125, 99.96875); ETH: кошелек без баланса и владелец;
+        # TRX: нулевой общий баланс
+        self.create_wallets('BTC', ['0.01', '31.99'])
+        self.create_wallets('ETH', ['10.00', None])
+        self.create_wallets('TRX', ['0.00', None])
+        for code, balance in (('ETH', '30'), ('TRX', '0')):
+            OwnersWallet.objects.create(coin=self.coins[code], balance=Decimal(balance),
+                                        last_replenishment=timezone.now())
+
+    def create_wallets(self, code, balances, users=None):
+        Wallet.objects.bulk_create([
+            Wallet(user=user, coin=self.coins[code], balance=balance and Decimal(balance))
+            for user, balance in zip(users or self.users, balances)
+        ])
+
+    def percentages(self, code):
+        return list(Wallet.objects.filter(coin=self.coins[code]).order_by('user_id').values_list(
+            'percentage_of_total_balance', flat=True))
+
+    def test_percentages_for_each_coin(self):
+        calculate_total_balance()
+        calc_user_percent_dep()
+
+        self.assertEqual(self.percentages('BTC'), [Decimal('0.0312'), Decimal('99.9688')])
+        self.assertEqual(self.percentages('ETH'), [Decimal('25.0000'), None])
+        self.assertEqual(self.percentages('TRX'), [Decimal('0.0000'), None])
+        self.assertEqual(dict(OwnersWallet.objects.values_list('coin__code', 'percentage_of_total_balance')),
+                         {'ETH': Decimal('75.0000'), 'TRX': Decimal('0.0000')})
+
+    def test_query_count_does_not_depend_on_wallets(self):
+        calculate_total_balance()
+        with CaptureQueriesContext(connection) as queries:
+            calc_user_percent_dep()
+        self.assertEqual(sum(query['sql'].startswith('UPDATE "dashboard_wallet"') for query in queries), 1)
+
+        users = User.objects.bulk_create([User(username=f'percent_more{i}') for i in range(50)])
+        self.create_wallets('BTC', ['1.00'] * len(users), users)
+        calculate_total_balance()
+        with CaptureQueriesContext(connection) as more_queries:
+            calc_user_percent_dep()
+        self.assertEqual(len(more_queries), len(queries))
+        self.assertEqual(self.percentages('BTC')[:3], [Decimal('0.0122'), Decimal('39.0122'), Decimal('1.2195')])
+
+
+class ProfitDistributionTests(TestCase):
+    def setUp(self):
+        self.coin = Coin.objects.create(name='Bitcoin', code='BTC', is_active=True)
+        users = User.objects.bulk_create([User(username=f'profit{i}') for i in range(7)])
+        Wallet.objects.bulk_create([
+            Wallet(user=user, coin=self.coin, balance=balance)
+            for user, balance in zip(users, ['1000.00', '250.50', '0.37', '12.34', '5000.00', '0.01', '777.77'])
+        ])
+        OwnersWallet.objects.create(coin=self.coin, balance=Decimal('300'), last_replenishment=timezone.now())
+        self.day_profit = DayProfit.objects.create(profittrailer_pnl=Decimal('123.4567'), date_created=timezone.now())
+        calculate_total_balance()
+        calc_user_percent_dep()
+
+    def balances(self):
+        return dict(Wallet.objects.values_list('pk', 'balance'))
+
+    def run_profit(self):
+        profit_run = start_profit_run(self.day_profit, self.coin.pk)
+        for shard_id in profit_run.shards.values_list('pk', flat=True):
+            distribute_shard(shard_id)
+        return finalize_profit_run(profit_run.pk)
+
+    def test_credited_balances_match_ledger(self):
+        before = self.balances()
+        profit_run = self.run_profit()
+        after = self.balances()
+
+        ledger = dict(ProfitWallet.objects.values_list('user__wallet', 'amount'))
+        self.assertEqual({pk: after[pk] - before[pk] for pk in before}, ledger)
+        self.assertEqual(sum(ledger.values()), profit_run.users_profit)
+        self.assertEqual(profit_run.users_profit + profit_run.owners_profit, self.day_profit.profittrailer_pnl)
+        self.assertEqual(ProfitRollup.objects.filter(period=ProfitRollup.PERIOD_TOTAL).aggregate(
+            total=Sum('amount'))['total'], profit_run.users_profit)
+
+    def test_preview_matches_run(self):
+        preview = preview_distribution(self.day_profit)[0]
+        profit_run = self.run_profit()
+        self.assertEqual((preview['users_profit'], preview['owners_profit']),
+                         (profit_run.users_profit, profit_run.owners_profit))
+
+    def test_chunked_distribution_and_owner_remainder(self):
+        owners_before = OwnersWallet.objects.get().balance
+        profit_run = start_profit_run(self.day_profit, self.coin.pk)
+        shard = profit_run.shards.get()
+
+        with CaptureQueriesContext(connection) as queries:
+            shard = distribute_shard(shard.pk, chunk_size=2)
+        # На пачку из 2 кошельков: одна вставка в ProfitWallet, по одному UPDATE кошельков и сводок
+        for statement in ('INSERT INTO "dashboard_profitwallet"', 'UPDATE "dashboard_wallet"',
+                          'UPDATE "dashboard_profitrollup"'):
+            self.assertEqual(sum(query['sql'].startswith(statement) for query in queries), 4, statement)
+        # Всего на пачку не больше 10 запросов (с блокировкой и контрольной точкой шарда, выборкой пачки,
+        # выборкой и вставкой строк сводок и savepoint) плюс запуск и завершение шарда
+        self.assertLessEqual(len(queries), 4 * 10 + 6)
+        self.assertEqual((shard.wallets_count, shard.last_wallet_id), (7, Wallet.objects.order_by('pk').last().pk))
+        self.assertEqual(ProfitWallet.objects.count(), 7)
+
+        profit_run = finalize_profit_run(profit_run.pk)
+        self.assertEqual((profit_run.status, profit_run.wallets_count, profit_run.users_profit),
+                         ('completed', 7, shard.users_profit))
+        self.assertEqual(profit_run.users_profit + profit_run.owners_profit, self.day_profit.profittrailer_pnl)
+        self.assertEqual(OwnersWallet.objects.order_by('-last_replenishment').first().balance,
+                         owners_before + profit_run.owners_profit)
+        self.assertEqual(TotalWallet.objects.get().users_profit, profit_run.users_profit)
+
+    @override_settings(PROFIT_DISTRIBUTION_SHARDS=3, PROFIT_DISTRIBUTION_CHUNK_SIZE=2)
+    def test_shards_cover_each_wallet_once(self):
+        user_ids = sorted(Wallet.objects.values_list('user_id', flat=True))
+        shards = plan_shards(self.coin.pk)
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(sorted(user_id for user_id in user_ids for user_id_from, user_id_to in shards
+                                if (user_id_from is None or user_id >= user_id_from)
+                                and (user_id_to is None or user_id < user_id_to)), user_ids)
+        self.assertEqual(len(plan_shards(self.coin.pk, chunk_size=100)), 1)
+
+        profit_run = self.run_profit()
+        self.assertEqual(profit_run.shards.count(), 3)
+        self.assertEqual(sorted(ProfitWallet.objects.values_list('user_id', flat=True)), user_ids)
+        self.assertEqual(profit_run.wallets_count, len(user_ids))
+
+    def test_second_run_is_noop(self):
+        self.run_profit()
+        balances = self.balances()
+
+        self.assertEqual(calculate_user_profit(self.day_profit.pk),
+                         f'Profit for day profit #{self.day_profit.pk} is already distributed')
+        self.assertEqual(ProfitWallet.objects.count(), 7)
+        self.assertEqual(self.balances(), balances)
+
+    def test_interrupted_shard_resumes_without_double_credit(self):
+        before = self.balances()
+        profit_run = start_profit_run(self.day_profit, self.coin.pk)
+        shard_id = profit_run.shards.get().pk
+
+        chunks = []
+
+        def fail_on_second_chunk(*args, **kwargs):
+            if chunks:
+                raise RuntimeError('Worker lost')
+            chunks.append(args)
+            return distribute_chunk(*args, **kwargs)
+
+        with mock.patch('dashboard.profit.distribute_chunk', fail_on_second_chunk):
+            with self.assertRaises(RuntimeError):
+                distribute_shard(shard_id, chunk_size=3)
+        self.assertEqual(ProfitRunShard.objects.get(pk=shard_id).wallets_count, 3)
+        self.assertEqual(ProfitWallet.objects.count(), 3)
+
+        distribute_shard(shard_id, chunk_size=3)
+        profit_run = finalize_profit_run(profit_run.pk)
+        after = self.balances()
+
+        ledger = dict(ProfitWallet.objects.values_list('user__wallet', 'amount'))
+        self.assertEqual(len(ledger), ProfitWallet.objects.count())
+        self.assertEqual({pk: after[pk] - before[pk] for pk in before}, ledger)
+        self.assertEqual(sum(ledger.values()), profit_run.users_profit)
+
+    def test_admin_action_without_day_profit(self):
+        self.day_profit.delete()
+        wallet = Wallet.objects.first()
+        profit_wallet = ProfitWallet.objects.create(user_id=wallet.user_id, coin=self.coin, amount=Decimal('1'),
+                                                    date_created=timezone.now())
+        self.client.force_login(User.objects.create_superuser('profitadmin', 'profitadmin@example.com', 'admin'))
+
+        response = self.client.post('/admin/dashboard/profitwallet/', {
+            'action': 'calculate_user_profit_action', '_selected_action': [profit_wallet.pk]}, follow=True)
+        self.assertContains(response, 'Bot day profit is not set.')
+
+    def test_admin_is_read_only(self):
+        self.run_profit()
+        profit_wallet = ProfitWallet.objects.first()
+        ledger = list(ProfitWallet.objects.values_list('pk', 'amount'))
+        rollups = list(ProfitRollup.objects.values_list('pk', 'amount'))
+        self.client.force_login(User.objects.create_superuser('profitadmin', 'profitadmin@example.com', 'admin'))
+
+        url = '/admin/dashboard/profitwallet/'
+        self.assertEqual(self.client.post(f'{url}add/', {
+            'user': profit_wallet.user_id, 'coin': self.coin.pk, 'amount': '1'}).status_code, 403)
+        self.assertEqual(self.client.post(f'{url}{profit_wallet.pk}/change/', {
+            'user': profit_wallet.user_id, 'coin': self.coin.pk, 'amount': '1'}).status_code, 403)
+        self.assertEqual(self.client.post(f'{url}{profit_wallet.pk}/delete/', {'post': 'yes'}).status_code, 403)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('delete_selected', dict(response.context['action_form'].fields['action'].choices))
+
+        self.assertEqual(list(ProfitWallet.objects.values_list('pk', 'amount')), ledger)
+        self.assertEqual(list(ProfitRollup.objects.values_list('pk', 'amount')), rollups)
+
+    def test_percentages_use_fixed_point_engine(self):
+        total = TotalWallet.objects.get().total_balance
+        for balance, percentage in Wallet.objects.values_list('balance', 'percentage_of_total_balance'):
+            self.assertEqual(percentage, (balance / total * 100).quantize(Decimal('0.0001')))
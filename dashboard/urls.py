@@ -3,8 +3,8 @@ from django.conf.urls.static import static
 from django.urls import path
 
 from .views import DashboardView, WalletReplenishmentRequestView, ReplenishmentSuccessView, WalletWithdrawalRequestView, \
-    WithdrawalSuccessView, WalletView, profit_chart_data
-from .views import get_chart_data
+    WithdrawalSuccessView, WalletView, profit_chart_data, dashboard_cache_stats_view, metrics_view
+from .views import get_chart_data, chart_data, export_transactions, export_profit
 
 urlpatterns = [
 
@@ -16,8 +16,13 @@ urlpatterns = [
     path('withdrawal/success/', WithdrawalSuccessView.as_view(), name='withdrawal_success'),
 
     path('wallet/', WalletView.as_view(), name='wallet'),
+    path('wallet/export/transactions/', export_transactions, name='export_transactions'),
+    path('wallet/export/profit/', export_profit, name='export_profit'),
+    path('chart_data/', chart_data, name='chart_data'),
     path('get_chart_data/', get_chart_data, name='get_chart_data'),
     path('profit_chart_data/', profit_chart_data, name='profit_chart_data'),
+    path('cache_stats/', dashboard_cache_stats_view, name='dashboard_cache_stats'),
+    path('metrics', metrics_view, name='metrics'),
 
 ]
 
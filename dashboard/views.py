@@ -1,54 +1,166 @@
 # -*- coding: utf-8 -*-
-from datetime import timedelta
+import hashlib
+import hmac
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
 
 from allauth.account.views import PasswordChangeView, PasswordSetView
+from django.conf import settings
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.core.mail import mail_admins
-from django.db import models
-from django.db.models import Sum, ExpressionWrapper, FloatField, F, Prefetch, Case, When, Value
-from django.http import JsonResponse
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Sum, Q, OuterRef, Subquery, DateField
+from django.db.models.functions import TruncDay, TruncWeek, TruncMonth
+from django.http import Http404, JsonResponse, HttpResponse
 from django.shortcuts import render, redirect
 from django.urls import reverse_lazy
 from django.utils import timezone
 from django.views import View
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.views.generic import ListView
-
-from .forms import WalletReplenishmentRequestForm, WalletWithdrawalRequestForm, UserProfileForm
-from .models import Wallet, WalletWithdrawalRequest, Transaction, ExchangeRate, UserProfile, ProfitWallet, \
-    OwnerCoinAddress
-
-
-@login_required
-def get_chart_data(request):
-    balance_datas = Wallet.objects.filter(user=request.user)
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from .cache import get_dashboard_context, dashboard_cache_stats, get_user_count
+from .exports import parse_date_param, day_start, filter_export, export_response, TRANSACTION_COLUMNS, \
+    PROFIT_WALLET_COLUMNS
+from .forms import WalletReplenishmentRequestForm, WalletWithdrawalRequestForm, UserProfileForm, TransactionFilterForm
+from .mail import queue_mail_admins
+from .metrics import render_metrics
+from .models import Wallet, WalletWithdrawalRequest, Transaction, UserProfile, ProfitWallet, OwnerCoinAddress, \
+    ProfitRollup
+from .rates import get_rate_snapshot
+
+
+# Распределение баланса по монетам в USDT
+def allocation_chart(user, rate_snapshot, params):
+    balance_datas = Wallet.objects.filter(user=user).select_related('coin')
     chart_data = []
     coin_names = []
     for balance_data in balance_datas:
-        exchange_rate = ExchangeRate.objects.get(coin=balance_data.coin)
-        balance_data.usdt_equivalent = balance_data.balance * exchange_rate.rate
+        balance_data.usdt_equivalent = balance_data.balance * rate_snapshot.rate(balance_data.coin_id, 1)
         coin_names.append(balance_data.coin.name)
         chart_data.append(float(balance_data.usdt_equivalent))
-    chart_data_json = {
+    return {
         'labels': coin_names,
         'series': chart_data
     }
-    return JsonResponse(chart_data_json)
 
 
-@login_required
-def profit_chart_data(request):
-    profits = ProfitWallet.objects.filter(user=request.user).order_by('date_created')
-    profit_values = [float(profit.amount) for profit in profits]
-    dates = [profit.date_created.strftime('%Y-%m-%d') for profit in profits]
+PROFIT_CHART_BUCKETS = {
+    'day': (TruncDay, timedelta(days=1)),
+    'week': (TruncWeek, timedelta(weeks=1)),
+    'month': (TruncMonth, timedelta(days=31)),
+}
+DEFAULT_PROFIT_CHART_MAX_POINTS = 366
+
+
+def get_profit_chart_max_points():
+    return getattr(settings, 'PROFIT_CHART_MAX_POINTS', DEFAULT_PROFIT_CHART_MAX_POINTS)
 
-    chart_data_json = {
-        'labels': dates,
-        'series': [profit_values],
+
+# Окно графика профита из параметров from/to (YYYY-MM-DD, включительно) и bucket=day|week|month
+def get_profit_window(params):
+    bucket = params.get('bucket', 'day')
+    if bucket not in PROFIT_CHART_BUCKETS:
+        raise ValueError(f'Unknown bucket: {bucket}')
+
+    _, step = PROFIT_CHART_BUCKETS[bucket]
+    date_to = parse_date_param(params.get('to')) or timezone.localdate()
+    date_from = parse_date_param(params.get('from')) or date_to - step * (get_profit_chart_max_points() - 1)
+    if date_from > date_to:
+        raise ValueError('from must not be later than to')
+    return date_from, date_to, bucket
+
+
+# История профита, сгруппированная в SQL по дням/неделям/месяцам; не больше PROFIT_CHART_MAX_POINTS последних точек
+def profit_chart(user, rate_snapshot, params):
+    date_from, date_to, bucket = get_profit_window(params)
+    trunc, _ = PROFIT_CHART_BUCKETS[bucket]
+
+    buckets = ProfitWallet.objects.filter(
+        user=user, date_created__gte=day_start(date_from), date_created__lt=day_start(date_to + timedelta(days=1))
+    ).annotate(
+        bucket=trunc('date_created', output_field=DateField())
+    ).values('bucket').annotate(amount=Sum('amount')).order_by('-bucket')[:get_profit_chart_max_points()]
+    buckets = list(buckets)[::-1]
+
+    return {
+        'labels': [row['bucket'].isoformat() for row in buckets],
+        'series': [[float(row['amount']) for row in buckets]],
     }
 
-    return JsonResponse(chart_data_json)
+
+CHART_SERIES = {
+    'allocation': allocation_chart,
+    'profit': profit_chart,
+}
+
+
+# Запрошенные серии и отметки изменений данных пользователя (считаются один раз на запрос)
+def get_chart_state(request):
+    if not hasattr(request, 'chart_state'):
+        requested = request.GET.get('series', ','.join(CHART_SERIES)).split(',')
+        user_updates = User.objects.filter(pk=request.user.pk).annotate(
+            wallet_updated=Subquery(Wallet.objects.filter(user=OuterRef('pk')).order_by('-last_updated').values(
+                'last_updated')[:1]),
+            profit_updated=Subquery(ProfitWallet.objects.filter(user=OuterRef('pk')).order_by(
+                '-date_created').values('date_created')[:1]),
+        ).values('wallet_updated', 'profit_updated').get()
+
+        request.chart_state = dict(
+            user_updates,
+            series=[name for name in dict.fromkeys(requested) if name in CHART_SERIES],
+            rate_snapshot=get_rate_snapshot(),
+        )
+    return request.chart_state
+
+
+def chart_etag(request):
+    state = get_chart_state(request)
+    stamp = ':'.join(str(part) for part in (
+        request.user.pk, request.get_full_path(), timezone.localdate(), state['wallet_updated'],
+        state['profit_updated'], state['rate_snapshot'].version,
+    ))
+    return hashlib.md5(stamp.encode()).hexdigest()
+
+
+def chart_last_modified(request):
+    state = get_chart_state(request)
+    updates = [state['wallet_updated'], state['profit_updated'], state['rate_snapshot'].last_updated]
+    return max((updated for updated in updates if updated is not None), default=None)
+
+
+# Данные графиков одним ответом: /chart_data/?series=allocation,profit, с ответом 304 без изменений
+@login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=chart_etag, last_modified_func=chart_last_modified)
+def chart_data(request):
+    state = get_chart_state(request)
+    try:
+        data = {name: CHART_SERIES[name](request.user, state['rate_snapshot'], request.GET) for name in state['series']}
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(data)
+
+
+@login_required
+def get_chart_data(request):
+    return JsonResponse(allocation_chart(request.user, get_rate_snapshot(), request.GET))
+
+
+# История профита: ?from=YYYY-MM-DD&to=YYYY-MM-DD&bucket=day|week|month
+@login_required
+def profit_chart_data(request):
+    try:
+        data = profit_chart(request.user, get_rate_snapshot(), request.GET)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(data)
 
 
 class DashboardView(LoginRequiredMixin, View):
@@ -62,60 +174,35 @@ class DashboardView(LoginRequiredMixin, View):
             user_profile = None
         return user_profile
 
-    def get_context_data(self):
+    def build_context_data(self):
         user = self.request.user
-        wallets = Wallet.objects.filter(user=user).prefetch_related(
-            Prefetch('coin__exchangerate_set', queryset=ExchangeRate.objects.all())
-        )
+        rate_snapshot = get_rate_snapshot()
+        wallets = list(Wallet.objects.filter(user=user).select_related('coin'))
         for wallet in wallets:
-            exchange_rate = wallet.coin.exchangerate_set.first()
-            wallet.usdt_equivalent = wallet.balance * (exchange_rate.rate if exchange_rate else 1)
+            wallet.usdt_equivalent = wallet.balance * rate_snapshot.rate(wallet.coin_id, 1)
 
         user_profile = UserProfile.objects.filter(user=user).first()
 
-        today = timezone.now().date()
+        today = timezone.localdate()
         yesterday = today - timedelta(days=1)
         first_day_of_month = today.replace(day=1)
         last_day_of_last_month = first_day_of_month - timedelta(days=1)
         first_day_of_last_month = last_day_of_last_month.replace(day=1)
 
-        profits = ProfitWallet.objects.filter(user=user)
-
-        aggregated_profits = profits.annotate(
-            profit_today=Case(
-                When(date_created__date=today, then=F('amount')),
-                default=Value(0),
-                output_field=models.DecimalField()
-            ),
-            profit_yesterday=Case(
-                When(date_created__date=yesterday, then=F('amount')),
-                default=Value(0),
-                output_field=models.DecimalField()
-            ),
-            profit_current_month=Case(
-                When(date_created__date__gte=first_day_of_month, date_created__date__lte=today, then=F('amount')),
-                default=Value(0),
-                output_field=models.DecimalField()
-            ),
-            profit_last_month=Case(
-                When(date_created__date__gte=first_day_of_last_month, date_created__date__lte=last_day_of_last_month,
-                     then=F('amount')),
-                default=Value(0),
-                output_field=models.DecimalField()
-            ),
-        ).aggregate(
-            profit_today_total=Sum('profit_today'),
-            profit_yesterday_total=Sum('profit_yesterday'),
-            profit_current_month_total=Sum('profit_current_month'),
-            profit_last_month_total=Sum('profit_last_month'),
-            profit_all_time=Sum('amount')
-        )
+        rollups = {
+            (rollup.period, rollup.period_start): rollup.amount
+            for rollup in ProfitRollup.objects.filter(user=user).filter(
+                Q(period=ProfitRollup.PERIOD_DAY, period_start__in=[today, yesterday]) |
+                Q(period=ProfitRollup.PERIOD_MONTH, period_start__in=[first_day_of_month, first_day_of_last_month]) |
+                Q(period=ProfitRollup.PERIOD_TOTAL, period_start=ProfitRollup.TOTAL_PERIOD_START)
+            )
+        }
 
-        profit_today = aggregated_profits['profit_today_total'] or 0
-        profit_yesterday = aggregated_profits['profit_yesterday_total'] or 0
-        profit_current_month = aggregated_profits['profit_current_month_total'] or 0
-        profit_last_month = aggregated_profits['profit_last_month_total'] or 0
-        profit_all_time = aggregated_profits['profit_all_time'] or 0
+        profit_today = rollups.get((ProfitRollup.PERIOD_DAY, today), 0)
+        profit_yesterday = rollups.get((ProfitRollup.PERIOD_DAY, yesterday), 0)
+        profit_current_month = rollups.get((ProfitRollup.PERIOD_MONTH, first_day_of_month), 0)
+        profit_last_month = rollups.get((ProfitRollup.PERIOD_MONTH, first_day_of_last_month), 0)
+        profit_all_time = rollups.get((ProfitRollup.PERIOD_TOTAL, ProfitRollup.TOTAL_PERIOD_START), 0)
 
         if profit_yesterday != 0:
             profit_day_change_percentage = ((profit_today - profit_yesterday) / profit_yesterday) * 100
@@ -130,7 +217,6 @@ class DashboardView(LoginRequiredMixin, View):
         context = {
             'wallets': wallets,
             'user_profile': user_profile,
-            'user_profile_form': UserProfileForm(instance=user_profile),
             'profit_today': profit_today,
             'profit_yesterday': profit_yesterday,
             'profit_current_month': profit_current_month,
@@ -141,6 +227,12 @@ class DashboardView(LoginRequiredMixin, View):
         }
         return context
 
+    # Контекст кэшируется по версиям пользователя, курсов и профита; форма собирается на каждый запрос
+    def get_context_data(self):
+        context = dict(get_dashboard_context(self.request.user.pk, self.build_context_data))
+        context['user_profile_form'] = UserProfileForm(instance=context['user_profile'])
+        return context
+
     def get(self, request):
         context = self.get_context_data()
         return render(request, self.template_name, context)
@@ -161,6 +253,24 @@ class DashboardView(LoginRequiredMixin, View):
         return redirect('dashboard')
 
 
+# Счетчики попаданий в кэш дашборда
+@staff_member_required
+def dashboard_cache_stats_view(request):
+    return JsonResponse(dashboard_cache_stats())
+
+
+# Метрики Prometheus всех процессов; доступ по заголовку Authorization: Bearer METRICS_TOKEN.
+# Без токена выдача доступна только с DEBUG. Без сессии и пользователя - выдача не обращается к БД
+def metrics_view(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not token:
+        if not settings.DEBUG:
+            raise Http404
+    elif not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+        return HttpResponse(status=401)
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)
+
+
 class MyPasswordChangeView(LoginRequiredMixin, PasswordChangeView):
     success_url = reverse_lazy('dashboard')
 
@@ -186,24 +296,25 @@ class WalletReplenishmentRequestView(LoginRequiredMixin, View):
     def post(self, request):
         form = WalletReplenishmentRequestForm(request.POST)
         if form.is_valid():
-            replenishment_request = form.save(commit=False)
-            replenishment_request.user = request.user
-            replenishment_request.save()
-
-            transaction = Transaction.objects.create(
-                user=request.user,
-                transaction_type='replenishment',
-                coin=replenishment_request.coin,
-                network=replenishment_request.network,
-                amount=replenishment_request.amount,
-                txid=replenishment_request.txid,
-            )
-
-            mail_admins(
-                subject='Запрос на пополнение',
-                message=f'{request.user.username} {replenishment_request.amount} {replenishment_request.coin} ({replenishment_request.network})',
-                fail_silently=False
-            )
+            with transaction.atomic():
+                replenishment_request = form.save(commit=False)
+                replenishment_request.user = request.user
+                replenishment_request.save()
+
+                Transaction.objects.create(
+                    user=request.user,
+                    transaction_type='replenishment',
+                    coin=replenishment_request.coin,
+                    network=replenishment_request.network,
+                    amount=replenishment_request.amount,
+                    txid=replenishment_request.txid,
+                )
+
+                queue_mail_admins(
+                    subject='Запрос на пополнение',
+                    message=f'{request.user.username} {replenishment_request.amount} {replenishment_request.coin} '
+                            f'({replenishment_request.network})',
+                )
 
             return redirect('replenishment_success')
 
@@ -247,21 +358,22 @@ class WalletWithdrawalRequestView(LoginRequiredMixin, View):
                 messages.error(request, 'Not enough funds in your wallet.')
                 return redirect('withdrawal')
 
-            withdrawal_request.save()
-
-            transaction = Transaction.objects.create(
-                user=request.user,
-                transaction_type='withdrawal',
-                coin=withdrawal_request.coin,
-                network=withdrawal_request.network,
-                amount=withdrawal_request.amount
-            )
-
-            mail_admins(
-                subject='Запрос на вывод средств',
-                message=f'{request.user.username} {withdrawal_request.amount} {withdrawal_request.coin} ({withdrawal_request.network})',
-                fail_silently=False
-            )
+            with transaction.atomic():
+                withdrawal_request.save()
+
+                Transaction.objects.create(
+                    user=request.user,
+                    transaction_type='withdrawal',
+                    coin=withdrawal_request.coin,
+                    network=withdrawal_request.network,
+                    amount=withdrawal_request.amount
+                )
+
+                queue_mail_admins(
+                    subject='Запрос на вывод средств',
+                    message=f'{request.user.username} {withdrawal_request.amount} {withdrawal_request.coin} '
+                            f'({withdrawal_request.network})',
+                )
             return redirect('withdrawal_success')
         return render(request, 'wallet/withdrawal.html', {'form': form})
 
@@ -272,53 +384,127 @@ class WithdrawalSuccessView(LoginRequiredMixin, View):
         return render(request, 'wallet/withdrawal_success.html')
 
 
+# Выгрузка истории транзакций: ?format=csv|json&from=&to=&coin=&transaction_type=&status=
+@login_required
+def export_transactions(request):
+    filter_form = TransactionFilterForm(request.GET)
+    filter_form.is_valid()
+    transactions = filter_form.filter(Transaction.objects.filter(user=request.user))
+    try:
+        return export_response(filter_export(transactions, request.GET), TRANSACTION_COLUMNS,
+                               request.GET.get('format', 'csv'), 'transactions')
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+
+# Выгрузка истории профита: ?format=csv|json&from=&to=&coin=
+@login_required
+def export_profit(request):
+    try:
+        return export_response(filter_export(ProfitWallet.objects.filter(user=request.user), request.GET),
+                               PROFIT_WALLET_COLUMNS, request.GET.get('format', 'csv'), 'profit')
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+
+# Курсор страницы истории: (date_created, id) граничной транзакции
+def encode_cursor(transaction):
+    return urlsafe_b64encode(f'{transaction.date_created.isoformat()}|{transaction.pk}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        date_created, pk = urlsafe_b64decode(cursor.encode()).decode().split('|', 1)
+        return datetime.fromisoformat(date_created), int(pk)
+    except ValueError:
+        return None
+
+
 # Кошелек
 class WalletView(LoginRequiredMixin, ListView):
     model = Transaction
     template_name = 'wallet/wallet.html'
     context_object_name = 'transactions'
-    paginate_by = 10
+    page_size = 10
+
+    def get_filter_form(self):
+        if not hasattr(self, 'filter_form'):
+            self.filter_form = TransactionFilterForm(self.request.GET)
+            self.filter_form.is_valid()
+        return self.filter_form
 
+    # Страница по курсору вместо OFFSET: after - следующая, before - предыдущая;
+    # отдельное условие на date_created дает границу диапазона для индекса (user, date_created, id)
     def get_queryset(self):
-        user_transactions = super().get_queryset().filter(user=self.request.user).order_by(
-            'date_created').select_related('coin')
-        return user_transactions
+        transactions = self.get_filter_form().filter(
+            Transaction.objects.filter(user=self.request.user)).select_related('coin')
+
+        before = decode_cursor(self.request.GET.get('before'))
+        if before:
+            date_created, pk = before
+            page = list(transactions.filter(date_created__lte=date_created).filter(
+                Q(date_created__lt=date_created) | Q(id__lt=pk)
+            ).order_by('-date_created', '-id')[:self.page_size + 1])
+            self.has_previous = len(page) > self.page_size
+            self.has_next = True
+            return page[:self.page_size][::-1]
+
+        after = decode_cursor(self.request.GET.get('after'))
+        if after:
+            date_created, pk = after
+            transactions = transactions.filter(date_created__gte=date_created).filter(
+                Q(date_created__gt=date_created) | Q(id__gt=pk))
+        page = list(transactions.order_by('date_created', 'id')[:self.page_size + 1])
+        self.has_previous = after is not None
+        self.has_next = len(page) > self.page_size
+        return page[:self.page_size]
+
+    def get_page_url(self, cursor_name, transaction):
+        params = self.request.GET.copy()
+        params.pop('after', None)
+        params.pop('before', None)
+        params[cursor_name] = encode_cursor(transaction)
+        return '?' + params.urlencode()
+
+    def get_transactions_count(self):
+        filter_form = self.get_filter_form()
+        filters = sorted(
+            (name, getattr(value, 'pk', value)) for name, value in filter_form.cleaned_data.items() if value)
+        return get_user_count(self.request.user.pk, 'transactions:' + urlencode(filters),
+                              filter_form.filter(Transaction.objects.filter(user=self.request.user)).count)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        transactions = context['object_list']
+        context.update({
+            'filter_form': self.get_filter_form(),
+            'transactions_count': self.get_transactions_count(),
+            'previous_page_url': self.get_page_url('before', transactions[0]) if transactions and self.has_previous
+            else None,
+            'next_page_url': self.get_page_url('after', transactions[-1]) if transactions and self.has_next else None,
+        })
 
         balance_datas = Wallet.objects.filter(user=self.request.user).select_related('coin')
-        exchange_rates = ExchangeRate.objects.select_related('coin').filter()
-        exchange_rate_mapping = {rate.coin_id: rate for rate in exchange_rates}
+        rate_snapshot = get_rate_snapshot()
 
+        total_usdt_balance = 0
         for balance_data in balance_datas:
-            exchange_rate = exchange_rate_mapping.get(balance_data.coin_id)
-            if exchange_rate:
-                balance_data.usdt_equivalent = balance_data.balance * exchange_rate.rate
-            else:
-                balance_data.usdt_equivalent = 0
-
-        total_usdt_balance = balance_datas.annotate(
-            usdt_equivalent=ExpressionWrapper(
-                F('balance') * F('coin__exchangerate__rate'),
-                output_field=FloatField()
-            )
-        ).aggregate(Sum('usdt_equivalent'))['usdt_equivalent__sum']
-
-        user_transactions_replenishment = Transaction.objects.filter(
-            user=self.request.user, transaction_type='replenishment', status='completed'
-        )
-        user_transactions_withdrawal = Transaction.objects.filter(
-            user=self.request.user, transaction_type='withdrawal', status='completed'
-        )
+            rate = rate_snapshot.rate(balance_data.coin_id)
+            balance_data.usdt_equivalent = balance_data.balance * rate if rate is not None else 0
+            total_usdt_balance += balance_data.usdt_equivalent
 
-        total_usd_replenishment = user_transactions_replenishment.aggregate(
-            total_replenishment=Sum(F('amount') * F('coin__exchangerate__rate'))
-        )['total_replenishment'] or 0
+        # Суммы завершенных пополнений и выводов по монетам одним запросом, пересчет в USD по снимку курсов
+        completed_totals = Transaction.objects.filter(
+            user=self.request.user, transaction_type__in=['replenishment', 'withdrawal'], status='completed'
+        ).order_by().values('transaction_type', 'coin_id').annotate(total=Sum('amount'))
 
-        total_usd_withdrawal = user_transactions_withdrawal.aggregate(
-            total_withdrawal=Sum(F('amount') * F('coin__exchangerate__rate'))
-        )['total_withdrawal'] or 0
+        total_usd = {'replenishment': 0, 'withdrawal': 0}
+        for row in completed_totals:
+            rate = rate_snapshot.rate(row['coin_id'])
+            if rate is not None:
+                total_usd[row['transaction_type']] += row['total'] * rate
 
         try:
             user_profile = UserProfile.objects.get(user=self.request.user)
@@ -329,9 +515,9 @@ class WalletView(LoginRequiredMixin, ListView):
             'user_profile': user_profile,
             'balance_datas': balance_datas,
             'total_usdt_balance': total_usdt_balance,
-            'exchange_rates': exchange_rates,
-            'total_usd_replenishment': total_usd_replenishment if total_usd_replenishment is not None else 0,
-            'total_usd_withdrawal': total_usd_withdrawal if total_usd_withdrawal is not None else 0,
+            'exchange_rates': rate_snapshot.exchange_rates,
+            'total_usd_replenishment': total_usd['replenishment'],
+            'total_usd_withdrawal': total_usd['withdrawal'],
         })
 
         return context
@@ -1,10 +1,10 @@
 $(document).ready(function () {
 
     function fetchDataForChart() {
-        return fetch('/profit_chart_data/')
+        return fetch('/chart_data/?series=profit')
             .then(response => response.json())
             .then(data => {
-                buildChart(data);
+                buildChart(data.profit);
             })
             .catch(error => {
                 console.error('ERROR CHARTS', error);
@@ -1,15 +1,15 @@
 
 $(document).ready(function() {
   function initializeDataTable() {
-    $("#datatable").DataTable();
+    $("#datatable").DataTable({paging: false, info: false, ordering: false});
     $(".dataTables_length select").addClass("form-select form-select-sm");
   }
 
   function fetchDataForChart() {
-    return fetch('/get_chart_data/')
+    return fetch('/chart_data/?series=allocation')
       .then(response => response.json())
       .then(data => {
-        buildChart(data);
+        buildChart(data.allocation);
       })
       .catch(error => {
         console.error('ERROR CHARTS', error);